@@ -16,6 +16,7 @@ from torch.optim import RMSprop, Adam
 from src.algos.qlearning.global_ann import GlobalPolicyNetwork
 from src.algos.qlearning.per_uav_ann import PerUAVPolicyNetwork
 from src.envs.grid_world import GridWorldEnv
+from src.envs.vector_env import BatchedGridWorldEnv
 from src.metrics.metrics import EpisodeStats, aggregate_episode_stats
 from src.utils.config import load_config, merge_configs
 from src.utils.logging import setup_logger
@@ -23,7 +24,9 @@ from src.utils.schedule import EpsilonSchedule
 from src.utils.seeding import set_seed
 
 Transition = namedtuple(
-    "Transition", ["state", "action", "reward", "next_state", "done"]
+    "Transition",
+    ["state", "action", "reward", "next_state", "done", "next_avail", "duration"],
+    defaults=(None, 1),
 )
 
 
@@ -38,8 +41,10 @@ class ReplayBuffer:
         reward: np.ndarray,
         next_state: np.ndarray,
         done: bool,
+        next_avail: np.ndarray | None = None,
+        duration: int = 1,
     ) -> None:
-        self.buffer.append(Transition(state, action, reward, next_state, done))
+        self.buffer.append(Transition(state, action, reward, next_state, done, next_avail, duration))
 
     def sample(self, batch_size: int) -> Transition:
         batch = random.sample(self.buffer, batch_size)
@@ -62,30 +67,72 @@ def select_actions(
     device: torch.device,
     network_type: str,
     per_uav_nets: List[nn.Module] | None = None,
+    avail_actions: np.ndarray | None = None,
 ) -> Tuple[np.ndarray, torch.Tensor]:
     if random.random() < epsilon:
-        actions = np.array([random.randrange(action_dim) for _ in range(num_uavs)])
+        if avail_actions is not None:
+            actions = np.array([random.choice(np.flatnonzero(row).tolist()) for row in avail_actions])
+        else:
+            actions = np.array([random.randrange(action_dim) for _ in range(num_uavs)])
         return actions, None
 
     state_tensor = to_device(state, device).unsqueeze(0)
     if network_type == "global":
         with torch.no_grad():
             q_values = policy_net(state_tensor).cpu().numpy()[0]
+        if avail_actions is not None:
+            q_values = np.where(avail_actions, q_values, -1e9)
         actions = q_values.argmax(axis=1)
         return actions, torch.tensor(q_values, dtype=torch.float32, device=device)
 
     # Per UAV networks
     actions = []
     q_values = []
-    for net in per_uav_nets or []:
+    for idx, net in enumerate(per_uav_nets or []):
         with torch.no_grad():
             q_val = net(state_tensor).cpu().numpy()[0]
+        if avail_actions is not None:
+            q_val = np.where(avail_actions[idx], q_val, -1e9)
         q_values.append(q_val)
         actions.append(int(np.argmax(q_val)))
     q_values_tensor = torch.tensor(np.stack(q_values), dtype=torch.float32, device=device)
     return np.array(actions), q_values_tensor
 
 
+def select_batched_actions(
+    states: np.ndarray,
+    policy_net,
+    num_uavs: int,
+    action_dim: int,
+    epsilon: float,
+    device: torch.device,
+    network_type: str,
+    per_uav_nets: List[nn.Module] | None = None,
+    avail_actions: np.ndarray | None = None,
+) -> np.ndarray:
+    """``select_actions`` for a (num_envs, obs_dim) batch, exploring per environment.
+
+    ``avail_actions`` is the (num_envs, num_uavs, action_dim) mask from the
+    batched environment's ``info``.
+    """
+    state_tensor = to_device(states, device)
+    with torch.no_grad():
+        if network_type == "global":
+            q_values = policy_net(state_tensor)
+        else:
+            q_values = torch.stack([net(state_tensor) for net in per_uav_nets or []], dim=1)
+    q_values = q_values.cpu().numpy()
+    explore = np.random.random(len(states)) < epsilon
+    if avail_actions is not None:
+        q_values = np.where(avail_actions, q_values, -1e9)
+        # Uniform random scores restricted to the available moves.
+        noise = np.where(avail_actions[explore], np.random.random(avail_actions[explore].shape), -1.0)
+        q_values[explore] = noise
+    else:
+        q_values[explore] = np.random.random((int(explore.sum()), num_uavs, action_dim))
+    return q_values.argmax(axis=2)
+
+
 def compute_loss_global(
     batch: Transition,
     policy_net: nn.Module,
@@ -100,13 +147,19 @@ def compute_loss_global(
         np.stack(batch.next_state), dtype=torch.float32, device=device
     )
     dones = torch.tensor(np.array(batch.done, dtype=np.float32), device=device).unsqueeze(-1)
+    # Macro-action transitions span several primitive steps.
+    discounts = gamma ** torch.tensor(np.array(batch.duration, dtype=np.float32), device=device).unsqueeze(-1)
 
     q_values = policy_net(states)
     state_action_values = q_values.gather(2, actions.unsqueeze(-1)).squeeze(-1)
 
     with torch.no_grad():
-        next_q_values = target_net(next_states).max(dim=2).values
-        target_values = rewards + gamma * (1 - dones) * next_q_values
+        next_q_values = target_net(next_states)
+        if batch.next_avail[0] is not None:
+            next_avail = torch.as_tensor(np.stack(batch.next_avail), dtype=torch.bool, device=device)
+            next_q_values = next_q_values.masked_fill(~next_avail, -1e9)
+        next_q_values = next_q_values.max(dim=2).values
+        target_values = rewards + discounts * (1 - dones) * next_q_values
 
     loss = nn.functional.mse_loss(state_action_values, target_values)
     return loss
@@ -126,6 +179,10 @@ def compute_loss_per_uav(
         np.stack(batch.next_state), dtype=torch.float32, device=device
     )
     dones = torch.tensor(np.array(batch.done, dtype=np.float32), device=device)
+    discounts = gamma ** torch.tensor(np.array(batch.duration, dtype=np.float32), device=device)
+    next_avail = None
+    if batch.next_avail[0] is not None:
+        next_avail = torch.as_tensor(np.stack(batch.next_avail), dtype=torch.bool, device=device)
 
     losses = []
     for idx, (net, target_net) in enumerate(zip(policy_nets, target_nets)):
@@ -133,8 +190,11 @@ def compute_loss_per_uav(
         state_action = q_values.gather(1, actions[:, idx].unsqueeze(-1)).squeeze(-1)
 
         with torch.no_grad():
-            next_q = target_net(next_states).max(dim=1).values
-            target = rewards[:, idx] + gamma * (1 - dones) * next_q
+            next_q = target_net(next_states)
+            if next_avail is not None:
+                next_q = next_q.masked_fill(~next_avail[:, idx], -1e9)
+            next_q = next_q.max(dim=1).values
+            target = rewards[:, idx] + discounts * (1 - dones) * next_q
         losses.append(nn.functional.mse_loss(state_action, target))
     return torch.mean(torch.stack(losses))
 
@@ -182,18 +242,35 @@ def train_single_setting(
     if device.type == "cuda" and not torch.cuda.is_available():
         device = torch.device("cpu")
 
-    env = GridWorldEnv(
+    env_kwargs = dict(
         map_size=map_size,
         num_uavs=num_uavs,
         obstacle_density=obstacle_density,
         obstacle_type=env_cfg.get("obstacle_type", "static"),
         max_steps=env_cfg.get("max_steps", 1000),
         energy_budget=env_cfg.get("energy_budget", 1800),
-        seed=env_cfg.get("seed"),
+        map_backend=env_cfg.get("map_backend", "dense"),
+        motion_model=env_cfg.get("motion_model", "random_walk"),
+        dynamic_fraction=env_cfg.get("dynamic_fraction", 0.1),
+        move_probability=env_cfg.get("move_probability", 0.5),
+        scenario_bank=env_cfg.get("scenario_bank"),
+        coverage_cells=env_cfg.get("coverage_cells", "reachable"),
+        action_mode=env_cfg.get("action_mode", "primitive"),
+        max_macro_steps=env_cfg.get("max_macro_steps"),
     )
-
-    obs_dim = int(env.observation_space.shape[0])
-    action_dim = int(env.action_space.nvec[0])
+    action_masking = bool(algo_cfg.get("action_masking", False))
+    # Several environments stepped as one batch; one gradient update per batched step.
+    num_envs = int(algo_cfg.get("num_envs", 1))
+    if num_envs < 1:
+        raise ValueError("num_envs must be positive")
+    if num_envs > 1:
+        env = BatchedGridWorldEnv(num_envs, seed=env_cfg.get("seed"), **env_kwargs)
+        obs_dim = int(env.single_observation_space.shape[0])
+        action_dim = int(env.single_action_space.nvec[0])
+    else:
+        env = GridWorldEnv(seed=env_cfg.get("seed"), **env_kwargs)
+        obs_dim = int(env.observation_space.shape[0])
+        action_dim = int(env.action_space.nvec[0])
 
     network_type = algo_cfg.get("network_type", "global").lower()
     hidden_dim = algo_cfg.get("hidden_dim", 167)
@@ -252,90 +329,163 @@ def train_single_setting(
     )
 
     global_step = 0
-    for episode in range(1, episodes + 1):
-        obs, info = env.reset()
-        episode_stats = EpisodeStats(
-            start_time=time.time(),
-            total_cells=info.get("valid_cells", env.total_cells),
-            per_uav_new_cells=[0 for _ in range(num_uavs)],
+
+    def train_step() -> None:
+        nonlocal global_step
+        batch = replay_buffer.sample(batch_size)
+        optimizer.zero_grad()
+        if network_type == "global":
+            loss = compute_loss_global(batch, policy_net, target_net, device, gamma)
+        else:
+            loss = compute_loss_per_uav(batch, per_uav_nets, per_uav_targets, device, gamma)
+        loss.backward()
+        nn.utils.clip_grad_norm_(
+            policy_net.parameters() if policy_net is not None else [p for net in per_uav_nets for p in net.parameters()],
+            max_norm=5.0,
         )
-        done = False
-        truncated = False
-        prev_actions = np.zeros(num_uavs, dtype=int)
+        optimizer.step()
 
-        while not (done or truncated):
-            epsilon = epsilon_schedule.get()
-            actions, _ = select_actions(
+        global_step += 1
+        if global_step % target_update_interval == 0:
+            if network_type == "global":
+                copy_weights(policy_net, target_net)
+            else:
+                copy_weights_list(per_uav_nets, per_uav_targets)
+
+    def log_progress(episode: int) -> None:
+        if episode % log_interval == 0:
+            recent_stats = aggregate_episode_stats(stats_all[-log_interval:])
+            logger.info(
+                "Episode %d | coverage_mean=%.3f | pa_mean=%.3f | steps_mean=%.1f | epsilon=%.3f",
+                episode,
+                recent_stats.get("coverage_mean", 0.0),
+                recent_stats.get("pa_mean", 0.0),
+                recent_stats.get("steps_mean", 0.0),
+                epsilon_schedule.get(),
+            )
+
+    if num_envs > 1:
+        obs, info = env.reset()
+        running = [
+            EpisodeStats(start_time=time.time(), total_cells=int(total), per_uav_new_cells=[0] * num_uavs)
+            for total in env.coverage_total
+        ]
+        finished = 0
+        while finished < episodes:
+            actions = select_batched_actions(
                 obs,
                 policy_net,
                 num_uavs,
                 action_dim,
-                epsilon,
+                epsilon_schedule.get(),
                 device,
                 network_type,
                 per_uav_nets,
+                avail_actions=info["avail_actions"] if action_masking else None,
             )
-
-            next_obs, rewards, done_flag, truncated_flag, step_info = env.step(actions)
-            done = done_flag
-            truncated = truncated_flag
-
-            replay_buffer.push(obs, actions, rewards, next_obs, done or truncated)
-
-            episode_stats.steps += 1
-            episode_stats.total_actions += num_uavs
-            episode_stats.energy_consumed += num_uavs
-            episode_stats.collisions += step_info.get("collisions", 0)
-            episode_stats.obstacle_hits += step_info.get("obstacle_hits", 0)
-            episode_stats.visited_cells = step_info.get("visited_count", episode_stats.visited_cells)
-
-            reward_vector = np.array(step_info.get("reward_vector", rewards))
+            next_obs, rewards, terminated, truncated, step_info = env.step(actions)
+            done = terminated | truncated
+            # Finished environments already restarted; their last observation is kept here.
+            final_obs = step_info["final_observation"]
+            final_avail = step_info["final_avail_actions"]
             new_cell_threshold = env.reward_new_cell_base
-            for idx, reward_value in enumerate(reward_vector):
-                if reward_value >= new_cell_threshold * 0.8:
-                    episode_stats.new_cell_actions += 1
-                    episode_stats.per_uav_new_cells[idx] += 1
+            for env_id in range(num_envs):
+                replay_buffer.push(
+                    obs[env_id],
+                    actions[env_id],
+                    rewards[env_id],
+                    final_obs[env_id],
+                    bool(done[env_id]),
+                    final_avail[env_id] if action_masking else None,
+                )
+                episode_stats = running[env_id]
+                episode_stats.steps += 1
+                episode_stats.total_actions += num_uavs
+                episode_stats.energy_consumed += num_uavs
+                episode_stats.collisions += int(step_info["collisions"][env_id])
+                episode_stats.obstacle_hits += int(step_info["obstacle_hits"][env_id])
+                episode_stats.visited_cells = int(step_info["visited_count"][env_id])
+                for idx, reward_value in enumerate(rewards[env_id]):
+                    if reward_value >= new_cell_threshold * 0.8:
+                        episode_stats.new_cell_actions += 1
+                        episode_stats.per_uav_new_cells[idx] += 1
+                if done[env_id] and finished < episodes:
+                    episode_stats.end_time = time.time()
+                    episode_stats.success = bool(terminated[env_id] and step_info["coverage"][env_id] >= 0.99)
+                    stats_all.append(episode_stats)
+                    epsilon_schedule.step()
+                    finished += 1
+                    log_progress(finished)
+                    running[env_id] = EpisodeStats(
+                        start_time=time.time(),
+                        total_cells=int(env.coverage_total[env_id]),
+                        per_uav_new_cells=[0] * num_uavs,
+                    )
 
             if len(replay_buffer) >= min_memory:
-                batch = replay_buffer.sample(batch_size)
-                optimizer.zero_grad()
-                if network_type == "global":
-                    loss = compute_loss_global(batch, policy_net, target_net, device, gamma)
-                else:
-                    loss = compute_loss_per_uav(batch, per_uav_nets, per_uav_targets, device, gamma)
-                loss.backward()
-                nn.utils.clip_grad_norm_(
-                    policy_net.parameters() if policy_net is not None else [p for net in per_uav_nets for p in net.parameters()],
-                    max_norm=5.0,
+                train_step()
+            obs, info = next_obs, step_info
+    else:
+        for episode in range(1, episodes + 1):
+            obs, info = env.reset()
+            episode_stats = EpisodeStats(
+                start_time=time.time(),
+                total_cells=info.get("coverage_total", env.total_cells),
+                per_uav_new_cells=[0 for _ in range(num_uavs)],
+            )
+            done = False
+            truncated = False
+            prev_actions = np.zeros(num_uavs, dtype=int)
+
+            while not (done or truncated):
+                epsilon = epsilon_schedule.get()
+                actions, _ = select_actions(
+                    obs,
+                    policy_net,
+                    num_uavs,
+                    action_dim,
+                    epsilon,
+                    device,
+                    network_type,
+                    per_uav_nets,
+                    avail_actions=info["avail_actions"] if action_masking else None,
                 )
-                optimizer.step()
-
-                global_step += 1
-                if global_step % target_update_interval == 0:
-                    if network_type == "global":
-                        copy_weights(policy_net, target_net)
-                    else:
-                        copy_weights_list(per_uav_nets, per_uav_targets)
-
-            obs = next_obs
-            prev_actions = actions
 
-        episode_stats.end_time = time.time()
-        episode_stats.success = bool(done and step_info.get("coverage", 0.0) >= 0.99)
-        stats_all.append(episode_stats)
-
-        epsilon_schedule.step()
-
-        if episode % log_interval == 0:
-            recent_stats = aggregate_episode_stats(stats_all[-log_interval:])
-            logger.info(
-                "Episode %d | coverage_mean=%.3f | pa_mean=%.3f | steps_mean=%.1f | epsilon=%.3f",
-                episode,
-                recent_stats.get("coverage_mean", 0.0),
-                recent_stats.get("pa_mean", 0.0),
-                recent_stats.get("steps_mean", 0.0),
-                epsilon_schedule.get(),
-            )
+                next_obs, rewards, done_flag, truncated_flag, step_info = env.step(actions)
+                done = done_flag
+                truncated = truncated_flag
+
+                next_avail = step_info["avail_actions"] if action_masking else None
+                primitive_steps = step_info.get("primitive_steps", 1)
+                replay_buffer.push(obs, actions, rewards, next_obs, done or truncated, next_avail, primitive_steps)
+
+                episode_stats.steps += primitive_steps
+                episode_stats.total_actions += num_uavs
+                episode_stats.energy_consumed += num_uavs * primitive_steps
+                episode_stats.collisions += step_info.get("collisions", 0)
+                episode_stats.obstacle_hits += step_info.get("obstacle_hits", 0)
+                episode_stats.visited_cells = step_info.get("visited_count", episode_stats.visited_cells)
+
+                reward_vector = np.array(step_info.get("reward_vector", rewards))
+                new_cell_threshold = env.reward_new_cell_base
+                for idx, reward_value in enumerate(reward_vector):
+                    if reward_value >= new_cell_threshold * 0.8:
+                        episode_stats.new_cell_actions += 1
+                        episode_stats.per_uav_new_cells[idx] += 1
+
+                if len(replay_buffer) >= min_memory:
+                    train_step()
+
+                obs = next_obs
+                info = step_info
+                prev_actions = actions
+
+            episode_stats.end_time = time.time()
+            episode_stats.success = bool(done and step_info.get("coverage", 0.0) >= 0.99)
+            stats_all.append(episode_stats)
+
+            epsilon_schedule.step()
+            log_progress(episode)
 
     summary = aggregate_episode_stats(stats_all)
     logger.info(
@@ -1,6 +1,9 @@
 ﻿"""Agent network for QMIX."""
 from __future__ import annotations
 
+from typing import Dict, List, Sequence
+
+import numpy as np
 import torch
 from torch import nn
 
@@ -33,3 +36,270 @@ class AgentNetwork(nn.Module):
         h = self.rnn(x, hidden_state)
         q = self.fc2(h)
         return q, h
+
+
+class BatchedAgentNetwork(nn.Module):
+    """All agents' :class:`AgentNetwork` weights stacked along a leading agent axis.
+
+    Inputs and hidden states are laid out as (agents, batch, features), so every
+    layer is a single batched matmul for all agents instead of one call per
+    agent. Weights convert to and from the per-agent ``AgentNetwork`` state
+    dicts stored in checkpoints.
+    """
+
+    LAYOUT = "independent"
+    # Parameters held once for all agents instead of stacked per agent.
+    SHARED_PARAMETER_NAMES: Sequence[str] = ()
+    PARAMETER_NAMES = (
+        "fc1.weight",
+        "fc1.bias",
+        "rnn.weight_ih",
+        "rnn.weight_hh",
+        "rnn.bias_ih",
+        "rnn.bias_hh",
+        "fc2.weight",
+        "fc2.bias",
+    )
+
+    def __init__(
+        self,
+        num_agents: int,
+        obs_dim: int,
+        action_dim: int,
+        hidden_dim: int = 64,
+    ) -> None:
+        super().__init__()
+        if num_agents < 1:
+            raise ValueError("num_agents must be positive")
+        self.num_agents = num_agents
+        self.obs_dim = obs_dim
+        self.action_dim = action_dim
+        self.hidden_dim = hidden_dim
+        # Initialise exactly as independent AgentNetworks would be.
+        agents = [AgentNetwork(obs_dim, action_dim, hidden_dim) for _ in range(num_agents)]
+        for name in self.PARAMETER_NAMES:
+            stacked = torch.stack([agent.state_dict()[name] for agent in agents])
+            self.register_parameter(name.replace(".", "_"), nn.Parameter(stacked))
+
+    def load_agent_state_dicts(self, states: Sequence[Dict[str, torch.Tensor]]) -> None:
+        """Load a list of per-agent ``AgentNetwork`` state dicts."""
+        if len(states) != self.num_agents:
+            raise ValueError(f"Expected {self.num_agents} agent states, got {len(states)}")
+        with torch.no_grad():
+            for name in self.PARAMETER_NAMES:
+                param = getattr(self, name.replace(".", "_"))
+                shared = name in self.SHARED_PARAMETER_NAMES
+                stacked = torch.stack([state[name] for state in states]).to(param.device)
+                agent_shape = param.shape if shared else param.shape[1:]
+                if stacked.shape[1:] != agent_shape:
+                    raise ValueError(f"Agent state {name} has shape {tuple(stacked.shape[1:])}, expected {tuple(agent_shape)}")
+                if shared:
+                    if not all(torch.equal(stacked[0], value) for value in stacked[1:]):
+                        raise ValueError(f"Agent states differ in shared parameter {name}")
+                    stacked = stacked[0]
+                param.copy_(stacked)
+
+    def agent_state_dicts(self) -> List[Dict[str, torch.Tensor]]:
+        """Return per-agent ``AgentNetwork`` state dicts (detached copies)."""
+        return [
+            {name: self._agent_parameter(name, idx).detach().clone() for name in self.PARAMETER_NAMES}
+            for idx in range(self.num_agents)
+        ]
+
+    def _agent_parameter(self, name: str, idx: int) -> torch.Tensor:
+        param = getattr(self, name.replace(".", "_"))
+        return param if name in self.SHARED_PARAMETER_NAMES else param[idx]
+
+    def init_hidden(self, batch_size: int, device: torch.device | None = None) -> torch.Tensor:
+        return torch.zeros(self.num_agents, batch_size, self.hidden_dim, device=device)
+
+    def forward(
+        self,
+        obs: torch.Tensor,
+        hidden_state: torch.Tensor,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Evaluate every agent: ``obs`` is (agents, batch, obs_dim), ``hidden_state`` (agents, batch, hidden)."""
+        return self.forward_preactivated(self.fc1_preactivation(obs), hidden_state)
+
+    def forward_preactivated(
+        self,
+        fc1_pre: torch.Tensor,
+        hidden_state: torch.Tensor,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """:meth:`forward` from fc1 pre-activations as returned by :meth:`fc1_preactivation`."""
+        h = self._gru_update(self._preactivation_gates(fc1_pre), hidden_state)
+        q = torch.baddbmm(self.fc2_bias.unsqueeze(1), h, self.fc2_weight.transpose(1, 2))
+        return q, h
+
+    def fc1_preactivation(self, obs: torch.Tensor) -> torch.Tensor:
+        """fc1 outputs before the ReLU, (agents, batch, hidden) for ``obs`` (agents, batch, obs_dim)."""
+        return self._fc1(self.fc1_inputs(obs))
+
+    def _fc1(self, inputs: torch.Tensor) -> torch.Tensor:
+        if inputs.stride(0) == 0:
+            # One observation broadcast to every agent: a single matmul against
+            # all agents' weights instead of U copies of the input.
+            num_agents, batch_size, _ = inputs.shape
+            out = inputs[0] @ self.fc1_weight.reshape(-1, self.obs_dim).t()
+            return out.view(batch_size, num_agents, -1).transpose(0, 1) + self.fc1_bias.unsqueeze(1)
+        return torch.baddbmm(self.fc1_bias.unsqueeze(1), inputs, self.fc1_weight.transpose(1, 2))
+
+    def fc1_inputs(self, obs: torch.Tensor) -> torch.Tensor:
+        """The part of ``obs`` (agents, batch, obs_dim) that fc1 reads."""
+        return obs
+
+    def fc1_increment(self, fc1_pre: torch.Tensor, index: torch.Tensor, delta: torch.Tensor) -> None:
+        """Add ``delta`` at flat ``index`` of :meth:`fc1_inputs` to the pre-activations ``fc1_pre`` in place.
+
+        Only the weight columns of the changed inputs are read.
+        """
+        row, col = index // self.obs_dim, index % self.obs_dim
+        columns = self.fc1_weight[row // fc1_pre.shape[1], :, col]
+        fc1_pre.view(-1, self.hidden_dim).index_add_(0, row, columns * delta.unsqueeze(1))
+
+    def unroll(
+        self,
+        obs: torch.Tensor,
+        hidden_state: torch.Tensor,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Evaluate whole sequences: ``obs`` is (agents, batch, time, obs_dim).
+
+        fc1, the GRU input projection and fc2 each run once over the
+        flattened (batch, time) block; only the hidden-to-hidden projection
+        is applied step by step. Returns Q-values (agents, batch, time,
+        actions) and the final hidden state (agents, batch, hidden).
+        """
+        num_agents, batch_size, steps, _ = obs.shape
+        # Flatten only what fc1 reads; a broadcast observation stays a view.
+        inputs = self.fc1_inputs(obs)
+        if inputs.dim() == 4 and inputs.stride(0) == 0:
+            inputs = inputs[0].reshape(batch_size * steps, -1).expand(num_agents, -1, -1)
+        else:
+            inputs = inputs.flatten(-3, -2)
+        gates_x = self._preactivation_gates(self._fc1(inputs))
+        gates_x = gates_x.view(num_agents, batch_size, steps, -1)
+        h = hidden_state
+        outputs = []
+        # unbind keeps backward linear in the sequence length; indexing each
+        # step would scatter a full-size gradient per step.
+        for step_gates in gates_x.unbind(dim=2):
+            h = self._gru_update(step_gates, h)
+            outputs.append(h)
+        hs = torch.stack(outputs, dim=2).view(num_agents, batch_size * steps, -1)
+        q = torch.baddbmm(self.fc2_bias.unsqueeze(1), hs, self.fc2_weight.transpose(1, 2))
+        return q.view(num_agents, batch_size, steps, -1), h
+
+    def _preactivation_gates(self, fc1_pre: torch.Tensor) -> torch.Tensor:
+        # A shared encoder yields (batch, hidden); broadcast it over the agents.
+        x = torch.relu(fc1_pre).expand(self.num_agents, -1, -1)
+        return torch.baddbmm(self.rnn_bias_ih.unsqueeze(1), x, self.rnn_weight_ih.transpose(1, 2))
+
+    def _gru_update(self, gates_x: torch.Tensor, hidden_state: torch.Tensor) -> torch.Tensor:
+        gates_h = torch.baddbmm(self.rnn_bias_hh.unsqueeze(1), hidden_state, self.rnn_weight_hh.transpose(1, 2))
+        # Same gate order and update rule as nn.GRUCell: reset, update, new.
+        reset_x, update_x, new_x = gates_x.chunk(3, dim=-1)
+        reset_h, update_h, new_h = gates_h.chunk(3, dim=-1)
+        reset = torch.sigmoid(reset_x + reset_h)
+        update = torch.sigmoid(update_x + update_h)
+        candidate = torch.tanh(new_x + reset * new_h)
+        return candidate + update * (hidden_state - candidate)
+
+
+class SharedTrunkAgentNetwork(BatchedAgentNetwork):
+    """:class:`BatchedAgentNetwork` with one fc1 encoder shared by all agents.
+
+    Meant for observations every agent sees identically (the tiled global
+    observation): the encoder runs once per (batch, time) step and only the
+    GRU and output heads are per agent, selected by the agent axis. Inputs
+    keep the (agents, batch, ...) layout but only agent 0's rows are read.
+    Per-agent state dicts repeat the shared encoder, so they load as plain
+    ``AgentNetwork`` weights.
+    """
+
+    LAYOUT = "shared_trunk"
+    SHARED_PARAMETER_NAMES = ("fc1.weight", "fc1.bias")
+
+    def __init__(
+        self,
+        num_agents: int,
+        obs_dim: int,
+        action_dim: int,
+        hidden_dim: int = 64,
+    ) -> None:
+        super().__init__(num_agents, obs_dim, action_dim, hidden_dim)
+        # Keep agent 0's encoder as the shared one.
+        for name in self.SHARED_PARAMETER_NAMES:
+            attr = name.replace(".", "_")
+            setattr(self, attr, nn.Parameter(getattr(self, attr).detach()[0].clone()))
+
+    def fc1_preactivation(self, obs: torch.Tensor) -> torch.Tensor:
+        """Shared fc1 outputs before the ReLU, (batch, hidden), from agent 0's rows of ``obs``."""
+        return self._fc1(self.fc1_inputs(obs))
+
+    def _fc1(self, inputs: torch.Tensor) -> torch.Tensor:
+        return torch.addmm(self.fc1_bias, inputs, self.fc1_weight.t())
+
+    def fc1_inputs(self, obs: torch.Tensor) -> torch.Tensor:
+        return obs[0]
+
+    def fc1_increment(self, fc1_pre: torch.Tensor, index: torch.Tensor, delta: torch.Tensor) -> None:
+        row, col = index // self.obs_dim, index % self.obs_dim
+        fc1_pre.index_add_(0, row, self.fc1_weight[:, col].t() * delta.unsqueeze(1))
+
+
+class Fc1Accumulator:
+    """Running fc1 pre-activations for step-by-step acting (NNUE-style).
+
+    Consecutive observations differ in a few cells, so instead of a dense
+    fc1 matmul per step the accumulator adds ``delta * weight column`` for
+    each changed input. A full recompute every ``refresh_interval`` steps,
+    or when more than ``max_changed_fraction`` of the inputs changed,
+    bounds float drift. Call :meth:`reset` at episode starts and whenever
+    the network's weights change.
+    """
+
+    def __init__(
+        self,
+        net: BatchedAgentNetwork,
+        refresh_interval: int = 256,
+        max_changed_fraction: float = 0.25,
+    ) -> None:
+        if refresh_interval < 1:
+            raise ValueError("refresh_interval must be positive")
+        self.net = net
+        self.refresh_interval = refresh_interval
+        self.max_changed_fraction = max_changed_fraction
+        self.reset()
+
+    def reset(self) -> None:
+        self._inputs: torch.Tensor | None = None
+        self._fc1_pre: torch.Tensor | None = None
+        self._since_refresh = 0
+
+    @torch.no_grad()
+    def update(self, obs: torch.Tensor) -> torch.Tensor:
+        """Return fc1 pre-activations for ``obs`` (agents, batch, obs_dim).
+
+        ``obs`` is kept for the next delta and must not be modified afterwards.
+        """
+        inputs = self.net.fc1_inputs(obs)
+        previous = self._inputs
+        self._inputs = inputs
+        if previous is not None and previous.shape == inputs.shape and self._since_refresh < self.refresh_interval:
+            index = self._changed_inputs(inputs, previous)
+            if index.numel() <= self.max_changed_fraction * inputs.numel():
+                delta = inputs.reshape(-1)[index] - previous.reshape(-1)[index]
+                self.net.fc1_increment(self._fc1_pre, index, delta)
+                self._since_refresh += 1
+                return self._fc1_pre
+        self._fc1_pre = self.net.fc1_preactivation(obs)
+        self._since_refresh = 0
+        return self._fc1_pre
+
+    @staticmethod
+    def _changed_inputs(inputs: torch.Tensor, previous: torch.Tensor) -> torch.Tensor:
+        """Flat indices where ``inputs`` differs from ``previous``."""
+        if inputs.device.type == "cpu":
+            # numpy's flatnonzero is several times faster than torch.nonzero on CPU.
+            return torch.from_numpy(np.flatnonzero(inputs.numpy() != previous.numpy()))
+        return torch.nonzero((inputs != previous).reshape(-1)).squeeze(1)
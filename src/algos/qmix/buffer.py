@@ -1,69 +1,500 @@
 ﻿"""Replay buffer for QMIX."""
 from __future__ import annotations
 
-from collections import deque
-from typing import Dict, List
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import numpy as np
 
+# Fields holding one frame more than there are transitions.
+_FRAME_FIELDS = ("obs", "state", "available_actions")
+# Compact-replay fields: per-frame, and stored once per episode.
+_COMPACT_FRAME_FIELDS = ("positions", "energy", "visit_counts", "available_actions")
+_COMPACT_EPISODE_FIELDS = ("obstacle_map", "visit_cells")
+
+
+def _transition_fields(max_seq_len: int, num_agents: int, action_dim: int) -> Dict[str, tuple]:
+    return {
+        "actions": ((max_seq_len, num_agents), np.uint8 if action_dim <= np.iinfo(np.uint8).max + 1 else np.int64),
+        "rewards": ((max_seq_len, num_agents), np.float32),
+        "terminated": ((max_seq_len, 1), np.float32),
+        "mask": ((max_seq_len, 1), np.float32),
+        "available_actions": ((max_seq_len + 1, num_agents, action_dim), bool),
+        "durations": ((max_seq_len,), np.int16),
+    }
+
+
+# Ring-buffer slots are allocated lazily, doubling from this many.
+_INITIAL_SLOTS = 8
+
+
+def _allocate(fields: Dict[str, tuple], lead: tuple = ()) -> Dict[str, np.ndarray]:
+    return {name: np.zeros(lead + shape, dtype=dtype) for name, (shape, dtype) in fields.items()}
+
+
+def _reset_episode(storage: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Mark every action available and every step one tick long, so padding is benign."""
+    storage["available_actions"][...] = True
+    storage["durations"][...] = 1
+    return storage
+
+
+def _episode_fields(
+    max_seq_len: int,
+    obs_dim: int,
+    state_dim: int,
+    num_agents: int,
+    action_dim: int,
+    obs_dtype: np.dtype,
+    shared_observations: bool = False,
+) -> Dict[str, tuple]:
+    """Shape and dtype of every per-episode array.
+
+    Observations, states and action masks hold ``max_seq_len + 1`` frames:
+    frame ``t + 1`` is the next observation of transition ``t``. With
+    ``shared_observations`` every agent observes the state, which is then
+    the only frame stored.
+    """
+    fields = {
+        "obs": ((max_seq_len + 1, num_agents, obs_dim), obs_dtype),
+        "state": ((max_seq_len + 1, state_dim), obs_dtype),
+        **_transition_fields(max_seq_len, num_agents, action_dim),
+    }
+    if shared_observations:
+        if obs_dim != state_dim:
+            raise ValueError("Shared observations require obs_dim == state_dim")
+        del fields["obs"]
+    return fields
+
+
+def _compact_episode_fields(
+    max_seq_len: int,
+    map_size: Tuple[int, int],
+    num_agents: int,
+    action_dim: int,
+) -> Dict[str, tuple]:
+    height, width = map_size
+    cells = height * width
+    cell_dtype = np.uint16 if cells <= np.iinfo(np.uint16).max else np.uint32
+    position_dtype = np.uint8 if max(height, width) <= np.iinfo(np.uint8).max + 1 else np.uint16
+    return {
+        "obstacle_map": ((height, width), bool),
+        "visit_cells": ((cells,), cell_dtype),
+        "visit_counts": ((max_seq_len + 1,), cell_dtype),
+        "positions": ((max_seq_len + 1, num_agents, 2), position_dtype),
+        "energy": ((max_seq_len + 1, num_agents), np.uint16),
+        **_transition_fields(max_seq_len, num_agents, action_dim),
+    }
+
 
 class EpisodeBatch:
-    """Stores an episode worth of transitions for multi-agent training."""
+    """Stores an episode worth of transitions for multi-agent training.
 
-    def __init__(self, max_seq_len: int, obs_dim: int, state_dim: int, num_agents: int, action_dim: int):
+    With ``storage`` the arrays are views into a :class:`ReplayBuffer` slot,
+    so a rollout writes straight into replay memory. With
+    ``shared_observations`` ``obs`` is a read-only per-agent view of
+    ``state`` and :meth:`insert` ignores its ``obs`` argument.
+    """
+
+    def __init__(
+        self,
+        max_seq_len: int,
+        obs_dim: int,
+        state_dim: int,
+        num_agents: int,
+        action_dim: int,
+        obs_dtype: np.dtype = np.float32,
+        storage: Optional[Dict[str, np.ndarray]] = None,
+        shared_observations: bool = False,
+    ):
         self.max_seq_len = max_seq_len
         self.obs_dim = obs_dim
         self.state_dim = state_dim
         self.num_agents = num_agents
         self.action_dim = action_dim
+        self.shared_observations = shared_observations
 
-        self.obs = np.zeros((max_seq_len + 1, num_agents, obs_dim), dtype=np.float32)
-        self.state = np.zeros((max_seq_len + 1, state_dim), dtype=np.float32)
-        self.actions = np.zeros((max_seq_len, num_agents), dtype=np.int64)
-        self.rewards = np.zeros((max_seq_len, num_agents), dtype=np.float32)
-        self.terminated = np.zeros((max_seq_len, 1), dtype=np.float32)
-        self.mask = np.zeros((max_seq_len, 1), dtype=np.float32)
-        self.available_actions = np.ones((max_seq_len + 1, num_agents, action_dim), dtype=np.float32)
+        fields = _episode_fields(max_seq_len, obs_dim, state_dim, num_agents, action_dim, obs_dtype, shared_observations)
+        if storage is None:
+            storage = _reset_episode(_allocate(fields))
+        self.bind(storage)
         self.ptr = 0
 
+    def bind(self, storage: Dict[str, np.ndarray]) -> None:
+        """Point the episode at ``storage``, e.g. after its replay slot was reallocated."""
+        self.state = storage["state"]
+        if self.shared_observations:
+            self.obs = np.broadcast_to(self.state[:, None, :], (self.max_seq_len + 1, self.num_agents, self.state_dim))
+        else:
+            self.obs = storage["obs"]
+        self.actions = storage["actions"]
+        self.rewards = storage["rewards"]
+        self.terminated = storage["terminated"]
+        self.mask = storage["mask"]
+        self.available_actions = storage["available_actions"]
+        self.durations = storage["durations"]
+
     def insert(
         self,
         t: int,
-        obs: np.ndarray,
+        obs: np.ndarray | None,
         state: np.ndarray,
         actions: np.ndarray,
         rewards: np.ndarray,
         terminated: bool,
         avail_actions: np.ndarray | None = None,
+        duration: int = 1,
     ) -> None:
-        self.obs[t] = obs
+        if not self.shared_observations:
+            self.obs[t] = obs
         self.state[t] = state
         self.actions[t] = actions
         self.rewards[t] = rewards
         self.terminated[t] = float(terminated)
         self.mask[t] = 1.0
+        self.durations[t] = duration
         if avail_actions is not None:
             self.available_actions[t] = avail_actions
         self.ptr = max(self.ptr, t + 1)
 
-    def set_last(self, obs: np.ndarray, state: np.ndarray, avail_actions: np.ndarray | None = None) -> None:
-        self.obs[self.ptr] = obs
+    def set_last(self, obs: np.ndarray | None, state: np.ndarray, avail_actions: np.ndarray | None = None) -> None:
+        if not self.shared_observations:
+            self.obs[self.ptr] = obs
         self.state[self.ptr] = state
         if avail_actions is not None:
             self.available_actions[self.ptr] = avail_actions
 
+    def clear(self) -> None:
+        self.mask[: self.ptr] = 0.0
+        self.ptr = 0
+
+
+class CompactEpisode:
+    """An episode stored as the state that renders its global observations.
+
+    Keeps the obstacle map once, the visited cells as an append-only list of
+    flat indices with a per-frame count, and per-frame UAV positions and
+    energy. Valid only for static obstacles and global observations, where
+    these fully determine every frame.
+    """
+
+    def __init__(
+        self,
+        max_seq_len: int,
+        map_size: Tuple[int, int],
+        num_agents: int,
+        action_dim: int,
+        storage: Optional[Dict[str, np.ndarray]] = None,
+    ):
+        self.max_seq_len = max_seq_len
+        self.map_size = map_size
+        self.num_agents = num_agents
+        self.action_dim = action_dim
+
+        if storage is None:
+            storage = _reset_episode(_allocate(_compact_episode_fields(max_seq_len, map_size, num_agents, action_dim)))
+        self.bind(storage)
+        self._seen = np.zeros(map_size[0] * map_size[1], dtype=bool)
+        self._visits = 0
+        self.ptr = 0
+
+    def bind(self, storage: Dict[str, np.ndarray]) -> None:
+        """Point the episode at ``storage``, e.g. after its replay slot was reallocated."""
+        self.obstacle_map = storage["obstacle_map"]
+        self.visit_cells = storage["visit_cells"]
+        self.visit_counts = storage["visit_counts"]
+        self.positions = storage["positions"]
+        self.energy = storage["energy"]
+        self.actions = storage["actions"]
+        self.rewards = storage["rewards"]
+        self.terminated = storage["terminated"]
+        self.mask = storage["mask"]
+        self.available_actions = storage["available_actions"]
+        self.durations = storage["durations"]
+
+    def set_obstacle_map(self, obstacle_map: np.ndarray) -> None:
+        self.obstacle_map[...] = obstacle_map
+
+    def _record_frame(self, t: int, positions: np.ndarray, energy: np.ndarray) -> None:
+        # A UAV has visited the cell it stands on, so new visits are new positions.
+        cells = positions[:, 0] * self.map_size[1] + positions[:, 1]
+        fresh = np.unique(cells[~self._seen[cells]])
+        self._seen[fresh] = True
+        self.visit_cells[self._visits : self._visits + len(fresh)] = fresh
+        self._visits += len(fresh)
+        self.visit_counts[t] = self._visits
+        self.positions[t] = positions
+        self.energy[t] = energy
+
+    def insert(
+        self,
+        t: int,
+        positions: np.ndarray,
+        energy: np.ndarray,
+        actions: np.ndarray,
+        rewards: np.ndarray,
+        terminated: bool,
+        avail_actions: np.ndarray | None = None,
+        duration: int = 1,
+    ) -> None:
+        """Record frame ``t`` (UAV positions and energy) and transition ``t``."""
+        self._record_frame(t, positions, energy)
+        self.actions[t] = actions
+        self.rewards[t] = rewards
+        self.terminated[t] = float(terminated)
+        self.mask[t] = 1.0
+        self.durations[t] = duration
+        if avail_actions is not None:
+            self.available_actions[t] = avail_actions
+        self.ptr = max(self.ptr, t + 1)
+
+    def set_last(self, positions: np.ndarray, energy: np.ndarray, avail_actions: np.ndarray | None = None) -> None:
+        self._record_frame(self.ptr, positions, energy)
+        if avail_actions is not None:
+            self.available_actions[self.ptr] = avail_actions
+
+    def clear(self) -> None:
+        self.mask[: self.ptr] = 0.0
+        self._seen.fill(False)
+        self._visits = 0
+        self.ptr = 0
+
 
 class ReplayBuffer:
-    def __init__(self, capacity: int) -> None:
+    """Ring buffer of episodes in per-field arrays with per-slot lengths.
+
+    Rollouts write into :meth:`current_episode` and :meth:`push` commits it;
+    the oldest episode is overwritten once the buffer is full. Several
+    rollouts can be in flight at once, one per ``env_id``; each writes into
+    a spare slot that is swapped into the ring when pushed, so storage holds
+    one slot per episode in flight beyond ``capacity``. Slot storage
+    grows by doubling as episodes arrive, so a large ``capacity`` only costs
+    memory once that many episodes have been stored. Sampled
+    batches are gathered with one fancy index per array, truncated to the
+    longest sampled episode. With ``shared_observations`` (global
+    observations, identical for every agent and equal to the state) each
+    frame is stored once and sampled ``obs`` is a broadcast view of it.
+    """
+
+    frame_fields: Tuple[str, ...] = _FRAME_FIELDS
+    episode_fields: Tuple[str, ...] = ()
+
+    def __init__(
+        self,
+        capacity: int,
+        max_seq_len: int,
+        obs_dim: int,
+        state_dim: int,
+        num_agents: int,
+        action_dim: int,
+        obs_dtype: np.dtype = np.uint8,
+        shared_observations: bool = False,
+    ) -> None:
+        self.num_agents = num_agents
+        self.shared_observations = shared_observations
+        self._episode_args = (max_seq_len, obs_dim, state_dim, num_agents, action_dim, obs_dtype)
+        self._init_storage(capacity, max_seq_len, _episode_fields(*self._episode_args, shared_observations))
+
+    def _init_storage(self, capacity: int, max_seq_len: int, fields: Dict[str, tuple]) -> None:
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
         self.capacity = capacity
-        self.buffer: deque[Dict] = deque(maxlen=capacity)
+        self.max_seq_len = max_seq_len
+        self._fields = fields
+        self.storage = _allocate(fields, (0,))
+        self.lengths = np.zeros(0, dtype=np.int64)
+        # Storage slot of each ring position; slots outside the ring are spare.
+        self._ring = np.zeros(capacity, dtype=np.int64)
+        self._spare: List[int] = []
+        self._next = 0
+        self._size = 0
+        self._episodes: Dict[int, Tuple[int, Any]] = {}
+
+    def _new_episode(self, slot: Dict[str, np.ndarray]) -> EpisodeBatch:
+        return EpisodeBatch(*self._episode_args, storage=slot, shared_observations=self.shared_observations)
 
-    def push(self, episode: Dict) -> None:
-        self.buffer.append(episode)
+    @property
+    def nbytes(self) -> int:
+        """Bytes currently allocated for episode storage."""
+        return sum(array.nbytes for array in self.storage.values())
 
-    def sample(self, batch_size: int) -> List[Dict]:
-        indices = np.random.choice(len(self.buffer), batch_size, replace=False)
-        return [self.buffer[i] for i in indices]
+    @property
+    def episode_nbytes(self) -> int:
+        """Bytes one stored episode takes."""
+        return sum(int(np.prod(shape)) * np.dtype(dtype).itemsize for shape, dtype in self._fields.values())
+
+    def _grow(self) -> None:
+        allocated = len(self.storage["mask"])
+        slots = min(self.capacity + len(self._episodes) + 1, max(_INITIAL_SLOTS, 2 * allocated))
+        for name, array in self.storage.items():
+            grown = np.zeros((slots,) + array.shape[1:], dtype=array.dtype)
+            grown[:allocated] = array
+            self.storage[name] = grown
+        self.lengths = np.concatenate([self.lengths, np.zeros(slots - allocated, dtype=np.int64)])
+        self._spare.extend(range(slots - 1, allocated - 1, -1))
+        # Rollouts in flight keep writing into their (copied) slots.
+        for index, episode in self._episodes.values():
+            episode.bind({name: array[index] for name, array in self.storage.items()})
+
+    def current_episode(self, env_id: int = 0):
+        """Return the (cleared) slot the rollout of environment ``env_id`` is written to."""
+        if env_id not in self._episodes:
+            if not self._spare:
+                self._grow()
+            index = self._spare.pop()
+            slot = _reset_episode({name: array[index] for name, array in self.storage.items()})
+            episode = self._new_episode(slot)
+            episode.ptr = int(self.lengths[index])
+            episode.clear()
+            self._episodes[env_id] = (index, episode)
+        return self._episodes[env_id][1]
+
+    def push(self, episode) -> None:
+        """Commit ``episode``; episodes not obtained from :meth:`current_episode` are copied in."""
+        if episode.ptr == 0:
+            raise ValueError("Cannot push an empty episode")
+        env_id = next((key for key, (_, current) in self._episodes.items() if current is episode), None)
+        if env_id is None:
+            # Copied through a slot of its own, so no rollout in flight is disturbed.
+            env_id = min(self._episodes, default=0) - 1
+            self.current_episode(env_id)
+        index, slot = self._episodes.pop(env_id)
+        if episode is not slot:
+            for name, array in self.storage.items():
+                if name in self.episode_fields:
+                    array[index] = getattr(episode, name)
+                    continue
+                frames = episode.ptr + 1 if name in self.frame_fields else episode.ptr
+                array[index, :frames] = getattr(episode, name)[:frames]
+        self.lengths[index] = episode.ptr
+        if self._size == self.capacity:
+            # The oldest episode's slot becomes spare.
+            self._spare.append(int(self._ring[self._next]))
+        self._ring[self._next] = index
+        self._next = (self._next + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+
+    def sample(self, batch_size: int, length_buckets: int = 1) -> Dict[str, np.ndarray]:
+        """Sample whole episodes, padded to the longest one in the batch.
+
+        With ``length_buckets > 1``, ``length_buckets * batch_size`` episodes
+        are drawn, sorted by length and cut into that many buckets, and one
+        bucket is returned. Every stored episode stays equally likely to be
+        sampled, but batch members have similar lengths, so little of the
+        unroll is spent on padding.
+        """
+        if length_buckets < 1:
+            raise ValueError("length_buckets must be positive")
+        buckets = max(1, min(length_buckets, self._size // batch_size))
+        indices = self._ring[np.random.choice(self._size, batch_size * buckets, replace=False)]
+        if buckets > 1:
+            indices = indices[np.argsort(self.lengths[indices], kind="stable")]
+            bucket = np.random.randint(buckets)
+            indices = indices[bucket * batch_size:(bucket + 1) * batch_size]
+        lengths = self.lengths[indices]
+        steps = int(lengths.max())
+        batch = {}
+        for name, array in self.storage.items():
+            if name in self.episode_fields:
+                batch[name] = array[indices]
+            else:
+                frames = steps + 1 if name in self.frame_fields else steps
+                batch[name] = array[indices, :frames]
+        batch["lengths"] = lengths
+        return self._finish_batch(batch, indices)
+
+    def sample_sequences(self, batch_size: int, length: int, burn_in: int = 0) -> Dict[str, np.ndarray]:
+        """Sample fixed-length chunks of ``burn_in + length`` transitions.
+
+        Each chunk's training part starts uniformly in
+        ``[0, max(episode_length - length, 0)]`` and is preceded by up to
+        ``burn_in`` earlier steps for warming up the recurrent state. Burn-in
+        steps before the episode start are flagged False in ``"started"``;
+        ``"mask"`` covers only the training part within the episode.
+        """
+        if length < 1 or burn_in < 0:
+            raise ValueError("length must be positive and burn_in non-negative")
+        indices = self._ring[np.random.choice(self._size, batch_size, replace=False)]
+        lengths = self.lengths[indices]
+        starts = np.random.randint(np.maximum(lengths - length, 0) + 1)
+        times = starts[:, None] - burn_in + np.arange(burn_in + length)
+        # Out-of-episode times are clamped to valid rows; they are masked or reset.
+        step_rows = np.clip(times, 0, self.max_seq_len - 1)
+        frame_rows = np.clip(np.concatenate([times, times[:, -1:] + 1], axis=1), 0, self.max_seq_len)
+        slots = indices[:, None]
+        batch = {}
+        for name, array in self.storage.items():
+            if name in self.episode_fields:
+                batch[name] = array[indices]
+            else:
+                batch[name] = array[slots, frame_rows if name in self.frame_fields else step_rows]
+        batch["mask"] = ((times >= starts[:, None]) & (times < lengths[:, None])).astype(np.float32)[..., None]
+        batch["started"] = times >= 0
+        batch["burn_in"] = burn_in
+        batch["lengths"] = lengths
+        return self._finish_batch(batch, indices)
+
+    def _finish_batch(self, batch: Dict[str, np.ndarray], indices: np.ndarray) -> Dict[str, np.ndarray]:
+        if self.shared_observations:
+            state = batch["state"]
+            batch["obs"] = np.broadcast_to(state[:, :, None, :], state.shape[:2] + (self.num_agents, state.shape[2]))
+        return batch
 
     def __len__(self) -> int:
-        return len(self.buffer)
+        return self._size
+
+
+class CompactReplayBuffer(ReplayBuffer):
+    """Replay of :class:`CompactEpisode` records, rendered when sampled.
+
+    ``render_states(visited, obstacles, positions, energy)`` turns
+    (batch, frames, H, W) visited masks and the matching obstacle maps,
+    positions and energy into (batch, frames, state_dim) global states, as
+    ``GridWorldEnv.render_global_states`` does. Sampled batches have the
+    same keys as :class:`ReplayBuffer` with shared observations.
+    """
+
+    frame_fields = _COMPACT_FRAME_FIELDS
+    episode_fields = _COMPACT_EPISODE_FIELDS
+
+    def __init__(
+        self,
+        capacity: int,
+        max_seq_len: int,
+        map_size: Tuple[int, int],
+        num_agents: int,
+        action_dim: int,
+        energy_budget: int,
+        render_states: Callable[..., np.ndarray],
+    ) -> None:
+        if energy_budget > np.iinfo(np.uint16).max:
+            raise ValueError("Compact replay stores energy as uint16; energy_budget is too large")
+        self.num_agents = num_agents
+        self.shared_observations = True
+        self.map_size = tuple(map_size)
+        self.render_states = render_states
+        self._episode_args = (max_seq_len, self.map_size, num_agents, action_dim)
+        self._init_storage(capacity, max_seq_len, _compact_episode_fields(*self._episode_args))
+
+    def _new_episode(self, slot: Dict[str, np.ndarray]) -> CompactEpisode:
+        return CompactEpisode(*self._episode_args, storage=slot)
+
+    def _finish_batch(self, batch: Dict[str, np.ndarray], indices: np.ndarray) -> Dict[str, np.ndarray]:
+        height, width = self.map_size
+        order = batch.pop("visit_cells")
+        counts = batch.pop("visit_counts")
+        batch_size, frames = counts.shape
+        # Visit rank of every cell; cell c is visited in frame f iff rank < count[f].
+        total = self.storage["visit_counts"][indices, self.lengths[indices]]
+        rows, ranks = np.nonzero(np.arange(order.shape[1]) < total[:, None])
+        rank = np.full((batch_size, height * width), height * width, dtype=order.dtype)
+        rank[rows, order[rows, ranks]] = ranks
+        visited = (rank[:, None, :] < counts[:, :, None]).reshape(batch_size, frames, height, width)
+        batch["state"] = self.render_states(
+            visited,
+            batch.pop("obstacle_map")[:, None],
+            batch.pop("positions"),
+            batch.pop("energy"),
+        )
+        return super()._finish_batch(batch, indices)
+
+
@@ -2,22 +2,22 @@
 from __future__ import annotations
 
 import argparse
-import random
 import time
 from copy import deepcopy
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
+from typing import Dict, Iterator, List, Tuple, Optional
 
 import numpy as np
 import torch
 from torch import nn
 from torch.optim import RMSprop
 
-from src.algos.qmix.agent_net import AgentNetwork
-from src.algos.qmix.buffer import ReplayBuffer
+from src.algos.qmix.agent_net import BatchedAgentNetwork, Fc1Accumulator, SharedTrunkAgentNetwork
+from src.algos.qmix.buffer import CompactEpisode, CompactReplayBuffer, ReplayBuffer
 from src.algos.qmix.mixer_net import MixingNetwork
 from src.metrics.metrics import EpisodeStats, aggregate_episode_stats
 from src.envs.grid_world import GridWorldEnv
+from src.envs.vector_env import BatchedGridWorldEnv
 from src.utils.config import load_config
 from src.utils.logging import setup_logger
 from src.utils.schedule import EpsilonSchedule, Plateau
@@ -35,11 +35,26 @@ def ensure_tuple_map_size(map_size_entry) -> Tuple[int, int]:
     return value, value
 
 
-def build_agents(num_agents: int, obs_dim: int, action_dim: int, hidden_dim: int, device: torch.device) -> Tuple[List[AgentNetwork], List[AgentNetwork]]:
-    agents = [AgentNetwork(obs_dim, action_dim, hidden_dim).to(device) for _ in range(num_agents)]
-    target_agents = [AgentNetwork(obs_dim, action_dim, hidden_dim).to(device) for _ in range(num_agents)]
-    for agent, target in zip(agents, target_agents):
-        target.load_state_dict(agent.state_dict())
+AGENT_LAYOUTS = {
+    BatchedAgentNetwork.LAYOUT: BatchedAgentNetwork,
+    SharedTrunkAgentNetwork.LAYOUT: SharedTrunkAgentNetwork,
+}
+
+
+def build_agents(
+    num_agents: int,
+    obs_dim: int,
+    action_dim: int,
+    hidden_dim: int,
+    device: torch.device,
+    layout: str = BatchedAgentNetwork.LAYOUT,
+) -> Tuple[BatchedAgentNetwork, BatchedAgentNetwork]:
+    if layout not in AGENT_LAYOUTS:
+        raise ValueError(f"Unknown agent_layout {layout!r}; expected one of {sorted(AGENT_LAYOUTS)}")
+    network_cls = AGENT_LAYOUTS[layout]
+    agents = network_cls(num_agents, obs_dim, action_dim, hidden_dim).to(device)
+    target_agents = network_cls(num_agents, obs_dim, action_dim, hidden_dim).to(device)
+    target_agents.load_state_dict(agents.state_dict())
     return agents, target_agents
 
 
@@ -57,121 +72,454 @@ def _decode_observations(data: np.ndarray, device: torch.device) -> torch.Tensor
     return tensor
 
 
+def _encode_observations(frames: np.ndarray) -> np.ndarray:
+    """Return observations as uint8, quantising float observations to [0, 255]."""
+    array = np.asarray(frames)
+    if array.dtype == np.uint8:
+        return array
+    return np.clip(np.rint(array.astype(np.float32) * 255.0), 0, 255).astype(np.uint8)
+
+
+def _agent_observations(obs: np.ndarray, num_agents: int) -> np.ndarray:
+    """Per-agent observation rows: local observations as-is, a global one tiled."""
+    if obs.ndim == 2:
+        return obs.copy()
+    return np.tile(obs, (num_agents, 1))
+
+
+def _replay_frame(
+    episode, positions: np.ndarray, energy: np.ndarray, agent_obs: np.ndarray, state: np.ndarray
+) -> Tuple:
+    """Frame arguments of ``episode.insert``/``set_last`` for the current step."""
+    if isinstance(episode, CompactEpisode):
+        return positions.copy(), energy.copy()
+    obs_frame = None if episode.shared_observations else _encode_observations(agent_obs)
+    return obs_frame, _encode_observations(state)
+
 
 def select_actions(
-    agents: List[AgentNetwork],
+    agents: BatchedAgentNetwork,
     obs: np.ndarray,
     hidden_states: torch.Tensor,
     epsilon: float,
     device: torch.device,
+    avail_actions: Optional[np.ndarray] = None,
+    accumulator: Optional[Fc1Accumulator] = None,
 ) -> Tuple[np.ndarray, torch.Tensor]:
-    """Epsilon-greedy action selection for all agents."""
+    """Epsilon-greedy action selection for all agents.
+
+    ``hidden_states`` is (agents, batch, hidden). ``avail_actions`` is an
+    optional (batch, agents, actions) mask; masked actions are never chosen,
+    greedily or at random. Every (batch row, agent) pair explores on its own
+    draw. With an ``accumulator``, fc1 is updated incrementally from the
+    previous call's observations.
+    """
     batch_size = obs.shape[0]
-    num_agents = len(agents)
-    action_dim = agents[0].fc2.out_features
-
-    obs_tensor = torch.tensor(obs, dtype=torch.float32, device=device)
-    actions = np.zeros((batch_size, num_agents), dtype=np.int64)
-    new_hidden_states = torch.zeros_like(hidden_states)
-
-    for agent_idx, agent in enumerate(agents):
-        agent_obs = obs_tensor[:, agent_idx, :]
-        hidden = hidden_states[agent_idx]
-        q_values, hidden_new = agent(agent_obs, hidden)
-        new_hidden_states[agent_idx] = hidden_new
-
-        if random.random() < epsilon:
-            random_actions = np.random.randint(action_dim, size=batch_size)
-            actions[:, agent_idx] = random_actions
+    num_agents = agents.num_agents
+    action_dim = agents.action_dim
+
+    obs_tensor = _decode_observations(obs, device).transpose(0, 1)
+    with torch.no_grad():
+        if accumulator is not None:
+            q_values, new_hidden_states = agents.forward_preactivated(accumulator.update(obs_tensor), hidden_states)
         else:
-            actions[:, agent_idx] = q_values.argmax(dim=1).cpu().numpy()
+            q_values, new_hidden_states = agents(obs_tensor, hidden_states)
+    if avail_actions is not None:
+        mask = torch.as_tensor(avail_actions, dtype=torch.bool, device=device).transpose(0, 1)
+        q_values = q_values.masked_fill(~mask, -1e9)
+    actions = q_values.argmax(dim=2).T.cpu().numpy()
+
+    explore = np.random.random((batch_size, num_agents)) < epsilon
+    if explore.any():
+        if avail_actions is not None:
+            # Largest random key among the available actions: a uniform valid choice.
+            random_actions = np.argmax(np.random.random(avail_actions.shape) * avail_actions, axis=2)
+        else:
+            random_actions = np.random.randint(action_dim, size=(batch_size, num_agents))
+        actions[explore] = random_actions[explore]
 
     return actions, new_hidden_states
 
 
-def compute_td_loss(
-    batch: List[Dict],
-    agents: List[AgentNetwork],
-    target_agents: List[AgentNetwork],
-    mixer: MixingNetwork,
-    target_mixer: MixingNetwork,
-    gamma: float,
+def _run_episodes(
+    env: GridWorldEnv,
+    agents: BatchedAgentNetwork,
+    replay_buffer: ReplayBuffer,
+    epsilon_schedule: EpsilonSchedule,
     device: torch.device,
-) -> torch.Tensor:
-    batch_size = len(batch)
-    episode_len = max(item["filled_steps"] for item in batch)
-    num_agents = len(agents)
-    obs_dim = agents[0].fc1.in_features
-    state_dim = batch[0]["state"].shape[-1]
-
-    obs = torch.zeros(batch_size, episode_len, num_agents, obs_dim, device=device)
-    next_obs = torch.zeros_like(obs)
-    state = torch.zeros(batch_size, episode_len, state_dim, device=device)
-    next_state = torch.zeros_like(state)
-    actions = torch.zeros(batch_size, episode_len, num_agents, device=device, dtype=torch.long)
-    rewards = torch.zeros(batch_size, episode_len, num_agents, device=device)
-    terminated = torch.zeros(batch_size, episode_len, 1, device=device)
-    mask = torch.zeros(batch_size, episode_len, 1, device=device)
-
-    for idx, episode in enumerate(batch):
-        T = episode["filled_steps"]
-        obs[idx, :T] = _decode_observations(episode["obs"][:T], device)
-        next_obs[idx, :T] = _decode_observations(episode["next_obs"][:T], device)
-        state[idx, :T] = _decode_observations(episode["state"][:T], device)
-        next_state[idx, :T] = _decode_observations(episode["next_state"][:T], device)
-        actions[idx, :T] = torch.tensor(episode["actions"][:T], dtype=torch.long, device=device)
-        rewards[idx, :T] = torch.tensor(episode["rewards"][:T], dtype=torch.float32, device=device)
-        terminated[idx, :T, 0] = torch.tensor(episode["terminated"][:T], dtype=torch.float32, device=device)
-        mask[idx, :T, 0] = 1.0
-
-    hidden_dim = agents[0].rnn.hidden_size
-    hidden = torch.zeros(num_agents, batch_size, hidden_dim, device=device)
-    target_hidden = torch.zeros_like(hidden)
+    action_masking: bool,
+    accumulator: Optional[Fc1Accumulator],
+) -> Iterator[EpisodeStats]:
+    """Roll out episodes one after another, writing each straight into replay.
+
+    Every finished episode is pushed to ``replay_buffer`` and its stats are
+    yielded; the caller trains between episodes.
+    """
+    num_uavs = env.num_uavs
+    episode = 0
+    while True:
+        episode += 1
+        obs, info = env.reset()
+        episode_stats = EpisodeStats(
+            start_time=time.time(),
+            total_cells=info.get("coverage_total", env.total_cells),
+            per_uav_new_cells=[0 for _ in range(num_uavs)],
+        )
 
-    loss = 0.0
-    mask_sum = mask.sum()
+        # Steps are written straight into the replay slot this episode will occupy.
+        episode_batch = replay_buffer.current_episode()
+        if isinstance(episode_batch, CompactEpisode):
+            episode_batch.set_obstacle_map(env.obstacle_manager.get_obstacle_view())
+        step_idx = 0
 
-    for t in range(episode_len):
-        step_mask = mask[:, t]
-        if step_mask.sum() == 0:
-            continue
+        state = env.global_state()
+        hidden_states = agents.init_hidden(1, device)
+        if accumulator is not None:
+            # Weights change between episodes, so start from a full recompute.
+            accumulator.reset()
+
+        done = False
+        truncated = False
+
+        while not (done or truncated):
+            epsilon = epsilon_schedule.get(episode)
+            agent_obs = _agent_observations(obs, num_uavs).reshape(1, num_uavs, -1)
+            avail_actions = info["avail_actions"][None] if action_masking else None
+            actions, hidden_states = select_actions(
+                agents,
+                agent_obs,
+                hidden_states,
+                epsilon,
+                device,
+                avail_actions=avail_actions,
+                accumulator=accumulator,
+            )
+            actions = actions[0]
+            frame = _replay_frame(episode_batch, env.uav_positions, env.uav_energy, agent_obs[0], state)
 
-        q_values_agents = []
-        target_q_values_agents = []
+            next_obs, rewards, done_flag, truncated_flag, step_info = env.step(actions)
+            done = done_flag
+            truncated = truncated_flag
 
-        step_obs = obs[:, t]
-        step_next_obs = next_obs[:, t]
-        step_actions = actions[:, t]
+            primitive_steps = step_info.get("primitive_steps", 1)
+            episode_batch.insert(
+                step_idx,
+                *frame,
+                actions,
+                rewards,
+                done or truncated,
+                avail_actions=avail_actions[0] if action_masking else None,
+                duration=primitive_steps,
+            )
+            step_idx += 1
+            next_state = env.global_state()
 
-        for agent_idx, agent in enumerate(agents):
-            agent_obs = step_obs[:, agent_idx, :]
-            agent_hidden = hidden[agent_idx]
-            q, hidden_new = agent(agent_obs, agent_hidden)
-            hidden[agent_idx] = hidden_new
-            chosen = q.gather(1, step_actions[:, agent_idx].unsqueeze(-1)).squeeze(-1)
-            q_values_agents.append(chosen)
+            episode_stats.steps += primitive_steps
+            episode_stats.total_actions += num_uavs
+            episode_stats.energy_consumed += num_uavs * primitive_steps
+            episode_stats.collisions += step_info.get("collisions", 0)
+            episode_stats.obstacle_hits += step_info.get("obstacle_hits", 0)
+            episode_stats.visited_cells = step_info.get("visited_count", episode_stats.visited_cells)
+
+            for idx, reward_value in enumerate(rewards):
+                if reward_value >= env.reward_new_cell_base * 0.8:
+                    episode_stats.new_cell_actions += 1
+                    episode_stats.per_uav_new_cells[idx] += 1
+
+            state = next_state
+            obs = next_obs
+            info = step_info
+
+        episode_stats.end_time = time.time()
+        episode_stats.success = bool(done and step_info.get("coverage", 0.0) >= 0.99)
+
+        episode_batch.set_last(
+            *_replay_frame(episode_batch, env.uav_positions, env.uav_energy, obs, state),
+            avail_actions=info["avail_actions"] if action_masking else None,
+        )
+        replay_buffer.push(episode_batch)
+        yield episode_stats
+
+
+def _run_batched_episodes(
+    env: BatchedGridWorldEnv,
+    agents: BatchedAgentNetwork,
+    replay_buffer: ReplayBuffer,
+    epsilon_schedule: EpsilonSchedule,
+    device: torch.device,
+    action_masking: bool,
+    accumulator: Optional[Fc1Accumulator],
+) -> Iterator[EpisodeStats]:
+    """:func:`_run_episodes` over every environment of ``env`` at once.
+
+    Each step runs one (agents, num_envs, obs) forward pass. Environment
+    ``i`` writes into ``replay_buffer.current_episode(i)``; episodes are
+    pushed and yielded in the order they finish, and the epsilon of a step
+    is that of the next episode to finish.
+    """
+    num_envs, num_uavs = env.num_envs, env.num_uavs
+    obs, info = env.reset()
+    hidden_states = agents.init_hidden(num_envs, device)
+    episode_batches = [replay_buffer.current_episode(env_id) for env_id in range(num_envs)]
+    running = []
+    for env_id, episode_batch in enumerate(episode_batches):
+        if isinstance(episode_batch, CompactEpisode):
+            episode_batch.set_obstacle_map(env.obstacle_maps[env_id])
+        running.append(
+            EpisodeStats(
+                start_time=time.time(),
+                total_cells=int(env.coverage_total[env_id]),
+                per_uav_new_cells=[0 for _ in range(num_uavs)],
+            )
+        )
+    step_idx = np.zeros(num_envs, dtype=int)
+    finished = 0
+
+    while True:
+        epsilon = epsilon_schedule.get(finished + 1)
+        # Global observations: every agent sees its environment's state.
+        agent_obs = np.broadcast_to(obs[:, None], (num_envs, num_uavs, obs.shape[1]))
+        avail_actions = info["avail_actions"] if action_masking else None
+        actions, hidden_states = select_actions(
+            agents,
+            agent_obs,
+            hidden_states,
+            epsilon,
+            device,
+            avail_actions=avail_actions,
+            accumulator=accumulator,
+        )
+        frames = [
+            _replay_frame(episode_batch, env.uav_positions[env_id], env.uav_energy[env_id], None, obs[env_id])
+            for env_id, episode_batch in enumerate(episode_batches)
+        ]
+
+        next_obs, rewards, terminated, truncated, step_info = env.step(actions)
+        done = terminated | truncated
+
+        for env_id, episode_batch in enumerate(episode_batches):
+            episode_batch.insert(
+                int(step_idx[env_id]),
+                *frames[env_id],
+                actions[env_id],
+                rewards[env_id],
+                bool(done[env_id]),
+                avail_actions=avail_actions[env_id] if action_masking else None,
+            )
+            episode_stats = running[env_id]
+            episode_stats.steps += 1
+            episode_stats.total_actions += num_uavs
+            episode_stats.energy_consumed += num_uavs
+            episode_stats.collisions += int(step_info["collisions"][env_id])
+            episode_stats.obstacle_hits += int(step_info["obstacle_hits"][env_id])
+            episode_stats.visited_cells = int(step_info["visited_count"][env_id])
+            for idx, reward_value in enumerate(rewards[env_id]):
+                if reward_value >= env.reward_new_cell_base * 0.8:
+                    episode_stats.new_cell_actions += 1
+                    episode_stats.per_uav_new_cells[idx] += 1
+        step_idx += 1
+
+        for env_id in np.flatnonzero(done):
+            episode_stats = running[env_id]
+            episode_stats.end_time = time.time()
+            episode_stats.success = bool(terminated[env_id] and step_info["coverage"][env_id] >= 0.99)
+            # The environment already restarted; ``step_info`` still describes the finished episode.
+            episode_batch = episode_batches[env_id]
+            episode_batch.set_last(
+                *_replay_frame(
+                    episode_batch,
+                    step_info["uav_positions"][env_id],
+                    step_info["energy"][env_id],
+                    None,
+                    step_info["final_observation"][env_id],
+                ),
+                avail_actions=step_info["final_avail_actions"][env_id] if action_masking else None,
+            )
+            replay_buffer.push(episode_batch)
+            finished += 1
+            yield episode_stats
+
+            episode_batch = episode_batches[env_id] = replay_buffer.current_episode(env_id)
+            if isinstance(episode_batch, CompactEpisode):
+                episode_batch.set_obstacle_map(env.obstacle_maps[env_id])
+            running[env_id] = EpisodeStats(
+                start_time=time.time(),
+                total_cells=int(env.coverage_total[env_id]),
+                per_uav_new_cells=[0 for _ in range(num_uavs)],
+            )
+            step_idx[env_id] = 0
+
+        if done.any():
+            hidden_states[:, torch.as_tensor(done, device=device)] = 0.0
+            if accumulator is not None:
+                # The caller may have trained in between, so start from a full recompute.
+                accumulator.reset()
+        obs, info = next_obs, step_info
+
+
+def _decode_frames(batch: Dict[str, np.ndarray], start: int, stop: int, device: torch.device) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Float observations (batch, frames, agents, obs_dim) and states for frames ``start:stop``.
+
+    Only the requested frames are dequantised, so long batches can be
+    streamed through the learner one time chunk at a time.
+    """
+    num_agents = batch["actions"].shape[2]
+    states = _decode_observations(batch["state"][:, start:stop], device)
+    obs = batch["obs"]
+    if obs.strides[2] == 0:
+        # Shared global observations: decode the one stored frame and broadcast it to every agent.
+        frames = _decode_observations(obs[:, start:stop, 0], device).unsqueeze(2).expand(-1, -1, num_agents, -1)
+    else:
+        frames = _decode_observations(obs[:, start:stop], device)
+    return frames, states
+
+
+def _burn_in(
+    batch: Dict[str, np.ndarray],
+    agents: BatchedAgentNetwork,
+    target_agents: BatchedAgentNetwork,
+    device: torch.device,
+    chunk_length: int,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Online and target hidden states after the batch's ``burn_in`` leading steps.
+
+    Computed without gradient, ``chunk_length`` frames at a time. Steps where
+    ``started`` is False precede the episode start and keep the state at zero.
+    """
+    batch_size = batch["actions"].shape[0]
+    hidden = agents.init_hidden(batch_size, device)
+    target_hidden = target_agents.init_hidden(batch_size, device)
+    burn_in = int(batch.get("burn_in", 0))
+    with torch.no_grad():
+        for start in range(0, burn_in, chunk_length):
+            stop = min(start + chunk_length, burn_in)
+            frames, _ = _decode_frames(batch, start, stop + 1, device)
+            started = torch.as_tensor(batch["started"][:, start:stop], device=device)
+            for t in range(stop - start):
+                keep = started[:, t].view(1, -1, 1)
+                _, hidden = agents(frames[:, t].transpose(0, 1), hidden)
+                _, target_hidden = target_agents(frames[:, t + 1].transpose(0, 1), target_hidden)
+                hidden = hidden * keep
+                target_hidden = target_hidden * keep
+    return hidden, target_hidden
+
+
+def _td_error_sum(
+    batch: Dict[str, np.ndarray],
+    start: int,
+    stop: int,
+    hidden: torch.Tensor,
+    target_hidden: torch.Tensor,
+    agents: BatchedAgentNetwork,
+    target_agents: BatchedAgentNetwork,
+    mixer: MixingNetwork,
+    target_mixer: MixingNetwork,
+    gamma: float,
+    device: torch.device,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Masked squared TD error summed over transitions ``start:stop``.
+
+    The agents unroll from ``hidden``/``target_hidden``; their hidden states
+    after the last step are returned alongside the sum. The target side is
+    evaluated without gradient.
+    """
+    batch_size = batch["actions"].shape[0]
+    num_agents = agents.num_agents
+    steps = stop - start
+
+    frames, state_frames = _decode_frames(batch, start, stop + 1, device)
+    obs, next_obs = frames[:, :-1], frames[:, 1:]
+    state, next_state = state_frames[:, :-1], state_frames[:, 1:]
+    actions = torch.as_tensor(batch["actions"][:, start:stop], device=device).long()
+    rewards = torch.as_tensor(batch["rewards"][:, start:stop], device=device)
+    terminated = torch.as_tensor(batch["terminated"][:, start:stop], device=device)
+    mask = torch.as_tensor(batch["mask"][:, start:stop], device=device)
+    next_avail = torch.as_tensor(batch["available_actions"][:, start + 1:stop + 1], device=device)
+    # Macro-action transitions span several primitive steps and discount by gamma ** steps.
+    durations = torch.as_tensor(batch["durations"][:, start:stop], dtype=torch.float32, device=device)
+    discount = gamma ** durations
+
+    # Whole (batch, time) block per network call, laid out (agents, batch, time, ...).
+    q, hidden = agents.unroll(obs.permute(2, 0, 1, 3), hidden)
+    agent_qs = q.gather(3, actions.permute(2, 0, 1).unsqueeze(-1)).squeeze(-1)
+
+    # Mix all B*T steps at once; padded steps are zeroed by the mask.
+    flat_steps = batch_size * steps
+    q_tot = mixer(agent_qs.permute(1, 2, 0).reshape(flat_steps, num_agents), state.reshape(flat_steps, -1))
+
+    with torch.no_grad():
+        target_q, target_hidden = target_agents.unroll(next_obs.permute(2, 0, 1, 3), target_hidden)
+        target_q = target_q.masked_fill(~next_avail.permute(2, 0, 1, 3), -1e9)
+        target_agent_qs = target_q.max(dim=3).values
+        target_q_tot = target_mixer(
+            target_agent_qs.permute(1, 2, 0).reshape(flat_steps, num_agents),
+            next_state.reshape(flat_steps, -1),
+        )
 
-            target_agent = target_agents[agent_idx]
-            target_obs = step_next_obs[:, agent_idx, :]
-            target_hidden_agent = target_hidden[agent_idx]
-            target_q, target_hidden_new = target_agent(target_obs, target_hidden_agent)
-            target_hidden[agent_idx] = target_hidden_new
-            target_q_max = target_q.max(dim=1).values
-            target_q_values_agents.append(target_q_max)
+    reward_total = rewards.sum(dim=2).reshape(flat_steps, 1)
+    not_done = 1 - terminated.reshape(flat_steps, 1)
+    target = reward_total + discount.reshape(flat_steps, 1) * not_done * target_q_tot
 
-        agent_qs = torch.stack(q_values_agents, dim=1)
-        target_agent_qs = torch.stack(target_q_values_agents, dim=1)
+    td_error = (q_tot - target) * mask.reshape(flat_steps, 1)
+    return (td_error ** 2).sum(), hidden, target_hidden
 
-        q_tot = mixer(agent_qs, state[:, t])
-        target_q_tot = target_mixer(target_agent_qs, next_state[:, t])
 
-        reward_total = rewards[:, t].sum(dim=1, keepdim=True)
-        target = reward_total + gamma * (1 - terminated[:, t]) * target_q_tot
+def compute_td_loss(
+    batch: Dict[str, np.ndarray],
+    agents: BatchedAgentNetwork,
+    target_agents: BatchedAgentNetwork,
+    mixer: MixingNetwork,
+    target_mixer: MixingNetwork,
+    gamma: float,
+    device: torch.device,
+) -> torch.Tensor:
+    """Masked QMIX TD loss over a batch sampled from :class:`ReplayBuffer`.
+
+    Batches from ``sample_sequences`` carry ``burn_in`` leading steps that
+    only warm up the agents' hidden states and are excluded from the loss.
+    """
+    episode_len = batch["actions"].shape[1]
+    burn_in = int(batch.get("burn_in", 0))
+    hidden, target_hidden = _burn_in(batch, agents, target_agents, device, max(burn_in, 1))
+    td_sum, _, _ = _td_error_sum(
+        batch, burn_in, episode_len, hidden, target_hidden,
+        agents, target_agents, mixer, target_mixer, gamma, device,
+    )
+    return td_sum / float(batch["mask"][:, burn_in:].sum())
 
-        td_error = (q_tot - target) * step_mask
-        loss = loss + (td_error ** 2).sum()
 
-    loss = loss / mask_sum
+def backward_td_loss(
+    batch: Dict[str, np.ndarray],
+    agents: BatchedAgentNetwork,
+    target_agents: BatchedAgentNetwork,
+    mixer: MixingNetwork,
+    target_mixer: MixingNetwork,
+    gamma: float,
+    device: torch.device,
+    chunk_length: int,
+) -> float:
+    """Backpropagate the :func:`compute_td_loss` loss ``chunk_length`` steps at a time.
+
+    Each chunk is dequantised from the stored uint8 frames, unrolled from the
+    previous chunk's detached hidden state (truncated BPTT) and backpropagated
+    before the next one is decoded, so peak memory grows with the chunk, not
+    the sequence. Gradients accumulate into the parameters; returns the loss.
+    """
+    episode_len = batch["actions"].shape[1]
+    burn_in = int(batch.get("burn_in", 0))
+    mask_total = float(batch["mask"][:, burn_in:].sum())
+    hidden, target_hidden = _burn_in(batch, agents, target_agents, device, chunk_length)
+    loss = 0.0
+    for start in range(burn_in, episode_len, chunk_length):
+        stop = min(start + chunk_length, episode_len)
+        td_sum, hidden, target_hidden = _td_error_sum(
+            batch, start, stop, hidden, target_hidden,
+            agents, target_agents, mixer, target_mixer, gamma, device,
+        )
+        chunk_loss = td_sum / mask_total
+        chunk_loss.backward()
+        loss += chunk_loss.item()
+        hidden = hidden.detach()
     return loss
 
 
@@ -219,7 +567,11 @@ def train_single_setting(
         final_obstacle_shaping_weight = 0.0
         logger.info("消融实验：势能奖励已关闭")
     
-    env = GridWorldEnv(
+    # Several environments stepped together, one agent forward per step for all of them.
+    num_envs = int(algo_cfg.get("num_envs", 1))
+    if num_envs < 1:
+        raise ValueError("num_envs must be positive")
+    env_kwargs = dict(
         map_size=map_size,
         num_uavs=num_uavs,
         obstacle_density=obstacle_density,
@@ -228,18 +580,38 @@ def train_single_setting(
         energy_budget=env_cfg.get("energy_budget", 2400),
         shaping_weight=shaping_weight,
         obstacle_shaping_weight=final_obstacle_shaping_weight,
-        seed=env_cfg.get("seed"),
+        observation_dtype=env_cfg.get("observation_dtype", "float32"),
+        map_backend=env_cfg.get("map_backend", "dense"),
+        motion_model=env_cfg.get("motion_model", "random_walk"),
+        dynamic_fraction=env_cfg.get("dynamic_fraction", 0.1),
+        move_probability=env_cfg.get("move_probability", 0.5),
+        scenario_bank=env_cfg.get("scenario_bank"),
+        coverage_cells=env_cfg.get("coverage_cells", "reachable"),
+        action_mode=env_cfg.get("action_mode", "primitive"),
+        max_macro_steps=env_cfg.get("max_macro_steps"),
+        observation_mode=env_cfg.get("observation_mode", "global"),
+        local_view_size=env_cfg.get("local_view_size", 7),
     )
+    if num_envs > 1:
+        env = BatchedGridWorldEnv(num_envs, seed=env_cfg.get("seed"), **env_kwargs)
+        template = env.envs[0]
+    else:
+        env = GridWorldEnv(seed=env_cfg.get("seed"), reuse_observation_buffer=True, **env_kwargs)
+        template = env
 
-    obs_dim = int(env.observation_space.shape[0])
-    state_dim = obs_dim
-    action_dim = int(env.action_space.nvec[0])
+    obs_dim = int(template.observation_space.shape[-1])
+    state_dim = template.state_dim
+    action_dim = int(template.action_space.nvec[0])
 
     hidden_dim = algo_cfg.get("agent_hidden_dim", 64)
     mixing_hidden_dim = algo_cfg.get("mixing_hidden_dim", 32)
     hyper_hidden_dim = algo_cfg.get("hyper_hidden_dim", 64)
 
-    agents, target_agents = build_agents(num_uavs, obs_dim, action_dim, hidden_dim, device)
+    # "shared_trunk" encodes the common global observation once for all agents.
+    agent_layout = algo_cfg.get("agent_layout", BatchedAgentNetwork.LAYOUT)
+    if agent_layout == SharedTrunkAgentNetwork.LAYOUT and template.observation_mode != "global":
+        raise ValueError("agent_layout 'shared_trunk' requires global observations")
+    agents, target_agents = build_agents(num_uavs, obs_dim, action_dim, hidden_dim, device, agent_layout)
     mixer, target_mixer = build_mixer(num_uavs, state_dim, mixing_hidden_dim, hyper_hidden_dim, device)
 
     if init_checkpoint:
@@ -248,36 +620,90 @@ def train_single_setting(
             logger.info("Loading initial checkpoint from %s", ckpt_path)
             checkpoint = torch.load(ckpt_path, map_location=device)
             agent_states = checkpoint.get("agents", [])
-            if len(agent_states) == num_uavs:
-                for agent, state in zip(agents, agent_states):
-                    agent.load_state_dict(state)
-            else:
+            # Checkpoints without a layout predate the option and are independent.
+            checkpoint_layout = checkpoint.get("agent_layout", BatchedAgentNetwork.LAYOUT)
+            if len(agent_states) != num_uavs:
                 logger.warning(
                     "Checkpoint agent count (%d) does not match num_uavs (%d); skipping agent load",
                     len(agent_states),
                     num_uavs,
                 )
+            elif agents.SHARED_PARAMETER_NAMES and checkpoint_layout != agent_layout:
+                logger.warning(
+                    "Checkpoint agent layout %r cannot be loaded into %r; skipping agent load",
+                    checkpoint_layout,
+                    agent_layout,
+                )
+            else:
+                agents.load_agent_state_dicts(agent_states)
             mixer_state = checkpoint.get("mixer")
             if mixer_state:
                 mixer.load_state_dict(mixer_state)
-            for agent, target in zip(agents, target_agents):
-                target.load_state_dict(agent.state_dict())
+            target_agents.load_state_dict(agents.state_dict())
             target_mixer.load_state_dict(mixer.state_dict())
         else:
             logger.warning("Init checkpoint %s not found, proceeding without warm start", ckpt_path)
 
-    params = []
-    for agent in agents:
-        params += list(agent.parameters())
-    params += list(mixer.parameters())
+    params = list(agents.parameters()) + list(mixer.parameters())
     optimizer = RMSprop(params, lr=algo_cfg.get("learning_rate", 5e-4))
 
-    replay_buffer = ReplayBuffer(algo_cfg.get("buffer_size", 5000))
+    episodes = algo_cfg.get("episodes", 100)
+    buffer_size = algo_cfg.get("buffer_size", 5000)
+    replay_storage = algo_cfg.get("replay_storage", "frames")
+    if replay_storage == "compact":
+        if template.observation_mode != "global" or template.obstacle_manager.obstacle_type != "static":
+            raise ValueError("replay_storage 'compact' requires global observations and static obstacles")
+        replay_buffer = CompactReplayBuffer(
+            buffer_size,
+            max_seq_len=template.max_steps,
+            map_size=map_size,
+            num_agents=num_uavs,
+            action_dim=action_dim,
+            energy_budget=template.energy_budget,
+            render_states=lambda *frames: template.render_global_states(*frames, dtype=np.uint8),
+        )
+    elif replay_storage == "frames":
+        replay_buffer = ReplayBuffer(
+            buffer_size,
+            max_seq_len=template.max_steps,
+            obs_dim=obs_dim,
+            state_dim=state_dim,
+            num_agents=num_uavs,
+            action_dim=action_dim,
+            shared_observations=template.observation_mode == "global",
+        )
+    else:
+        raise ValueError(f"Unknown replay_storage {replay_storage!r}; expected 'frames' or 'compact'")
+    logger.info(
+        "Replay buffer holds up to %d episodes of %.1f MiB, allocated as episodes arrive",
+        replay_buffer.capacity,
+        replay_buffer.episode_nbytes / 2**20,
+    )
     batch_size = algo_cfg.get("batch_size", 32)
     min_buffer = algo_cfg.get("min_buffer", 200)
-    episodes = algo_cfg.get("episodes", 100)
+    # Fixed-length chunk sampling with burn-in; None trains on whole episodes.
+    sequence_length = algo_cfg.get("sequence_length")
+    burn_in = int(algo_cfg.get("burn_in", 0))
+    updates_per_episode = int(algo_cfg.get("updates_per_episode", 1))
+    if burn_in and not sequence_length:
+        raise ValueError("burn_in requires sequence_length")
+    if updates_per_episode < 1:
+        raise ValueError("updates_per_episode must be positive")
+    # Acting updates fc1 from observation deltas instead of a dense matmul per step.
+    accumulator = None
+    if algo_cfg.get("incremental_acting", False):
+        accumulator = Fc1Accumulator(agents, refresh_interval=int(algo_cfg.get("fc1_refresh_interval", 256)))
+    length_buckets = int(algo_cfg.get("length_buckets", 1))
+    if length_buckets < 1:
+        raise ValueError("length_buckets must be positive")
+    td_chunk_length = algo_cfg.get("td_chunk_length")
+    if td_chunk_length is not None:
+        td_chunk_length = int(td_chunk_length)
+        if td_chunk_length < 1:
+            raise ValueError("td_chunk_length must be positive")
     target_update_interval = algo_cfg.get("target_update_interval", 200)
     gamma = algo_cfg.get("gamma", 0.99)
+    action_masking = bool(algo_cfg.get("action_masking", False))
 
     plateau_configs = algo_cfg.get("epsilon_plateaus", [])
     plateaus: List[Plateau] = []
@@ -368,6 +794,8 @@ def train_single_setting(
     recovery_cooldown = int(recovery_cfg.get("cooldown", 0))
 
     stats_all: List[EpisodeStats] = []
+    unrolled_steps = 0
+    trained_steps = 0
 
     logger.info(
         f"Training QMIX on map={map_size}, num_uavs={num_uavs}, obstacle_density={obstacle_density}"
@@ -378,107 +806,37 @@ def train_single_setting(
     degrade_counter = 0
     last_recovery_episode = -recovery_cooldown
 
-    global_step = 0
-    for episode in range(1, episodes + 1):
-        obs, info = env.reset()
-        episode_stats = EpisodeStats(
-            start_time=time.time(),
-            total_cells=info.get("valid_cells", env.total_cells),
-            per_uav_new_cells=[0 for _ in range(num_uavs)],
-        )
-
-        episode_data = {
-            "obs": [],
-            "next_obs": [],
-            "actions": [],
-            "rewards": [],
-            "state": [],
-            "next_state": [],
-            "terminated": [],
-        }
-
-        state = obs.copy()
-        hidden_states = torch.zeros(len(agents), 1, hidden_dim, device=device)
+    run_episodes = _run_batched_episodes if num_envs > 1 else _run_episodes
+    rollouts = run_episodes(env, agents, replay_buffer, epsilon_schedule, device, action_masking, accumulator)
 
-        done = False
-        truncated = False
-
-        while not (done or truncated):
-            epsilon = epsilon_schedule.get(episode)
-            agent_obs = np.tile(obs, (num_uavs, 1))
-            agent_obs = agent_obs.reshape(1, num_uavs, obs_dim)
-            actions, hidden_states = select_actions(agents, agent_obs, hidden_states, epsilon, device)
-            actions = actions[0]
-
-            next_obs, rewards, done_flag, truncated_flag, step_info = env.step(actions)
-            done = done_flag
-            truncated = truncated_flag
-
-            episode_data["obs"].append(agent_obs[0].copy())
-            episode_data["actions"].append(actions.copy())
-            episode_data["rewards"].append(rewards.copy())
-            episode_data["state"].append(state.copy())
-            episode_data["terminated"].append(float(done or truncated))
-
-            next_agent_obs = np.tile(next_obs, (num_uavs, 1)).reshape(1, num_uavs, obs_dim)
-            episode_data["next_obs"].append(next_agent_obs[0].copy())
-            episode_data["next_state"].append(next_obs.copy())
-
-            episode_stats.steps += 1
-            episode_stats.total_actions += num_uavs
-            episode_stats.energy_consumed += num_uavs
-            episode_stats.collisions += step_info.get("collisions", 0)
-            episode_stats.obstacle_hits += step_info.get("obstacle_hits", 0)
-            episode_stats.visited_cells = step_info.get("visited_count", episode_stats.visited_cells)
-
-            for idx, reward_value in enumerate(rewards):
-                if reward_value >= env.reward_new_cell_base * 0.8:
-                    episode_stats.new_cell_actions += 1
-                    episode_stats.per_uav_new_cells[idx] += 1
-
-            state = next_obs.copy()
-            obs = next_obs
-
-        episode_stats.end_time = time.time()
-        episode_stats.success = bool(done and step_info.get("coverage", 0.0) >= 0.99)
+    global_step = 0
+    for episode, episode_stats in zip(range(1, episodes + 1), rollouts):
         stats_all.append(episode_stats)
 
-        obs_array = np.array(episode_data["obs"], dtype=np.float32)
-        next_obs_array = np.array(episode_data["next_obs"], dtype=np.float32)
-        state_array = np.array(episode_data["state"], dtype=np.float32)
-        next_state_array = np.array(episode_data["next_state"], dtype=np.float32)
-
-        obs_encoded = np.clip(np.rint(obs_array * 255.0), 0, 255).astype(np.uint8)
-        next_obs_encoded = np.clip(np.rint(next_obs_array * 255.0), 0, 255).astype(np.uint8)
-        state_encoded = np.clip(np.rint(state_array * 255.0), 0, 255).astype(np.uint8)
-        next_state_encoded = np.clip(np.rint(next_state_array * 255.0), 0, 255).astype(np.uint8)
-
-        episode_array = {
-            "obs": obs_encoded,
-            "next_obs": next_obs_encoded,
-            "actions": np.array(episode_data["actions"], dtype=np.int64),
-            "rewards": np.array(episode_data["rewards"], dtype=np.float16),
-            "state": state_encoded,
-            "next_state": next_state_encoded,
-            "terminated": np.array(episode_data["terminated"], dtype=np.uint8),
-            "filled_steps": len(episode_data["actions"]),
-        }
-
-        replay_buffer.push(episode_array)
-
         if len(replay_buffer) >= min_buffer:
-            batch = replay_buffer.sample(batch_size)
-            optimizer.zero_grad()
-            loss = compute_td_loss(batch, agents, target_agents, mixer, target_mixer, gamma, device)
-            loss.backward()
-            nn.utils.clip_grad_norm_(params, max_norm=algo_cfg.get("grad_clip", 10.0))
-            optimizer.step()
-
-            global_step += 1
-            if global_step % target_update_interval == 0:
-                for agent, target in zip(agents, target_agents):
-                    target.load_state_dict(agent.state_dict())
-                target_mixer.load_state_dict(mixer.state_dict())
+            for _ in range(updates_per_episode):
+                if sequence_length:
+                    batch = replay_buffer.sample_sequences(batch_size, sequence_length, burn_in)
+                else:
+                    batch = replay_buffer.sample(batch_size, length_buckets)
+                # Steps outside the loss mask (padding, burn-in) are unrolled for nothing.
+                unrolled_steps += batch["mask"].size
+                trained_steps += int(batch["mask"].sum())
+                optimizer.zero_grad()
+                if td_chunk_length:
+                    backward_td_loss(
+                        batch, agents, target_agents, mixer, target_mixer, gamma, device, td_chunk_length
+                    )
+                else:
+                    loss = compute_td_loss(batch, agents, target_agents, mixer, target_mixer, gamma, device)
+                    loss.backward()
+                nn.utils.clip_grad_norm_(params, max_norm=algo_cfg.get("grad_clip", 10.0))
+                optimizer.step()
+
+                global_step += 1
+                if global_step % target_update_interval == 0:
+                    target_agents.load_state_dict(agents.state_dict())
+                    target_mixer.load_state_dict(mixer.state_dict())
 
         if (
             not epsilon_accel_applied
@@ -513,20 +871,24 @@ def train_single_setting(
         if episode % log_interval == 0:
             recent_stats = aggregate_episode_stats(stats_all[-log_interval:])
             epsilon_value = epsilon_schedule.get(episode)
+            padding = 1.0 - trained_steps / unrolled_steps if unrolled_steps else 0.0
             logger.info(
-                "Episode %d | coverage_mean=%.3f | pa_mean=%.3f | steps_mean=%.1f | epsilon=%.3f",
+                "Episode %d | coverage_mean=%.3f | pa_mean=%.3f | steps_mean=%.1f | epsilon=%.3f | padding=%.3f",
                 episode,
                 recent_stats.get("coverage_mean", 0.0),
                 recent_stats.get("pa_mean", 0.0),
                 recent_stats.get("steps_mean", 0.0),
                 epsilon_value,
+                padding,
             )
+            unrolled_steps = 0
+            trained_steps = 0
 
             if recovery_enabled and episode >= recovery_start_episode:
                 coverage = recent_stats.get("coverage_mean", 0.0)
                 if coverage >= recovery_threshold and coverage > best_coverage + recovery_min_improvement:
                     best_snapshot = {
-                        "agents": [deepcopy(agent.state_dict()) for agent in agents],
+                        "agents": agents.agent_state_dicts(),
                         "mixer": deepcopy(mixer.state_dict()),
                     }
                     best_coverage = coverage
@@ -548,11 +910,9 @@ def train_single_setting(
                         degrade_counter >= recovery_patience
                         and episode - last_recovery_episode >= recovery_cooldown
                     ):
-                        for agent, state in zip(agents, best_snapshot["agents"]):
-                            agent.load_state_dict(state)
+                        agents.load_agent_state_dicts(best_snapshot["agents"])
                         mixer.load_state_dict(best_snapshot["mixer"])
-                        for agent, target in zip(agents, target_agents):
-                            target.load_state_dict(agent.state_dict())
+                        target_agents.load_state_dict(agents.state_dict())
                         target_mixer.load_state_dict(mixer.state_dict())
                         previous_epsilon = epsilon_value
                         if previous_epsilon < recovery_reset_epsilon:
@@ -596,8 +956,7 @@ def train_single_setting(
             "Applying best snapshot (coverage=%.3f) before saving checkpoint.",
             best_coverage,
         )
-        for agent, state in zip(agents, best_snapshot["agents"]):
-            agent.load_state_dict(state)
+        agents.load_agent_state_dicts(best_snapshot["agents"])
         mixer.load_state_dict(best_snapshot["mixer"])
 
     checkpoint_dir = Path(base_cfg.get("checkpoint_dir", "experiments/checkpoints"))
@@ -606,7 +965,8 @@ def train_single_setting(
     obs_density_str = f"obs{obstacle_density:.2f}".replace(".", "")
     ckpt_path = checkpoint_dir / f"qmix_map{map_size[0]}_uavs{num_uavs}_{obs_density_str}_{int(time.time())}.pt"
     checkpoint = {
-        "agents": [agent.state_dict() for agent in agents],
+        "agents": agents.agent_state_dicts(),
+        "agent_layout": agents.LAYOUT,
         "mixer": mixer.state_dict(),
         "map_size": map_size,
         "num_uavs": num_uavs,
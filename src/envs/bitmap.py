@@ -0,0 +1,104 @@
+"""Bit-packed boolean maps for large grids."""
+from __future__ import annotations
+
+from typing import Tuple
+
+import numpy as np
+
+WORD_BITS = 64
+_BITS = np.left_shift(np.uint64(1), np.arange(WORD_BITS, dtype=np.uint64))
+_BYTE_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def _popcount(words: np.ndarray) -> int:
+    if hasattr(np, "bitwise_count"):
+        return int(np.bitwise_count(words).sum())
+    return int(_BYTE_POPCOUNT[words.view(np.uint8)].sum())
+
+
+class PackedBitMap:
+    """(H, W) boolean map stored as little-endian uint64 words, one row per word run.
+
+    Supports ``bitmap[row, col]`` reads and writes like a bool array, and
+    whole-map queries (counts, unions, unpacking) as word-level operations.
+    Padding bits past ``width`` are always zero.
+    """
+
+    def __init__(self, height: int, width: int) -> None:
+        self.height = height
+        self.width = width
+        self.words_per_row = (width + WORD_BITS - 1) // WORD_BITS
+        self.words = np.zeros((height, self.words_per_row), dtype="<u8")
+        tail = np.full(self.words_per_row, np.iinfo(np.uint64).max, dtype="<u8")
+        if width % WORD_BITS:
+            tail[-1] = _BITS[width % WORD_BITS] - np.uint64(1)
+        self._row_mask = tail
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.height, self.width
+
+    @classmethod
+    def from_dense(cls, mask: np.ndarray) -> "PackedBitMap":
+        bitmap = cls(*mask.shape)
+        bitmap.load(mask)
+        return bitmap
+
+    def load(self, mask: np.ndarray) -> None:
+        """Overwrite the map from a dense (H, W) boolean array."""
+        packed = np.packbits(np.asarray(mask, dtype=bool), axis=1, bitorder="little")
+        padded = np.zeros((self.height, self.words_per_row * 8), dtype=np.uint8)
+        padded[:, : packed.shape[1]] = packed
+        self.words[...] = padded.view("<u8")
+
+    def to_dense(self) -> np.ndarray:
+        """Unpack into a new (H, W) boolean array."""
+        bits = np.unpackbits(self.words.view(np.uint8), axis=1, count=self.width, bitorder="little")
+        return bits.view(bool)
+
+    def copy(self) -> "PackedBitMap":
+        bitmap = PackedBitMap(self.height, self.width)
+        bitmap.words[...] = self.words
+        return bitmap
+
+    def fill(self, value: bool) -> None:
+        self.words[...] = self._row_mask if value else 0
+
+    def count(self) -> int:
+        """Number of set cells."""
+        return _popcount(self.words)
+
+    def get_many(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """Vectorised read of the cells at ``(rows, cols)``."""
+        cols = np.asarray(cols)
+        return (self.words[rows, cols // WORD_BITS] & _BITS[cols % WORD_BITS]) != 0
+
+    def set_many(self, rows: np.ndarray, cols: np.ndarray) -> None:
+        """Vectorised set of the cells at ``(rows, cols)``; repeats are allowed."""
+        cols = np.asarray(cols)
+        np.bitwise_or.at(self.words, (rows, cols // WORD_BITS), _BITS[cols % WORD_BITS])
+
+    def clear_many(self, rows: np.ndarray, cols: np.ndarray) -> None:
+        """Vectorised clear of the cells at ``(rows, cols)``; repeats are allowed."""
+        cols = np.asarray(cols)
+        np.bitwise_and.at(self.words, (rows, cols // WORD_BITS), ~_BITS[cols % WORD_BITS])
+
+    def __getitem__(self, index: Tuple[int, int]) -> bool:
+        row, col = index
+        return bool(self.words[row, col // WORD_BITS] & _BITS[col % WORD_BITS])
+
+    def __setitem__(self, index: Tuple[int, int], value: bool) -> None:
+        row, col = index
+        word = col // WORD_BITS
+        if value:
+            self.words[row, word] |= _BITS[col % WORD_BITS]
+        else:
+            self.words[row, word] &= ~_BITS[col % WORD_BITS]
+
+
+def count_unset(*maps: PackedBitMap) -> int:
+    """Number of cells set in none of the given maps."""
+    union = np.zeros_like(maps[0].words)
+    for bitmap in maps:
+        union |= bitmap.words
+    return _popcount(~union & maps[0]._row_mask)
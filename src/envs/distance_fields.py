@@ -0,0 +1,324 @@
+"""Grid distance fields used for reward shaping."""
+from __future__ import annotations
+
+import heapq
+from array import array
+from collections import deque
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+UNREACHABLE = -1
+
+
+def _dilate(mask: np.ndarray) -> np.ndarray:
+    """Grow a batch of (N, H, W) boolean maps by one 4-neighbour step."""
+    grown = mask.copy()
+    grown[:, 1:, :] |= mask[:, :-1, :]
+    grown[:, :-1, :] |= mask[:, 1:, :]
+    grown[:, :, 1:] |= mask[:, :, :-1]
+    grown[:, :, :-1] |= mask[:, :, 1:]
+    return grown
+
+
+def obstacle_clearance(obstacle_maps: np.ndarray) -> np.ndarray:
+    """Per-cell distance to the nearest obstacle via multi-source BFS.
+
+    Accepts a single (H, W) map or a batch (N, H, W). Cells on maps without
+    obstacles are ``UNREACHABLE``.
+    """
+    batch = obstacle_maps if obstacle_maps.ndim == 3 else obstacle_maps[None]
+    reached = batch.astype(bool, copy=True)
+    clearance = np.where(reached, 0, UNREACHABLE).astype(np.int32)
+    step = 0
+    while True:
+        step += 1
+        grown = _dilate(reached)
+        newly = grown & ~reached
+        if not newly.any():
+            break
+        clearance[newly] = step
+        reached = grown
+    return clearance if obstacle_maps.ndim == 3 else clearance[0]
+
+
+def geodesic_distance_field(sources: np.ndarray, passable: np.ndarray) -> np.ndarray:
+    """Full (H, W) BFS distance to the nearest source through passable cells."""
+    reached = (sources & passable)[None]
+    field = np.where(reached[0], 0, UNREACHABLE).astype(np.int32)
+    step = 0
+    while True:
+        step += 1
+        grown = _dilate(reached) & passable
+        newly = grown & ~reached
+        if not newly.any():
+            break
+        field[newly[0]] = step
+        reached = grown
+    return field
+
+
+def label_components(passable: np.ndarray) -> Tuple[np.ndarray, int]:
+    """4-connected component labels of an (H, W) passable map.
+
+    Returns ``(labels, count)``: blocked cells get label 0 and components are
+    numbered ``1..count`` in row-major order of their first cell. Labels
+    spread as neighbourhood minima with pointer jumping, so the number of
+    sweeps grows with the logarithm of a component's extent rather than
+    its length.
+    """
+    passable = np.asarray(passable, dtype=bool)
+    size = passable.size
+    blocked = np.iinfo(np.int64).max
+    labels = np.where(passable.reshape(-1), np.arange(size), blocked).reshape(passable.shape)
+    while True:
+        merged = labels.copy()
+        np.minimum(merged[1:, :], labels[:-1, :], out=merged[1:, :])
+        np.minimum(merged[:-1, :], labels[1:, :], out=merged[:-1, :])
+        np.minimum(merged[:, 1:], labels[:, :-1], out=merged[:, 1:])
+        np.minimum(merged[:, :-1], labels[:, 1:], out=merged[:, :-1])
+        merged[~passable] = blocked
+        # Each label is the flat index of a cell in the component; follow it.
+        flat = merged.reshape(-1)
+        inside = flat != blocked
+        while True:
+            jumped = flat[flat[inside]]
+            if np.array_equal(jumped, flat[inside]):
+                break
+            flat[inside] = jumped
+        if np.array_equal(merged, labels):
+            break
+        labels = merged
+    roots, compact = np.unique(labels, return_inverse=True)
+    compact = compact.reshape(passable.shape).astype(np.int32) + 1
+    compact[~passable] = 0
+    return compact, int(np.count_nonzero(roots != blocked))
+
+
+class IncrementalDistanceField:
+    """BFS distance to a changing set of source cells, repaired in place.
+
+    Every passable cell stores the number of 4-neighbour moves to the nearest
+    source along passable cells. Removing sources or blocking cells only
+    revisits the cells whose shortest paths depended on them, and adding
+    sources or unblocking cells relaxes outwards from the change, so the cost
+    of an update scales with the number of cells whose distance changes.
+    Cells are addressed by flat index ``row * width + col``.
+
+    The repair loops run on ``array``/``bytearray`` storage, which is much
+    cheaper to index from Python than NumPy scalars; ``_passable``,
+    ``_sources`` and ``_dist`` are NumPy views of the same memory. That
+    storage carries a one-cell impassable border, so a cell's neighbours are
+    plain offsets and no per-cell neighbour lists are kept. Fields built by a
+    ``DistanceFieldStack`` each own one block of the stack's storage.
+    """
+
+    INF = np.iinfo(np.int32).max
+
+    def __init__(
+        self,
+        sources: np.ndarray,
+        passable: np.ndarray,
+        stack: Optional[DistanceFieldStack] = None,
+        index: int = 0,
+    ) -> None:
+        self.height, self.width = sources.shape
+        self._stride = self.width + 2
+        size = (self.height + 2) * self._stride
+        if stack is None:
+            self._passable_cells = bytearray(size)
+            self._source_cells = bytearray(size)
+            self._dist_cells = array("i", bytes(4 * size))
+        else:
+            # Block ``index`` of storage shared with the stack's other fields.
+            self._passable_cells = stack.passable_cells
+            self._source_cells = stack.source_cells
+            self._dist_cells = stack.dist_cells
+        self._base = index * size
+        window = slice(self._base, self._base + size)
+        self._passable = np.frombuffer(self._passable_cells, dtype=bool)[window]
+        self._sources = np.frombuffer(self._source_cells, dtype=bool)[window]
+        self._dist = np.frombuffer(self._dist_cells, dtype=np.int32)[window]
+        self._dist[:] = self.INF
+        self.reset(sources, passable)
+
+    def _interior(self, storage: np.ndarray) -> np.ndarray:
+        return storage.reshape(self.height + 2, self._stride)[1:-1, 1:-1]
+
+    def _padded(self, cells: Iterable[int]) -> List[int]:
+        """Storage indices of flat ``row * width + col`` cells."""
+        width, offset = self.width, self._base + self._stride + 1
+        return [cell + 2 * (cell // width) + offset for cell in cells]
+
+    def reset(self, sources: np.ndarray, passable: np.ndarray) -> None:
+        """Recompute the whole field for new source and passable maps."""
+        passable = np.asarray(passable, dtype=bool).reshape(self.height, self.width)
+        sources = np.asarray(sources, dtype=bool).reshape(self.height, self.width) & passable
+        self._interior(self._passable)[...] = passable
+        self._interior(self._sources)[...] = sources
+        field = geodesic_distance_field(sources, passable)
+        self._interior(self._dist)[...] = np.where(field == UNREACHABLE, self.INF, field)
+
+    @property
+    def passable(self) -> np.ndarray:
+        """(H, W) view of the passable cells."""
+        return self._interior(self._passable)
+
+    @property
+    def sources(self) -> np.ndarray:
+        """(H, W) view of the source cells."""
+        return self._interior(self._sources)
+
+    @property
+    def distance(self) -> np.ndarray:
+        """(H, W) distances with ``UNREACHABLE`` for cells that reach no source."""
+        field = self._interior(self._dist)
+        return np.where(field == self.INF, UNREACHABLE, field)
+
+    def lookup(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """Vectorised read of the field, ``UNREACHABLE`` where no source is reachable."""
+        values = self._dist[(np.asarray(rows) + 1) * self._stride + np.asarray(cols) + 1]
+        return np.where(values == self.INF, UNREACHABLE, values)
+
+    def remove_sources(self, cells: Iterable[int]) -> None:
+        """Turn source cells into ordinary passable cells."""
+        sources, roots = self._source_cells, []
+        for cell in self._padded(cells):
+            if sources[cell]:
+                sources[cell] = False
+                roots.append(cell)
+        if roots:
+            self._raise(roots)
+
+    def add_sources(self, cells: Iterable[int]) -> None:
+        """Turn passable cells into sources."""
+        passable, sources, roots = self._passable_cells, self._source_cells, []
+        for cell in self._padded(cells):
+            if passable[cell] and not sources[cell]:
+                sources[cell] = True
+                roots.append(cell)
+        if roots:
+            self._lower(roots)
+
+    def block(self, cells: Iterable[int]) -> None:
+        """Make cells impassable (they also stop being sources)."""
+        passable, sources, roots = self._passable_cells, self._source_cells, []
+        for cell in self._padded(cells):
+            if passable[cell]:
+                passable[cell] = False
+                sources[cell] = False
+                roots.append(cell)
+        if roots:
+            self._raise(roots)
+
+    def unblock(self, cells: Iterable[int], source: bool = False) -> None:
+        """Make blocked cells passable again, optionally as sources."""
+        passable, sources, roots = self._passable_cells, self._source_cells, []
+        for cell in self._padded(cells):
+            if not passable[cell]:
+                passable[cell] = True
+                sources[cell] = source
+                roots.append(cell)
+        if roots:
+            self._lower(roots)
+
+    def _raise(self, roots: List[int]) -> None:
+        """Repair distances after ``roots`` lost source status or were blocked.
+
+        Flags are already updated; ``_dist`` still holds the old distances.
+        """
+        dist, passable, sources = self._dist_cells, self._passable_cells, self._source_cells
+        stride, inf = self._stride, self.INF
+
+        # Collect cells whose every shortest-path parent is gone.
+        affected = {cell for cell in roots if passable[cell]}
+        queue = deque(roots)
+        while queue:
+            cell = queue.popleft()
+            child_dist = dist[cell] + 1
+            for child in (cell - stride, cell + stride, cell - 1, cell + 1):
+                if child in affected or not passable[child] or sources[child]:
+                    continue
+                if dist[child] != child_dist:
+                    continue
+                supported = False
+                for parent in (child - stride, child + stride, child - 1, child + 1):
+                    if parent not in affected and passable[parent] and dist[parent] == child_dist - 1:
+                        supported = True
+                        break
+                if not supported:
+                    affected.add(child)
+                    queue.append(child)
+
+        for cell in roots:
+            if not passable[cell]:
+                dist[cell] = inf
+
+        # Re-seed affected cells from their intact neighbours and settle them.
+        heap: List[Tuple[int, int]] = []
+        for cell in affected:
+            best = inf
+            for neighbor in (cell - stride, cell + stride, cell - 1, cell + 1):
+                if neighbor not in affected and passable[neighbor] and dist[neighbor] < best - 1:
+                    best = dist[neighbor] + 1
+            dist[cell] = best
+            if best < inf:
+                heap.append((best, cell))
+        heapq.heapify(heap)
+        while heap:
+            value, cell = heapq.heappop(heap)
+            if value != dist[cell]:
+                continue
+            for neighbor in (cell - stride, cell + stride, cell - 1, cell + 1):
+                if neighbor in affected and value + 1 < dist[neighbor]:
+                    dist[neighbor] = value + 1
+                    heapq.heappush(heap, (value + 1, neighbor))
+
+    def _lower(self, roots: List[int]) -> None:
+        """Relax distances outwards from new sources or newly passable cells."""
+        dist, passable, sources = self._dist_cells, self._passable_cells, self._source_cells
+        stride, inf = self._stride, self.INF
+
+        for cell in roots:
+            best = 0 if sources[cell] else inf
+            for neighbor in (cell - stride, cell + stride, cell - 1, cell + 1):
+                if passable[neighbor] and dist[neighbor] < best - 1:
+                    best = dist[neighbor] + 1
+            dist[cell] = best
+
+        queue = deque(roots)
+        while queue:
+            cell = queue.popleft()
+            value = dist[cell]
+            if value == inf:
+                continue
+            for neighbor in (cell - stride, cell + stride, cell - 1, cell + 1):
+                if passable[neighbor] and value + 1 < dist[neighbor]:
+                    dist[neighbor] = value + 1
+                    queue.append(neighbor)
+
+
+class DistanceFieldStack:
+    """``count`` same-shaped ``IncrementalDistanceField``s in one block of storage.
+
+    Field ``i`` of ``fields`` repairs itself exactly like a standalone field;
+    sharing the storage lets :meth:`lookup` read any mix of fields with one
+    NumPy gather.
+    """
+
+    def __init__(self, count: int, height: int, width: int) -> None:
+        self.height, self.width = height, width
+        self._stride = width + 2
+        self._block = (height + 2) * self._stride
+        self.passable_cells = bytearray(count * self._block)
+        self.source_cells = bytearray(count * self._block)
+        self.dist_cells = array("i", bytes(4 * count * self._block))
+        self._dist = np.frombuffer(self.dist_cells, dtype=np.int32)
+        empty = np.zeros((height, width), dtype=bool)
+        self.fields = [IncrementalDistanceField(empty, empty, stack=self, index=idx) for idx in range(count)]
+
+    def lookup(self, index: np.ndarray, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """Read ``fields[index]`` at ``(rows, cols)``; the three arrays broadcast."""
+        cells = np.asarray(index) * self._block + (np.asarray(rows) + 1) * self._stride + np.asarray(cols) + 1
+        values = self._dist[cells]
+        return np.where(values == IncrementalDistanceField.INF, UNREACHABLE, values)
@@ -1,15 +1,19 @@
 """Multi-UAV grid world environment for path planning."""
 from __future__ import annotations
 
-from collections import deque
+from dataclasses import dataclass
 from enum import IntEnum
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import gymnasium as gym
 import numpy as np
 from gymnasium import spaces
+from numpy.lib.stride_tricks import sliding_window_view
 
-from src.envs.obstacles import ObstacleManager
+from src.envs.bitmap import PackedBitMap, count_unset
+from src.envs.distance_fields import UNREACHABLE, IncrementalDistanceField
+from src.envs.obstacles import CLEARANCE_LIMIT, ObstacleManager, ObstacleState
+from src.envs.scenarios import ScenarioBank
 
 
 class CellType(IntEnum):
@@ -26,6 +30,108 @@ class Action(IntEnum):
     RIGHT = 3
 
 
+# Row/column offsets indexed by ``Action`` value; ``action ^ 1`` is the reverse move.
+ACTION_DELTAS = np.array([(-1, 0), (1, 0), (0, -1), (0, 1)], dtype=np.int64)
+
+OBSERVATION_MODES = ("global", "local")
+ACTION_MODES = ("primitive", "macro")
+COVERAGE_CELLS = ("all", "reachable", "repair")
+# Per-agent scalars appended to a local window: row, col, energy, coverage,
+# frontier direction (row, col) and frontier distance.
+LOCAL_SCALAR_SIZE = 7
+
+
+def open_move_mask(open_moves: np.ndarray, actions: np.ndarray) -> np.ndarray:
+    """Whether each action stays on the map and off static obstacles.
+
+    ``open_moves`` holds the open-move bits of the cells the actions start
+    from, as kept in ``GridWorldEnv._open_moves``; the two arrays broadcast.
+    """
+    return ((open_moves >> actions) & 1).astype(bool)
+
+
+def register_no_progress(
+    no_progress_steps: np.ndarray,
+    mask: np.ndarray,
+    rewards: np.ndarray,
+    patience: int,
+    penalty: float,
+) -> None:
+    """Count a step without progress for ``mask`` and charge ``penalty`` at ``patience``.
+
+    Counters that reach the patience restart from zero; all arrays share a
+    shape and are updated in place.
+    """
+    if not mask.any():
+        return
+    no_progress_steps[mask] += 1
+    triggered = mask & (no_progress_steps >= patience)
+    rewards[triggered] += penalty
+    no_progress_steps[triggered] = 0
+
+
+def new_cell_rewards(fresh: np.ndarray, remaining: np.ndarray, base: float, longest_side: int) -> np.ndarray:
+    """Reward for the UAVs (last axis) that claimed a new cell, 0 elsewhere.
+
+    ``remaining`` is the count of cells left before the step and broadcasts
+    against ``fresh`` without its last axis; cells claimed by lower-indexed
+    UAVs in the same step shrink it for the later ones.
+    """
+    remaining = remaining[..., None] - (np.cumsum(fresh, axis=-1) - fresh)
+    scale = 1.0 + np.where(remaining > 0, longest_side / np.maximum(remaining, 1), 0.0)
+    return np.where(fresh, base * scale, 0.0)
+
+
+def shaping_potential(distance: np.ndarray, clearance: np.ndarray, obstacle_weight: float) -> np.ndarray:
+    """Minus the frontier distance plus weighted clearance; ``UNREACHABLE`` terms count 0."""
+    potential = np.zeros(distance.shape, dtype=np.float64)
+    potential -= np.where(distance != UNREACHABLE, distance, 0)
+    potential += np.where(
+        clearance != UNREACHABLE,
+        obstacle_weight * np.minimum(clearance, CLEARANCE_LIMIT),
+        0.0,
+    )
+    return potential
+
+
+def apply_shaping(
+    rewards: np.ndarray,
+    prev_potential: np.ndarray,
+    potential: np.ndarray,
+    active: np.ndarray,
+    weight: float,
+) -> None:
+    """Add the potential-based shaping reward of ``active`` UAVs and keep their new potential."""
+    rewards[active] += weight * (potential[active] - prev_potential[active])
+    prev_potential[active] = potential[active]
+
+
+@dataclass
+class EnvState:
+    """Snapshot of a ``GridWorldEnv`` episode, see ``GridWorldEnv.get_state``."""
+
+    visited: np.ndarray
+    uav_positions: np.ndarray
+    uav_energy: np.ndarray
+    no_progress_steps: np.ndarray
+    prev_potential: np.ndarray
+    frontier_sources: np.ndarray
+    frontier_passable: np.ndarray
+    frontier_dist: np.ndarray
+    observation: np.ndarray
+    map_layers: Optional[np.ndarray]
+    uav_cells: np.ndarray
+    obstacles: ObstacleState
+    step_count: int = 0
+    visited_count: int = 0
+    episode_reward: float = 0.0
+    remaining_count: int = 0
+    unreachable_count: int = 0
+    valid_cells: int = 0
+    reachable_cells: int = 0
+    rng_state: Optional[Dict[str, Any]] = None
+
+
 class GridWorldEnv(gym.Env):
     metadata = {"render_modes": ["human"]}
 
@@ -47,7 +153,25 @@ class GridWorldEnv(gym.Env):
         shaping_weight: float = 10.0,
         obstacle_shaping_weight: float = 2.0,
         seed: Optional[int] = None,
+        observation_dtype: str = "float32",
+        reuse_observation_buffer: bool = False,
+        map_backend: str = "dense",
+        observation_mode: str = "global",
+        local_view_size: int = 7,
+        motion_model: str = "random_walk",
+        dynamic_fraction: float = 0.1,
+        move_probability: float = 0.5,
+        scenario_bank: Optional[Union[str, ScenarioBank]] = None,
+        coverage_cells: str = "reachable",
+        debug_counters: bool = False,
+        action_mode: str = "primitive",
+        max_macro_steps: Optional[int] = None,
     ) -> None:
+        """Create the environment.
+
+        See "Environment options" in the README for the observation, backend,
+        obstacle, action and coverage modes.
+        """
         super().__init__()
 
         self.map_size = map_size
@@ -67,6 +191,27 @@ class GridWorldEnv(gym.Env):
         self.shaping_weight = shaping_weight
         self.obstacle_shaping_weight = obstacle_shaping_weight
 
+        self.observation_dtype = np.dtype(observation_dtype)
+        if self.observation_dtype not in (np.dtype(np.float32), np.dtype(np.uint8)):
+            raise ValueError(f"Unsupported observation dtype: {observation_dtype}")
+        self.reuse_observation_buffer = reuse_observation_buffer
+        if observation_mode not in OBSERVATION_MODES:
+            raise ValueError(f"Unsupported observation mode: {observation_mode}")
+        if local_view_size < 1 or local_view_size % 2 == 0:
+            raise ValueError(f"local_view_size must be a positive odd number, received {local_view_size}")
+        self.observation_mode = observation_mode
+        self.local_view_size = local_view_size
+        if coverage_cells not in COVERAGE_CELLS:
+            raise ValueError(f"Unsupported coverage cells: {coverage_cells}")
+        self.coverage_cells = coverage_cells
+        self.debug_counters = debug_counters
+        if action_mode not in ACTION_MODES:
+            raise ValueError(f"Unsupported action mode: {action_mode}")
+        if max_macro_steps is not None and max_macro_steps < 1:
+            raise ValueError(f"max_macro_steps must be positive, received {max_macro_steps}")
+        self.action_mode = action_mode
+        self.max_macro_steps = max_macro_steps or max(map_size)
+
         self.rng = np.random.default_rng(seed)
 
         self.obstacle_manager = ObstacleManager(
@@ -74,31 +219,90 @@ class GridWorldEnv(gym.Env):
             obstacle_density=obstacle_density,
             obstacle_type=obstacle_type,
             seed=seed,
+            map_backend=map_backend,
+            motion_model=motion_model,
+            dynamic_fraction=dynamic_fraction,
+            move_probability=move_probability,
         )
-
-        self.visited_map: np.ndarray = np.zeros((self.height, self.width), dtype=bool)
-        self.uav_positions: List[Tuple[int, int]] = []
+        self.map_backend = map_backend
+        if isinstance(scenario_bank, str):
+            scenario_bank = ScenarioBank(scenario_bank)
+        if scenario_bank is not None:
+            scenario_bank.check_compatible(map_size, num_uavs)
+        self.scenario_bank = scenario_bank
+
+        self.visited_map = self._new_visited_map()
+        self.uav_positions = np.zeros((self.num_uavs, 2), dtype=np.int64)
         self.uav_energy = np.zeros(self.num_uavs, dtype=int)
         self.step_count = 0
         self.visited_count = 0
         self.episode_reward = 0.0
         self.no_progress_steps = np.zeros(self.num_uavs, dtype=int)
         self.prev_potential = np.zeros(self.num_uavs, dtype=np.float32)
+        self._remaining_count = 0
+        self._unreachable_count = 0
+        self.valid_cells = 0
+        self.reachable_cells = 0
+        self._occupancy = np.zeros(self.total_cells, dtype=np.min_scalar_type(self.num_uavs))
+        # Per cell, bit ``a`` is set when move ``a`` stays on the map and off static obstacles.
+        self._open_moves = np.zeros(self.total_cells, dtype=np.uint8)
+        self._move_offsets = ACTION_DELTAS[:, 0] * self.width + ACTION_DELTAS[:, 1]
+        self._table_version = -1
+        self._last_events = np.zeros(self.num_uavs, dtype=bool)
+        self.frontier_field = IncrementalDistanceField(
+            sources=np.zeros((self.height, self.width), dtype=bool),
+            passable=np.zeros((self.height, self.width), dtype=bool),
+        )
 
         self._build_spaces()
+        self._allocate_observation()
 
     def _build_spaces(self) -> None:
         self.action_space = spaces.MultiDiscrete([len(Action)] * self.num_uavs)
         map_obs_size = self.height * self.width * 3
         scalar_obs_size = 1 + self.num_uavs * 3
-        obs_size = map_obs_size + scalar_obs_size
+        self.state_dim = map_obs_size + scalar_obs_size
+        if self.observation_mode == "local":
+            window_size = 3 * self.local_view_size ** 2
+            obs_shape = (self.num_uavs, window_size + LOCAL_SCALAR_SIZE)
+        else:
+            obs_shape = (self.state_dim,)
+        quantised = self.observation_dtype == np.uint8
         self.observation_space = spaces.Box(
-            low=0.0,
-            high=1.0,
-            shape=(obs_size,),
-            dtype=np.float32,
+            low=0,
+            high=255 if quantised else 1.0,
+            shape=obs_shape,
+            dtype=self.observation_dtype,
         )
 
+    def _allocate_observation(self) -> None:
+        map_obs_size = self.height * self.width * 3
+        self._obs_high = 255 if self.observation_dtype == np.uint8 else 1.0
+        self._obs_buffer = np.zeros(self.observation_space.shape, dtype=self.observation_dtype)
+        if self.observation_mode == "local":
+            view, radius = self.local_view_size, self.local_view_size // 2
+            if self.map_backend == "packed":
+                # Windows are read straight from the packed maps; no dense layers are kept.
+                self._window_offsets = np.arange(view) - radius
+                layers = None
+            else:
+                # Map layers live in a padded array; each UAV's window is a strided
+                # view into it, gathered into the observation rows.
+                self._padded_layers = np.zeros(
+                    (3, self.height + 2 * radius, self.width + 2 * radius), dtype=self.observation_dtype
+                )
+                layers = self._padded_layers[:, radius:radius + self.height, radius:radius + self.width]
+                self._windows = sliding_window_view(self._padded_layers, (view, view), axis=(1, 2))
+            window_size = 3 * view * view
+            self._local_maps = self._obs_buffer[:, :window_size].reshape(self.num_uavs, 3, view, view)
+            self._scalar_obs = self._obs_buffer[:, window_size:]
+        else:
+            layers = self._obs_buffer[:map_obs_size].reshape(3, self.height, self.width)
+            self._scalar_obs = self._obs_buffer[map_obs_size:]
+        self._map_layers = layers
+        self._visited_layer, self._obstacle_layer, self._uav_layer = (None,) * 3 if layers is None else layers
+        self._uav_cells = np.zeros((0, 2), dtype=np.int64)
+
     def reset(
         self, *, seed: Optional[int] = None, options: Optional[Dict[str, Any]] = None
     ) -> Tuple[np.ndarray, Dict[str, Any]]:
@@ -107,9 +311,13 @@ class GridWorldEnv(gym.Env):
 
         self.step_count = 0
         self.episode_reward = 0.0
-        self.visited_map = np.zeros((self.height, self.width), dtype=bool)
+        self.visited_map = self._new_visited_map()
         self.uav_energy = np.full(self.num_uavs, self.energy_budget, dtype=int)
-        self.uav_positions = self._initial_positions()
+        if self.scenario_bank is not None:
+            self.uav_positions = self._draw_scenario()
+        else:
+            self.uav_positions = self._initial_positions()
+        self.obstacle_manager.ensure_connectivity(self.uav_positions)
         self.visited_count = 0
         self.no_progress_steps = np.zeros(self.num_uavs, dtype=int)
 
@@ -117,10 +325,27 @@ class GridWorldEnv(gym.Env):
             if not self.visited_map[row, col]:
                 self.visited_map[row, col] = True
                 self.visited_count += 1
-
-        self.prev_potential = np.array([self._state_potential(pos) for pos in self.uav_positions], dtype=np.float32)
-
-        self.obstacle_manager.ensure_connectivity(self.uav_positions)
+        self._analyse_reachability(self.uav_positions)
+
+        # One dense copy of the final map serves every rebuild below (packed
+        # maps unpack on each ``get_obstacle_view``).
+        obstacles = self.obstacle_manager.get_obstacle_view()
+        unvisited = ~obstacles
+        unvisited[self.uav_positions[:, 0], self.uav_positions[:, 1]] = False
+        self.frontier_field.reset(sources=unvisited, passable=~obstacles)
+        self.prev_potential = self._state_potentials().astype(np.float32)
+
+        if self._table_version != self.obstacle_manager.map_version:
+            # The table covers static obstacles; ``_neighbours`` checks movers.
+            static_free = ~obstacles
+            movers = self.obstacle_manager.dynamic_positions
+            static_free[movers[:, 0], movers[:, 1]] = True
+            self._build_neighbour_table(static_free)
+        # Start cells are free and reachable, so every other valid cell remains.
+        self._remaining_count = self.valid_cells - self.visited_count
+        self._reset_observation(obstacles)
+        if self.debug_counters:
+            self._check_counters()
 
         observation = self._get_observation()
         info = self._get_info()
@@ -134,91 +359,16 @@ class GridWorldEnv(gym.Env):
                 f"Expected {self.num_uavs} actions, received {len(actions)}"
             )
 
-        rewards = np.zeros(self.num_uavs, dtype=np.float32)
-        attempted_positions: List[Tuple[int, int]] = []
-        final_positions = self.uav_positions.copy()
-        progress_made = [False] * self.num_uavs
-        penalty_registered = [False] * self.num_uavs
-        collisions = 0
-        obstacle_hits = 0
-
-        for idx, action in enumerate(actions):
-            row, col = self.uav_positions[idx]
-            if self.uav_energy[idx] <= 0:
-                attempted_positions.append((row, col))
-                continue
-
-            d_row, d_col = self._action_to_delta(Action(action))
-            new_row, new_col = row + d_row, col + d_col
-
-            if self._is_invalid_cell(new_row, new_col):
-                rewards[idx] += self.reward_obstacle
-                obstacle_hits += 1
-                self._register_no_progress(idx, rewards)
-                penalty_registered[idx] = True
-                attempted_positions.append((row, col))
-                continue
-
-            attempted_positions.append((new_row, new_col))
-
-        for idx, pos in enumerate(attempted_positions):
-            if self.uav_energy[idx] <= 0:
-                continue
-
-            if attempted_positions.count(pos) > 1:
-                rewards[idx] += self.reward_collision
-                collisions += 1
-                self._register_no_progress(idx, rewards)
-                penalty_registered[idx] = True
-                continue
-
-            final_positions[idx] = pos
-            self.uav_energy[idx] = max(0, self.uav_energy[idx] - 1)
-
-            row, col = pos
-            if not self.visited_map[row, col]:
-                remaining = self._remaining_free_cells()
-                scale = 1.0
-                if remaining > 0:
-                    scale += max(self.height, self.width) / remaining
-                rewards[idx] += self.reward_new_cell_base * scale
-                self.visited_map[row, col] = True
-                self.visited_count += 1
-                self.no_progress_steps[idx] = 0
-                progress_made[idx] = True
-            else:
-                rewards[idx] += self.reward_visited_cell
-                self._register_no_progress(idx, rewards)
-                penalty_registered[idx] = True
-
-        for idx in range(self.num_uavs):
-            if self.uav_energy[idx] <= 0:
-                continue
-            if progress_made[idx]:
-                continue
-            if penalty_registered[idx]:
-                continue
-            self._register_no_progress(idx, rewards, gentle=True)
-
-        self.uav_positions = final_positions
-
-        # Potential-based shaping reward
-        for idx, pos in enumerate(self.uav_positions):
-            if self.uav_energy[idx] <= 0:
-                continue
-            potential_new = self._state_potential(pos)
-            delta = potential_new - self.prev_potential[idx]
-            rewards[idx] += self.shaping_weight * delta
-            self.prev_potential[idx] = potential_new
+        actions = np.asarray(actions, dtype=np.int64)
+        invalid = (actions < 0) | (actions >= len(Action))
+        if invalid.any():
+            raise ValueError(f"Unsupported action: {actions[invalid][0]}")
 
-        self.step_count += 1
-        self.episode_reward += float(rewards.sum())
-
-        terminated = self._is_covered()
-        truncated = self.step_count >= self.max_steps or np.all(self.uav_energy <= 0)
-
-        if terminated:
-            rewards += self.reward_complete / self.num_uavs
+        if self.action_mode == "macro":
+            rewards, terminated, truncated, counts = self._macro_step(actions)
+        else:
+            rewards, terminated, truncated, counts = self._primitive_step(actions)
+        collisions, obstacle_hits, primitive_steps, energy_used = counts
 
         observation = self._get_observation()
         info = self._get_info()
@@ -227,147 +377,571 @@ class GridWorldEnv(gym.Env):
                 "collisions": collisions,
                 "obstacle_hits": obstacle_hits,
                 "reward_vector": rewards.copy(),
+                "primitive_steps": primitive_steps,
+                "energy_used": energy_used,
             }
         )
 
         return observation, rewards, terminated, truncated, info
 
-    def _state_potential(self, position: Tuple[int, int]) -> float:
-        distance = self._nearest_unvisited_distance(position)
-        clearance = self._nearest_obstacle_distance(position)
-        potential = 0.0
-        if distance is not None:
-            potential -= float(distance)
-        if clearance is not None:
-            potential += self.obstacle_shaping_weight * float(min(clearance, 5))
-        return potential
-
-    def _nearest_obstacle_distance(self, position: Tuple[int, int]) -> Optional[int]:
-        obstacle_map = self.obstacle_manager.get_obstacle_map()
-        start_row, start_col = position
-        if obstacle_map[start_row, start_col]:
-            return 0
-
-        visited = np.zeros((self.height, self.width), dtype=bool)
-        queue = deque()
-        queue.append((start_row, start_col, 0))
-        visited[start_row, start_col] = True
-
-        while queue:
-            row, col, dist = queue.popleft()
-            for d_row, d_col in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-                n_row, n_col = row + d_row, col + d_col
-                if n_row < 0 or n_row >= self.height or n_col < 0 or n_col >= self.width:
-                    continue
-                if visited[n_row, n_col]:
-                    continue
-                if obstacle_map[n_row, n_col]:
-                    return dist + 1
-                visited[n_row, n_col] = True
-                queue.append((n_row, n_col, dist + 1))
-        return None
-
-    def _nearest_unvisited_distance(self, position: Tuple[int, int]) -> Optional[int]:
-        obstacle_map = self.obstacle_manager.get_obstacle_map()
-        start_row, start_col = position
-        if not self.visited_map[start_row, start_col]:
-            return 0
-
-        visited = np.zeros((self.height, self.width), dtype=bool)
-        queue = deque()
-        queue.append((start_row, start_col, 0))
-        visited[start_row, start_col] = True
-
-        while queue:
-            row, col, dist = queue.popleft()
-            for d_row, d_col in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-                n_row, n_col = row + d_row, col + d_col
-                if n_row < 0 or n_row >= self.height or n_col < 0 or n_col >= self.width:
-                    continue
-                if visited[n_row, n_col] or obstacle_map[n_row, n_col]:
-                    continue
-                if not self.visited_map[n_row, n_col]:
-                    return dist + 1
-                visited[n_row, n_col] = True
-                queue.append((n_row, n_col, dist + 1))
-        return None
+    def _primitive_step(self, actions: np.ndarray) -> Tuple[np.ndarray, bool, bool, Tuple[int, int, int, np.ndarray]]:
+        """Advance every UAV one cell; returns rewards, done flags and step counts.
+
+        The counts are ``(collisions, obstacle_hits, primitive_steps,
+        energy_used)``. ``self._last_events`` keeps the UAV masks that end a
+        macro-action.
+        """
+        rewards = np.zeros(self.num_uavs, dtype=np.float32)
+        positions = self.uav_positions
+        alive = self.uav_energy > 0
+
+        targets = positions + ACTION_DELTAS[actions]
+        neighbours = self._neighbours(positions[:, 0] * self.width + positions[:, 1], actions)
+        blocked = alive & (neighbours < 0)
+        rewards[blocked] += self.reward_obstacle
+        self._register_no_progress(blocked, rewards)
+
+        attempted = np.where((alive & ~blocked)[:, None], targets, positions)
+        cells = attempted[:, 0] * self.width + attempted[:, 1]
+        np.add.at(self._occupancy, cells, 1)
+        collided = alive & (self._occupancy[cells] > 1)
+        self._occupancy[cells] = 0
+        rewards[collided] += self.reward_collision
+        self._register_no_progress(collided, rewards)
+
+        landed = alive & ~collided
+        self.uav_positions = np.where(landed[:, None], attempted, positions)
+        self.uav_energy[landed] = np.maximum(0, self.uav_energy[landed] - 1)
+
+        rows, cols = self.uav_positions[:, 0], self.uav_positions[:, 1]
+        fresh = landed & ~self._visited_at(rows, cols)
+        if fresh.any():
+            bonus = new_cell_rewards(
+                fresh, np.asarray(self._remaining_count), self.reward_new_cell_base, max(self.height, self.width)
+            )
+            rewards[fresh] += bonus[fresh]
+            self.no_progress_steps[fresh] = 0
+
+        stale = landed & ~fresh
+        rewards[stale] += self.reward_visited_cell
+        self._register_no_progress(stale, rewards)
+
+        idle = (self.uav_energy > 0) & ~fresh & ~blocked & ~collided & ~stale
+        self._register_no_progress(idle, rewards, gentle=True)
+
+        newly_visited = cells[fresh]
+        self._mark_visited(rows[fresh], cols[fresh])
+        self.visited_count += len(newly_visited)
+        self._remaining_count -= len(newly_visited)
+        self.frontier_field.remove_sources(newly_visited.tolist())
+        if self._map_layers is not None:
+            self._visited_layer[rows[fresh], cols[fresh]] = self._obs_high
+
+        if self.obstacle_manager.obstacle_type == "dynamic":
+            self._move_obstacles()
+
+        # Potential-based shaping reward
+        potential_new = self._state_potentials().astype(np.float32)
+        apply_shaping(rewards, self.prev_potential, potential_new, self.uav_energy > 0, self.shaping_weight)
+
+        self.step_count += 1
+        self.episode_reward += float(rewards.sum())
+
+        terminated = self._is_covered()
+        truncated = self.step_count >= self.max_steps or np.all(self.uav_energy <= 0)
+
+        if terminated:
+            rewards += self.reward_complete / self.num_uavs
+        if self.debug_counters:
+            self._check_counters()
+
+        self._last_events = fresh | blocked | collided | (landed & (self.uav_energy == 0))
+        counts = (int(collided.sum()), int(blocked.sum()), 1, landed.astype(int))
+        return rewards, terminated, truncated, counts
+
+    def _macro_step(self, actions: np.ndarray) -> Tuple[np.ndarray, bool, bool, Tuple[int, int, int, np.ndarray]]:
+        """Repeat the joint move until a UAV reaches a new cell or is about to stop.
+
+        The macro-action ends after the primitive step in which any UAV
+        claims an unvisited cell, hits something or runs out of energy, and
+        before one in which a UAV would move into an obstacle, off the map or
+        into another UAV. It never runs more than ``max_macro_steps``
+        primitive steps. Rewards, collisions, hits and energy are summed over
+        the primitive steps.
+        """
+        rewards = np.zeros(self.num_uavs, dtype=np.float32)
+        energy_used = np.zeros(self.num_uavs, dtype=int)
+        collisions = obstacle_hits = steps = 0
+        while True:
+            step_rewards, terminated, truncated, counts = self._primitive_step(actions)
+            rewards += step_rewards
+            collisions += counts[0]
+            obstacle_hits += counts[1]
+            energy_used += counts[3]
+            steps += 1
+            if terminated or truncated or steps >= self.max_macro_steps or self._last_events.any():
+                break
+            alive = self.uav_energy > 0
+            cells = self.uav_positions[:, 0] * self.width + self.uav_positions[:, 1]
+            targets = self._neighbours(cells, actions)
+            if (alive & (targets < 0)).any():
+                break
+            targets = np.where(alive, targets, cells)
+            meets = (targets[:, None] == cells[None, :]) | (targets[:, None] == targets[None, :])
+            np.fill_diagonal(meets, False)
+            if meets.any():
+                break
+        return rewards, terminated, truncated, (collisions, obstacle_hits, steps, energy_used)
+
+
+    def get_state(self, out: Optional[EnvState] = None) -> EnvState:
+        """Capture the mutable episode state, writing into ``out`` when given.
+
+        Reusing one ``EnvState`` per slot makes a snapshot a handful of array
+        copies with no allocation, which lets planners branch from a state
+        thousands of times per second.
+        """
+        visited = self.visited_map.words if isinstance(self.visited_map, PackedBitMap) else self.visited_map
+        field = self.frontier_field
+        if out is None:
+            out = EnvState(
+                visited=np.empty_like(visited),
+                uav_positions=np.empty_like(self.uav_positions),
+                uav_energy=np.empty_like(self.uav_energy),
+                no_progress_steps=np.empty_like(self.no_progress_steps),
+                prev_potential=np.empty_like(self.prev_potential),
+                frontier_sources=np.empty_like(field._sources),
+                frontier_passable=np.empty_like(field._passable),
+                frontier_dist=np.empty_like(field._dist),
+                observation=np.empty_like(self._obs_buffer),
+                map_layers=None if self._map_layers is None else np.empty_like(self._map_layers),
+                uav_cells=self._uav_cells,
+                obstacles=self.obstacle_manager.get_state(),
+            )
+        else:
+            # A changed mover count makes ``get_state`` allocate a new snapshot.
+            out.obstacles = self.obstacle_manager.get_state(out.obstacles)
+        out.visited[...] = visited
+        out.uav_positions[...] = self.uav_positions
+        out.uav_energy[...] = self.uav_energy
+        out.no_progress_steps[...] = self.no_progress_steps
+        out.prev_potential[...] = self.prev_potential
+        out.frontier_sources[...] = field._sources
+        out.frontier_passable[...] = field._passable
+        out.frontier_dist[...] = field._dist
+        out.observation[...] = self._obs_buffer
+        if self.observation_mode == "local" and self._map_layers is not None:
+            out.map_layers[...] = self._map_layers
+        # Replaced, never modified in place, by ``_get_observation``.
+        out.uav_cells = self._uav_cells
+        out.step_count = self.step_count
+        out.visited_count = self.visited_count
+        out.episode_reward = self.episode_reward
+        out.remaining_count = self._remaining_count
+        out.unreachable_count = self._unreachable_count
+        out.valid_cells = self.valid_cells
+        out.reachable_cells = self.reachable_cells
+        out.rng_state = self.rng.bit_generator.state
+        return out
+
+    def set_state(self, state: EnvState) -> np.ndarray:
+        """Restore a snapshot taken with ``get_state`` and return its observation."""
+        if isinstance(self.visited_map, PackedBitMap):
+            self.visited_map.words[...] = state.visited
+        else:
+            self.visited_map[...] = state.visited
+        self.uav_positions[...] = state.uav_positions
+        self.uav_energy[...] = state.uav_energy
+        self.no_progress_steps[...] = state.no_progress_steps
+        self.prev_potential[...] = state.prev_potential
+        field = self.frontier_field
+        field._sources[...] = state.frontier_sources
+        field._passable[...] = state.frontier_passable
+        field._dist[...] = state.frontier_dist
+        self._restore_obstacles(state.obstacles)
+        self._obs_buffer[...] = state.observation
+        if self.observation_mode == "local" and self._map_layers is not None:
+            self._map_layers[...] = state.map_layers
+        self._uav_cells = state.uav_cells
+        self.step_count = state.step_count
+        self.visited_count = state.visited_count
+        self.episode_reward = state.episode_reward
+        self._remaining_count = state.remaining_count
+        self._unreachable_count = state.unreachable_count
+        self.valid_cells = state.valid_cells
+        self.reachable_cells = state.reachable_cells
+        self.rng.bit_generator.state = state.rng_state
+        if self.reuse_observation_buffer:
+            return self._obs_buffer
+        return self._obs_buffer.copy()
+
+    def _restore_obstacles(self, state: ObstacleState) -> None:
+        """Restore the obstacle snapshot and bring the neighbour table in line with it.
+
+        The table only covers static obstacles, so snapshots that differ in
+        mover positions alone leave it as it is.
+        """
+        self.obstacle_manager.set_state(state)
+        if self._table_version != state.map_version:
+            self._build_neighbour_table()
+
+    def _state_potentials(self) -> np.ndarray:
+        """Shaping potential of every UAV: minus the frontier distance plus weighted clearance."""
+        rows, cols = self.uav_positions[:, 0], self.uav_positions[:, 1]
+        distance = self.frontier_field.lookup(rows, cols)
+        clearance = self.obstacle_manager.clearance_at(rows, cols)
+        return shaping_potential(distance, clearance, self.obstacle_shaping_weight)
+
+    def _move_obstacles(self) -> None:
+        """Advance dynamic obstacles and patch state for the cells they changed."""
+        uav_cells = self.uav_positions[:, 0] * self.width + self.uav_positions[:, 1]
+        vacated, occupied = self.obstacle_manager.update_dynamic(forbidden=uav_cells)
+        if not len(vacated):
+            return
+        vacated_rows, vacated_cols = np.divmod(vacated, self.width)
+        occupied_rows, occupied_cols = np.divmod(occupied, self.width)
+        if self._map_layers is not None:
+            self._obstacle_layer[vacated_rows, vacated_cols] = 0
+            self._obstacle_layer[occupied_rows, occupied_cols] = self._obs_high
+        # Uncovered cells freed by an obstacle become frontier again. As many
+        # cells are vacated as occupied, so only the visited ones tip the count.
+        vacated_visited = self._visited_at(vacated_rows, vacated_cols)
+        occupied_visited = self._visited_at(occupied_rows, occupied_cols)
+        self.frontier_field.unblock(vacated[~vacated_visited].tolist(), source=True)
+        self.frontier_field.unblock(vacated[vacated_visited].tolist())
+        self.frontier_field.block(occupied.tolist())
+        self._remaining_count += int(np.count_nonzero(occupied_visited)) - int(np.count_nonzero(vacated_visited))
 
     def _register_no_progress(
-        self, idx: int, rewards: np.ndarray, gentle: bool = False
+        self, mask: np.ndarray, rewards: np.ndarray, gentle: bool = False
     ) -> None:
-        self.no_progress_steps[idx] += 1
-        if self.no_progress_steps[idx] >= self.no_progress_patience:
-            penalty = self.reward_no_progress if not gentle else self.reward_no_progress * 0.5
-            rewards[idx] += penalty
-            self.no_progress_steps[idx] = 0
-
-    def _initial_positions(self) -> List[Tuple[int, int]]:
-        obstacle_map = self.obstacle_manager.get_obstacle_map()
+        penalty = self.reward_no_progress if not gentle else self.reward_no_progress * 0.5
+        register_no_progress(self.no_progress_steps, mask, rewards, self.no_progress_patience, penalty)
+
+    def _neighbours(self, cells: np.ndarray, actions: np.ndarray) -> np.ndarray:
+        """Flat index reached from ``cells`` by ``actions``, -1 if the move is blocked.
+
+        The table answers for the map edge and static obstacles; moving
+        obstacles are looked up at the few cells the moves enter.
+        """
+        open_move = open_move_mask(self._open_moves[cells], actions)
+        targets = cells + self._move_offsets[actions]
+        manager = self.obstacle_manager
+        if len(manager.dynamic_positions):
+            # Closed moves read their own (in-bounds) cell instead.
+            open_move &= ~manager.obstacles_at_cells(np.where(open_move, targets, cells))
+        return np.where(open_move, targets, -1)
+
+    def _build_neighbour_table(self, free: Optional[np.ndarray] = None) -> None:
+        """Set the open-move bits of every cell from the static obstacles."""
+        if free is None:
+            free = ~self.obstacle_manager.get_static_obstacle_map()
+        moves = self._open_moves.reshape(self.height, self.width)
+        moves.fill(0)
+        for action, (d_row, d_col) in enumerate(ACTION_DELTAS):
+            # Cells whose move stays on the map, and the cells those moves enter.
+            rows = slice(max(0, -d_row), self.height - max(0, d_row))
+            cols = slice(max(0, -d_col), self.width - max(0, d_col))
+            target_rows = slice(max(0, d_row), self.height - max(0, -d_row))
+            target_cols = slice(max(0, d_col), self.width - max(0, -d_col))
+            moves[rows, cols] |= free[target_rows, target_cols].astype(np.uint8) << action
+        self._table_version = self.obstacle_manager.map_version
+
+    def _available_actions(self) -> np.ndarray:
+        """(U, 4) mask of moves that stay on the map and off obstacles.
+
+        A UAV with no such move gets an all-true row, so masked action
+        selection always has a choice.
+        """
+        cells = self.uav_positions[:, 0] * self.width + self.uav_positions[:, 1]
+        available = self._neighbours(cells[:, None], np.arange(len(Action))) >= 0
+        available[~available.any(axis=-1)] = True
+        return available
+
+    def _initial_positions(self) -> np.ndarray:
+        obstacle_map = self.obstacle_manager.get_obstacle_view()
         free_cells = np.argwhere(~obstacle_map)
         if len(free_cells) < self.num_uavs:
             raise RuntimeError("Not enough free cells for UAV initialisation")
         indices = self.rng.choice(len(free_cells), size=self.num_uavs, replace=False)
-        positions = [tuple(free_cells[i]) for i in indices]
-        return positions
-
-    def _action_to_delta(self, action: Action) -> Tuple[int, int]:
-        if action == Action.UP:
-            return -1, 0
-        if action == Action.DOWN:
-            return 1, 0
-        if action == Action.LEFT:
-            return 0, -1
-        if action == Action.RIGHT:
-            return 0, 1
-        raise ValueError(f"Unsupported action: {action}")
-
-    def _is_invalid_cell(self, row: int, col: int) -> bool:
-        if row < 0 or row >= self.height or col < 0 or col >= self.width:
-            return True
-        return self.obstacle_manager.is_obstacle(row, col)
+        return free_cells[indices].astype(np.int64)
+
+    def _analyse_reachability(self, positions: np.ndarray) -> None:
+        """Find free cells no UAV can reach and count or repair them per ``coverage_cells``."""
+        manager = self.obstacle_manager
+        unreachable_count = 0
+        labels, count = manager.free_components
+        if count > 1:
+            # Label 0 marks static obstacles; movers sit on labelled cells.
+            started = np.zeros(count + 1, dtype=bool)
+            started[0] = True
+            started[labels[positions[:, 0], positions[:, 1]]] = True
+            unreachable = ~started[labels]
+            movers = manager.dynamic_positions
+            unreachable[movers[:, 0], movers[:, 1]] = False
+            if self.coverage_cells == "repair":
+                manager.fill_cells(unreachable)
+            else:
+                unreachable_count = int(unreachable.sum())
+        self.reachable_cells = self.total_cells - manager.obstacle_count - unreachable_count
+        # Under "all" unreachable cells still count as remaining.
+        self._unreachable_count = unreachable_count if self.coverage_cells == "reachable" else 0
+        self.valid_cells = self.total_cells - manager.obstacle_count - self._unreachable_count
+
+    def _draw_scenario(self) -> np.ndarray:
+        """Load a random bank scenario's map and return its start positions."""
+        obstacle_map, starts, clearance = self.scenario_bank[int(self.rng.integers(len(self.scenario_bank)))]
+        self.obstacle_manager.load_map(obstacle_map, clearance)
+        return starts[: self.num_uavs].astype(np.int64)
+
+    def _new_visited_map(self) -> np.ndarray | PackedBitMap:
+        if self.map_backend == "packed":
+            return PackedBitMap(self.height, self.width)
+        return np.zeros((self.height, self.width), dtype=bool)
+
+    def _visited_at(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        if isinstance(self.visited_map, PackedBitMap):
+            return self.visited_map.get_many(rows, cols)
+        return self.visited_map[rows, cols]
+
+    def _mark_visited(self, rows: np.ndarray, cols: np.ndarray) -> None:
+        if isinstance(self.visited_map, PackedBitMap):
+            self.visited_map.set_many(rows, cols)
+        else:
+            self.visited_map[rows, cols] = True
+
+    def _dense_visited_map(self) -> np.ndarray:
+        if isinstance(self.visited_map, PackedBitMap):
+            return self.visited_map.to_dense()
+        return self.visited_map
 
     def _remaining_free_cells(self) -> int:
-        obstacle_map = self.obstacle_manager.get_obstacle_map()
+        """Full-map count of the cells behind ``_remaining_count``."""
+        # Unreachable cells are never visited, so they are all still counted here.
+        if isinstance(self.visited_map, PackedBitMap):
+            return count_unset(self.visited_map, self.obstacle_manager.obstacle_map) - self._unreachable_count
+        obstacle_map = self.obstacle_manager.get_obstacle_view()
         remaining = np.logical_not(np.logical_or(obstacle_map, self.visited_map))
-        return int(remaining.sum())
+        return int(remaining.sum()) - self._unreachable_count
 
     def _is_covered(self) -> bool:
-        obstacle_map = self.obstacle_manager.get_obstacle_map()
-        return np.all(np.logical_or(self.visited_map, obstacle_map))
+        return self._remaining_count == 0
+
+    def _check_counters(self) -> None:
+        """Compare the running counters with full-map reductions."""
+        manager = self.obstacle_manager
+        expected = {
+            "remaining": self._remaining_free_cells(),
+            "valid_cells": self.total_cells - manager.obstacle_count - self._unreachable_count,
+            "visited": int(self._dense_visited_map().sum()),
+            "obstacles": int(manager.get_obstacle_view().sum()),
+        }
+        actual = {
+            "remaining": self._remaining_count,
+            "valid_cells": self.valid_cells,
+            "visited": self.visited_count,
+            "obstacles": manager.obstacle_count,
+        }
+        for name, value in expected.items():
+            if actual[name] != value:
+                raise RuntimeError(f"{name} counter is {actual[name]}, full recount gives {value}")
+
+    def _reset_observation(self, obstacles: Optional[np.ndarray] = None) -> None:
+        """Rewrite every map layer of the observation buffer."""
+        self._uav_cells = np.zeros((0, 2), dtype=np.int64)
+        if self._map_layers is None:
+            return
+        if obstacles is None:
+            obstacles = self.obstacle_manager.get_obstacle_view()
+        if self.observation_mode == "local":
+            # Out-of-map cells read as obstacles.
+            self._padded_layers.fill(0)
+            self._padded_layers[1] = self._obs_high
+        self._visited_layer[...] = self._dense_visited_map() * self._obs_high
+        self._obstacle_layer[...] = obstacles * self._obs_high
+        self._uav_layer.fill(0)
 
     def _get_observation(self) -> np.ndarray:
-        visited_layer = self.visited_map.astype(np.float32)
-        obstacle_layer = self.obstacle_manager.get_obstacle_map().astype(np.float32)
-        uav_layer = np.zeros((self.height, self.width), dtype=np.float32)
-        for row, col in self.uav_positions:
-            uav_layer[row, col] = 1.0
-        maps = np.stack([visited_layer, obstacle_layer, uav_layer], axis=0).reshape(-1)
-
-        coverage = self.visited_count / max(1, self.total_cells)
-        scalars: List[float] = [coverage]
-        for idx, (row, col) in enumerate(self.uav_positions):
-            scalars.extend([
-                row / (self.height - 1 + 1e-8),
-                col / (self.width - 1 + 1e-8),
-                self.uav_energy[idx] / max(1, self.energy_budget),
-            ])
-        return np.concatenate([maps, np.array(scalars, dtype=np.float32)], axis=0)
+        """Update the dynamic parts of the observation buffer and return it.
+
+        The visited and obstacle layers are maintained incrementally by
+        ``reset``/``step``; only UAV cells, local windows and scalars are
+        written here.
+        """
+        positions = self.uav_positions
+        if self._map_layers is not None:
+            self._uav_layer[self._uav_cells[:, 0], self._uav_cells[:, 1]] = 0
+            self._uav_cells = positions.copy()
+            self._uav_layer[positions[:, 0], positions[:, 1]] = self._obs_high
+
+        if self.observation_mode == "local":
+            if self._map_layers is None:
+                self._read_packed_windows(positions)
+            else:
+                windows = self._windows[:, positions[:, 0], positions[:, 1]]
+                self._local_maps[...] = windows.transpose(1, 0, 2, 3)
+            self._scalar_obs[...] = self._quantise(self._local_scalars())
+        else:
+            self._scalar_obs[:] = self._quantise(self._global_scalars())
+
+        if self.reuse_observation_buffer:
+            return self._obs_buffer
+        return self._obs_buffer.copy()
+
+    def _read_packed_windows(self, positions: np.ndarray) -> None:
+        """Fill the local windows from the packed visited and obstacle maps."""
+        rows, cols = np.broadcast_arrays(
+            positions[:, 0, None, None] + self._window_offsets[:, None],
+            positions[:, 1, None, None] + self._window_offsets[None, :],
+        )
+        inside = (rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width)
+        rows, cols = rows[inside], cols[inside]
+        visited = np.zeros(inside.shape, dtype=bool)
+        visited[inside] = self.visited_map.get_many(rows, cols)
+        # Out-of-map cells read as obstacles.
+        obstacles = np.ones(inside.shape, dtype=bool)
+        obstacles[inside] = self.obstacle_manager.obstacle_map.get_many(rows, cols)
+        uavs = np.zeros(inside.shape, dtype=bool)
+        uavs[inside] = np.isin(rows * self.width + cols, positions[:, 0] * self.width + positions[:, 1])
+        self._local_maps[:, 0] = visited * self._obs_high
+        self._local_maps[:, 1] = obstacles * self._obs_high
+        self._local_maps[:, 2] = uavs * self._obs_high
+
+    def global_state(self) -> np.ndarray:
+        """Return a fresh copy of the global observation vector.
+
+        Identical to the ``"global"`` observation; in local mode this is the
+        state input for centralised components such as the QMIX mixer.
+        """
+        if self.observation_mode == "global":
+            return self._obs_buffer.copy()
+        map_obs_size = self.height * self.width * 3
+        state = np.empty(self.state_dim, dtype=self.observation_dtype)
+        layers = state[:map_obs_size].reshape(3, self.height, self.width)
+        if self._map_layers is None:
+            layers[0] = self._dense_visited_map() * self._obs_high
+            layers[1] = self.obstacle_manager.get_obstacle_view() * self._obs_high
+            layers[2] = 0
+            layers[2][self.uav_positions[:, 0], self.uav_positions[:, 1]] = self._obs_high
+        else:
+            layers[...] = self._map_layers
+        state[map_obs_size:] = self._quantise(self._global_scalars())
+        return state
+
+    def render_global_states(
+        self,
+        visited: np.ndarray,
+        obstacles: np.ndarray,
+        positions: np.ndarray,
+        energy: np.ndarray,
+        dtype: Optional[np.dtype] = None,
+    ) -> np.ndarray:
+        """Build global states for many frames at once.
+
+        ``visited`` is (..., H, W) and ``obstacles`` broadcasts against it;
+        ``positions`` is (..., U, 2) and ``energy`` (..., U). The result has
+        shape (..., state_dim) and matches what :meth:`global_state` returns
+        for the same frame. ``dtype`` (float32 or uint8) overrides the
+        observation dtype; uint8 output is quantised as ``observation_dtype
+        = "uint8"`` would be.
+        """
+        dtype = self.observation_dtype if dtype is None else np.dtype(dtype)
+        quantised = dtype == np.uint8
+        high = 255 if quantised else 1.0
+        lead = visited.shape[:-2]
+        cells = self.height * self.width
+        states = np.zeros(lead + (self.state_dim,), dtype=dtype)
+        layers = states[..., : 3 * cells].reshape(lead + (3, cells))
+        visited = visited.reshape(lead + (cells,))
+        layers[..., 0, :] = visited
+        layers[..., 1, :] = np.broadcast_to(obstacles, lead + obstacles.shape[-2:]).reshape(lead + (cells,))
+        flat_uav = positions[..., 0].astype(np.intp) * self.width + positions[..., 1]
+        np.put_along_axis(layers[..., 2, :], flat_uav, 1, axis=-1)
+        if quantised:
+            layers *= high
+
+        scalars = np.empty(lead + (self.num_uavs, 3), dtype=np.float64)
+        scalars[..., 0] = positions[..., 0] / (self.height - 1 + 1e-8)
+        scalars[..., 1] = positions[..., 1] / (self.width - 1 + 1e-8)
+        scalars[..., 2] = energy / max(1, self.energy_budget)
+        values = np.empty(lead + (1 + self.num_uavs * 3,), dtype=np.float32)
+        values[..., 0] = np.count_nonzero(visited, axis=-1) / max(1, self.total_cells)
+        values[..., 1:] = scalars.reshape(lead + (-1,))
+        if quantised:
+            values = np.clip(np.rint(values * np.float32(high)), 0, 255)
+        states[..., 3 * cells:] = values
+        return states
+
+    def _quantise(self, values: np.ndarray) -> np.ndarray:
+        if self.observation_dtype == np.uint8:
+            return np.clip(np.rint(values * np.float32(255.0)), 0, 255)
+        return values
+
+    def _global_scalars(self) -> np.ndarray:
+        positions = self.uav_positions
+        scalars = np.empty((self.num_uavs, 3), dtype=np.float64)
+        scalars[:, 0] = positions[:, 0] / (self.height - 1 + 1e-8)
+        scalars[:, 1] = positions[:, 1] / (self.width - 1 + 1e-8)
+        scalars[:, 2] = self.uav_energy / max(1, self.energy_budget)
+        values = np.empty(1 + self.num_uavs * 3, dtype=np.float32)
+        values[0] = self.visited_count / max(1, self.total_cells)
+        values[1:] = scalars.reshape(-1)
+        return values
+
+    def _local_scalars(self) -> np.ndarray:
+        """(U, LOCAL_SCALAR_SIZE) per-agent scalars for local observations."""
+        positions = self.uav_positions
+        direction, distance = self._frontier_direction()
+        scalars = np.empty((self.num_uavs, LOCAL_SCALAR_SIZE), dtype=np.float64)
+        scalars[:, 0] = positions[:, 0] / (self.height - 1 + 1e-8)
+        scalars[:, 1] = positions[:, 1] / (self.width - 1 + 1e-8)
+        scalars[:, 2] = self.uav_energy / max(1, self.energy_budget)
+        scalars[:, 3] = self.visited_count / max(1, self.total_cells)
+        scalars[:, 4:6] = (direction + 1) / 2
+        scalars[:, 6] = distance
+        return scalars.astype(np.float32)
+
+    def _frontier_direction(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Unit step towards the nearest unvisited cell and the normalised distance.
+
+        The step follows the frontier distance field downhill; UAVs with no
+        reachable unvisited cell get a zero step and distance 1.
+        """
+        positions = self.uav_positions
+        here = self.frontier_field.lookup(positions[:, 0], positions[:, 1])
+        neighbours = positions[:, None, :] + ACTION_DELTAS[None]
+        rows, cols = neighbours[..., 0], neighbours[..., 1]
+        inside = (rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width)
+        distances = np.full(rows.shape, IncrementalDistanceField.INF, dtype=np.int64)
+        distances[inside] = self.frontier_field.lookup(rows[inside], cols[inside])
+        distances[distances == UNREACHABLE] = IncrementalDistanceField.INF
+        best = distances.argmin(axis=1)
+
+        reachable = here > 0
+        direction = np.where(reachable[:, None], ACTION_DELTAS[best], 0)
+        scale = self.height + self.width
+        distance = np.where(reachable, np.minimum(here, scale) / scale, 1.0)
+        return direction, distance
 
     def _get_info(self) -> Dict[str, Any]:
-        coverage = self.visited_count / max(1, self.total_cells)
+        coverage_total = self.total_cells if self.coverage_cells == "all" else self.valid_cells
         return {
-            "coverage": coverage,
+            "coverage": self.visited_count / max(1, coverage_total),
+            "coverage_total": coverage_total,
+            "reachable_coverage": self.visited_count / max(1, self.reachable_cells),
+            "valid_cells": self.valid_cells,
             "steps": self.step_count,
             "energy": self.uav_energy.copy(),
             "visited_cells": self.visited_count,
             "visited_count": self.visited_count,
-            "remaining_free_cells": self._remaining_free_cells(),
+            "remaining_free_cells": self._remaining_count,
+            "avail_actions": self._available_actions(),
         }
 
     def render(self) -> None:
         grid = np.full((self.height, self.width), CellType.UNVISITED, dtype=int)
-        grid[self.visited_map] = CellType.VISITED
-        obstacle_map = self.obstacle_manager.get_obstacle_map()
+        grid[self._dense_visited_map()] = CellType.VISITED
+        obstacle_map = self.obstacle_manager.get_obstacle_view()
         grid[obstacle_map] = CellType.OBSTACLE
         for row, col in self.uav_positions:
             grid[row, col] = CellType.UAV
@@ -1,8 +1,71 @@
 ﻿"""Obstacle generation and management for grid world."""
-from typing import List, Optional, Tuple
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 
+from src.envs.bitmap import PackedBitMap
+from src.envs.distance_fields import UNREACHABLE, label_components, obstacle_clearance
+
+MAP_BACKENDS = ("dense", "packed")
+MOTION_MODELS = ("random_walk", "bounce")
+# Obstacle clearance only shapes rewards up to this distance.
+CLEARANCE_LIMIT = 5
+# Row/column offsets for up, down, left, right; ``heading ^ 1`` reverses a heading.
+_MOVES = np.array([(-1, 0), (1, 0), (0, -1), (0, 1)], dtype=np.int64)
+# Offsets closer than CLEARANCE_LIMIT (Manhattan), for windowed clearance queries.
+_NEAR = np.array(
+    [
+        (d_row, d_col)
+        for d_row in range(1 - CLEARANCE_LIMIT, CLEARANCE_LIMIT)
+        for d_col in range(1 - CLEARANCE_LIMIT, CLEARANCE_LIMIT)
+        if abs(d_row) + abs(d_col) < CLEARANCE_LIMIT
+    ],
+    dtype=np.int64,
+)
+_NEAR_DISTANCE = np.abs(_NEAR).sum(axis=1)
+# Ticks of motion randomness drawn per generator call.
+_DRAW_BLOCK = 256
+
+
+def sample_obstacle_maps(
+    rng: np.random.Generator,
+    count: int,
+    map_size: Tuple[int, int],
+    obstacle_density: float,
+) -> np.ndarray:
+    """Draw ``count`` (H, W) obstacle maps, each with ``int(H * W * density)`` obstacles.
+
+    Obstacle cells are the smallest of per-cell random keys, so every map is a
+    uniform sample without replacement and the whole batch is one array op.
+    """
+    height, width = map_size
+    maps = np.zeros((count, height * width), dtype=bool)
+    num_obstacles = min(int(height * width * obstacle_density), height * width)
+    if num_obstacles > 0:
+        keys = rng.random((count, height * width))
+        cells = np.argpartition(keys, num_obstacles - 1, axis=1)[:, :num_obstacles]
+        np.put_along_axis(maps, cells, True, axis=1)
+    return maps.reshape(count, height, width)
+
+
+@dataclass
+class ObstacleState:
+    """Snapshot of an ``ObstacleManager``'s mutable state, see ``get_state``."""
+
+    obstacle_map: np.ndarray
+    padded_map: Optional[np.ndarray]
+    clearance_field: np.ndarray
+    obstacle_count: int
+    dynamic_positions: np.ndarray
+    headings: np.ndarray
+    move_draws: np.ndarray
+    heading_draws: np.ndarray
+    draw_index: int
+    rng_state: Dict[str, Any]
+    components: Optional[Tuple[np.ndarray, int]] = None
+    map_version: int = 0
+
 
 class ObstacleManager:
     """Manages obstacles in the grid world."""
@@ -13,35 +76,147 @@ class ObstacleManager:
         obstacle_density: float = 0.0,
         obstacle_type: str = "static",
         seed: Optional[int] = None,
+        map_backend: str = "dense",
+        motion_model: str = "random_walk",
+        dynamic_fraction: float = 0.1,
+        move_probability: float = 0.5,
     ) -> None:
-        """Initialise obstacle manager."""
+        """Initialise obstacle manager.
+
+        With ``map_backend="packed"`` the obstacle map is held as a
+        ``PackedBitMap``; dense accessors unpack it on demand.
+
+        For ``obstacle_type="dynamic"`` a ``dynamic_fraction`` of the
+        obstacles move: each tick every mover steps one cell with
+        ``move_probability``, in a fresh random direction (``"random_walk"``)
+        or along its heading, reversing when blocked (``"bounce"``). Moving
+        maps answer clearance queries from the cells around the query point;
+        the full clearance field is only computed when ``clearance_field`` is
+        read, at most once per tick.
+        """
+        if map_backend not in MAP_BACKENDS:
+            raise ValueError(f"Unsupported map backend: {map_backend}")
+        if motion_model not in MOTION_MODELS:
+            raise ValueError(f"Unsupported motion model: {motion_model}")
         self.map_size = map_size
         self.obstacle_density = obstacle_density
         self.obstacle_type = obstacle_type
+        self.map_backend = map_backend
+        self.motion_model = motion_model
+        self.dynamic_fraction = dynamic_fraction
+        self.move_probability = move_probability
         self.height, self.width = map_size
-
-        if seed is not None:
-            np.random.seed(seed)
+        self.rng = np.random.default_rng(seed)
 
         self.obstacle_map = np.zeros((self.height, self.width), dtype=bool)
-        self.obstacle_positions: List[Tuple[int, int]] = []
+        self.obstacle_count = 0
+        self._padded_map: Optional[np.ndarray] = None
+        self._components: Optional[Tuple[np.ndarray, int]] = None
+        # Whether the clearance field of a moving map predates its last change.
+        self._clearance_stale = True
+        # Bumped whenever the map is replaced or edited outside ``update_dynamic``.
+        self.map_version = 0
+        # Clearance never exceeds H + W, so small maps fit in int16.
+        self._clearance_dtype = np.int16 if self.height + self.width <= np.iinfo(np.int16).max else np.int32
+        self._clearance_field = np.full((self.height, self.width), UNREACHABLE, dtype=self._clearance_dtype)
         self._generate_obstacles()
+        if map_backend == "packed":
+            self.obstacle_map = PackedBitMap.from_dense(self.obstacle_map)
+        self._select_movers()
+        self._on_map_changed()
+
+    def load_map(self, obstacle_map: np.ndarray, clearance_field: Optional[np.ndarray] = None) -> None:
+        """Replace the obstacle map, e.g. with a scenario drawn from a bank.
+
+        ``clearance_field`` may carry the map's precomputed clearance so that
+        static maps skip the BFS.
+        """
+        if isinstance(self.obstacle_map, PackedBitMap):
+            self.obstacle_map.load(obstacle_map)
+        else:
+            self.obstacle_map[...] = obstacle_map
+        self._select_movers()
+        self._on_map_changed(clearance_field)
+
+    def get_state(self, out: Optional[ObstacleState] = None) -> ObstacleState:
+        """Copy the mutable state into ``out`` (allocated when ``None`` or mis-shaped).
+
+        The static clearance field, the component labels and the blocks of
+        pre-drawn motion randomness are replaced rather than modified, so
+        they are shared by reference.
+        """
+        words = self.obstacle_map.words if isinstance(self.obstacle_map, PackedBitMap) else self.obstacle_map
+        if out is None or out.dynamic_positions.shape != self.dynamic_positions.shape:
+            out = ObstacleState(
+                obstacle_map=np.empty_like(words),
+                padded_map=None if self._padded_map is None else np.empty_like(self._padded_map),
+                clearance_field=self._clearance_field,
+                obstacle_count=0,
+                dynamic_positions=np.empty_like(self.dynamic_positions),
+                headings=np.empty_like(self._headings),
+                move_draws=self._move_draws,
+                heading_draws=self._heading_draws,
+                draw_index=0,
+                rng_state={},
+            )
+        out.obstacle_map[...] = words
+        if self._padded_map is not None:
+            out.padded_map[...] = self._padded_map
+        out.clearance_field = self._clearance_field
+        out.obstacle_count = self.obstacle_count
+        out.dynamic_positions[...] = self.dynamic_positions
+        out.headings[...] = self._headings
+        out.move_draws, out.heading_draws = self._move_draws, self._heading_draws
+        out.draw_index = self._draw_index
+        out.components = self._components
+        out.map_version = self.map_version
+        out.rng_state = self.rng.bit_generator.state
+        return out
+
+    def set_state(self, state: ObstacleState) -> None:
+        """Restore a snapshot taken with ``get_state`` on this manager."""
+        if isinstance(self.obstacle_map, PackedBitMap):
+            self.obstacle_map.words[...] = state.obstacle_map
+        else:
+            self.obstacle_map[...] = state.obstacle_map
+        if state.padded_map is not None:
+            self._padded_map[...] = state.padded_map
+        self._clearance_field = state.clearance_field
+        self.obstacle_count = state.obstacle_count
+        if self.dynamic_positions.shape == state.dynamic_positions.shape:
+            self.dynamic_positions[...] = state.dynamic_positions
+            self._headings[...] = state.headings
+        else:
+            self.dynamic_positions = state.dynamic_positions.copy()
+            self._headings = state.headings.copy()
+        self._move_draws, self._heading_draws = state.move_draws, state.heading_draws
+        self._draw_index = state.draw_index
+        self._components = state.components
+        self._clearance_stale = True
+        self.map_version = state.map_version
+        self.rng.bit_generator.state = state.rng_state
+
+    @property
+    def obstacle_positions(self) -> List[Tuple[int, int]]:
+        """Obstacle cells in row-major order."""
+        return [(row, col) for row, col in np.argwhere(self.get_obstacle_view()).tolist()]
 
     def _generate_obstacles(self) -> None:
         """Generate obstacles on the map."""
         if self.obstacle_density <= 0:
             return
+        self.obstacle_map = sample_obstacle_maps(self.rng, 1, self.map_size, self.obstacle_density)[0]
 
-        num_obstacles = int(self.height * self.width * self.obstacle_density)
-        attempts = num_obstacles * 10 if num_obstacles > 0 else 0
-
-        while len(self.obstacle_positions) < num_obstacles and attempts > 0:
-            attempts -= 1
-            row = np.random.randint(0, self.height)
-            col = np.random.randint(0, self.width)
-            if not self.obstacle_map[row, col]:
-                self.obstacle_map[row, col] = True
-                self.obstacle_positions.append((row, col))
+    def _select_movers(self) -> None:
+        """Pick the obstacles that move on dynamic maps."""
+        self.dynamic_positions = np.zeros((0, 2), dtype=np.int64)
+        cells = np.argwhere(self.get_obstacle_view())
+        if self.obstacle_type == "dynamic" and len(cells):
+            count = max(1, int(round(len(cells) * self.dynamic_fraction)))
+            chosen = self.rng.choice(len(cells), size=count, replace=False)
+            self.dynamic_positions = cells[chosen].astype(np.int64)
+        self._headings = self.rng.integers(len(_MOVES), size=len(self.dynamic_positions))
+        self._discard_draws()
 
     def is_obstacle(self, row: int, col: int) -> bool:
         """Check if a cell is an obstacle or out-of-bounds."""
@@ -49,20 +224,227 @@ class ObstacleManager:
             return True
         return bool(self.obstacle_map[row, col])
 
+    def obstacles_at(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """Vectorised ``is_obstacle`` for arrays of coordinates."""
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        blocked = (rows < 0) | (rows >= self.height) | (cols < 0) | (cols >= self.width)
+        inside = ~blocked
+        if isinstance(self.obstacle_map, PackedBitMap):
+            blocked[inside] = self.obstacle_map.get_many(rows[inside], cols[inside])
+        else:
+            blocked[inside] = self.obstacle_map[rows[inside], cols[inside]]
+        return blocked
+
+    def obstacles_at_cells(self, cells: np.ndarray) -> np.ndarray:
+        """``obstacles_at`` for in-bounds flat ``row * width + col`` indices."""
+        if isinstance(self.obstacle_map, PackedBitMap):
+            return self.obstacle_map.get_many(*np.divmod(cells, self.width))
+        return self.obstacle_map.reshape(-1)[cells]
+
     def ensure_connectivity(self, start_positions: List[Tuple[int, int]]) -> None:
         """Ensure starting cells are obstacle-free."""
+        cleared = 0
         for row, col in start_positions:
             if self.is_obstacle(row, col):
                 self.obstacle_map[row, col] = False
-                if (row, col) in self.obstacle_positions:
-                    self.obstacle_positions.remove((row, col))
+                cleared += 1
+        if cleared:
+            dropped = 0
+            if len(self.dynamic_positions):
+                rows, cols = self.dynamic_positions[:, 0], self.dynamic_positions[:, 1]
+                keep = self.obstacles_at(rows, cols)
+                dropped = len(keep) - int(keep.sum())
+                self.dynamic_positions = self.dynamic_positions[keep]
+                self._headings = self._headings[keep]
+                self._discard_draws()
+            # Labels already count mover cells as free, so they survive when
+            # only movers were cleared.
+            self._on_map_changed(components=self._components if dropped == cleared else None)
+
+    def clearance(self, row: int, col: int) -> Optional[int]:
+        """Return the BFS distance from a cell to the nearest obstacle.
+
+        Reads the precomputed clearance field; ``None`` when the map has no
+        obstacles. Dynamic maps scan the cells around ``(row, col)`` instead,
+        so their values saturate at ``CLEARANCE_LIMIT``.
+        """
+        value = int(self.clearance_at(np.array([row]), np.array([col]))[0])
+        return None if value == UNREACHABLE else value
+
+    def clearance_at(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        """Vectorised ``clearance``, ``UNREACHABLE`` on obstacle-free maps."""
+        if self.obstacle_type != "dynamic":
+            return self._clearance_field[rows, cols]
+        if not self.obstacle_count:
+            return np.full(np.shape(rows), UNREACHABLE, dtype=np.int32)
+        near_rows = np.asarray(rows)[:, None] + _NEAR[:, 0]
+        near_cols = np.asarray(cols)[:, None] + _NEAR[:, 1]
+        if self._padded_map is not None:
+            hits = self._padded_map[near_rows + CLEARANCE_LIMIT, near_cols + CLEARANCE_LIMIT]
+        else:
+            # Out-of-bounds cells do not count as obstacles for clearance.
+            inside = (near_rows >= 0) & (near_rows < self.height) & (near_cols >= 0) & (near_cols < self.width)
+            hits = np.zeros(near_rows.shape, dtype=bool)
+            hits[inside] = self.obstacle_map.get_many(near_rows[inside], near_cols[inside])
+        return np.where(hits, _NEAR_DISTANCE, CLEARANCE_LIMIT).min(axis=1).astype(np.int32)
+
+    @property
+    def clearance_field(self) -> np.ndarray:
+        """(H, W) BFS distance to the nearest obstacle, ``UNREACHABLE`` if there is none."""
+        if self.obstacle_type == "dynamic" and self._clearance_stale:
+            # Replaced rather than modified, so earlier snapshots keep their field.
+            self._clearance_field = obstacle_clearance(self.get_obstacle_view()).astype(self._clearance_dtype)
+            self._clearance_stale = False
+        return self._clearance_field
+
+    @property
+    def free_components(self) -> Tuple[np.ndarray, int]:
+        """``label_components`` of the free space, computed once per map.
+
+        Cells under moving obstacles count as free, since movers never wall
+        off a region for good. The labels therefore depend on the static
+        obstacles alone, which ``update_dynamic`` never touches, and stay
+        valid however the movers move.
+        """
+        if self._components is None:
+            self._components = label_components(~self.get_static_obstacle_map())
+        return self._components
+
+    def get_static_obstacle_map(self) -> np.ndarray:
+        """Return a copy of the obstacle map without the moving obstacles."""
+        blocked = self.get_obstacle_map()
+        blocked[self.dynamic_positions[:, 0], self.dynamic_positions[:, 1]] = False
+        return blocked
+
+    def fill_cells(self, mask: np.ndarray) -> None:
+        """Turn the free cells in the (H, W) ``mask`` into static obstacles."""
+        rows, cols = np.nonzero(mask)
+        if not len(rows):
+            return
+        if isinstance(self.obstacle_map, PackedBitMap):
+            self.obstacle_map.set_many(rows, cols)
+        else:
+            self.obstacle_map[rows, cols] = True
+        components = None
+        if self._components is not None:
+            # Filling whole components splits no other one, so their cells
+            # just drop to label 0 instead of the map being relabelled.
+            labels, count = self._components
+            filled = np.bincount(labels[rows, cols], minlength=count + 1)[1:]
+            sizes = np.bincount(labels.reshape(-1), minlength=count + 1)[1:]
+            if np.all((filled == 0) | (filled == sizes)):
+                labels = labels.copy()
+                labels[rows, cols] = 0
+                components = (labels, count)
+        self._on_map_changed(components=components)
+
+    def _on_map_changed(
+        self,
+        clearance_field: Optional[np.ndarray] = None,
+        components: Optional[Tuple[np.ndarray, int]] = None,
+    ) -> None:
+        """Rebuild fields derived from the obstacle map.
+
+        ``components`` may carry labels that are still valid for the new map.
+        """
+        packed = isinstance(self.obstacle_map, PackedBitMap)
+        self.obstacle_count = self.obstacle_map.count() if packed else int(self.obstacle_map.sum())
+        self._components = components
+        self._clearance_stale = True
+        self.map_version += 1
+        if self.obstacle_type != "dynamic":
+            if clearance_field is None:
+                clearance_field = obstacle_clearance(self.get_obstacle_view())
+            self._clearance_field = np.asarray(clearance_field, dtype=self._clearance_dtype)
+        elif not packed:
+            # Obstacle-free margin so windowed clearance queries need no bounds checks.
+            self._padded_map = np.pad(self.obstacle_map, CLEARANCE_LIMIT)
 
     def get_obstacle_map(self) -> np.ndarray:
         """Return a copy of the obstacle map."""
+        if isinstance(self.obstacle_map, PackedBitMap):
+            return self.obstacle_map.to_dense()
         return self.obstacle_map.copy()
 
-    def update_dynamic(self) -> None:
-        """Update dynamic obstacles (placeholder)."""
-        if self.obstacle_type == "dynamic":
-            # TODO: Implement dynamic obstacle behaviour
-            pass
+    def get_obstacle_view(self) -> np.ndarray:
+        """Return a read-only view of the obstacle map (no copy for dense maps)."""
+        if isinstance(self.obstacle_map, PackedBitMap):
+            view = self.obstacle_map.to_dense()
+        else:
+            view = self.obstacle_map.view()
+        view.flags.writeable = False
+        return view
+
+    def update_dynamic(self, forbidden: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Move dynamic obstacles one tick.
+
+        Obstacles only step into free in-bounds cells that are not listed in
+        ``forbidden`` (flat ``row * width + col`` indices, e.g. UAV cells) and
+        that no other obstacle claims this tick.
+
+        Returns:
+            ``(vacated, occupied)`` flat indices of the cells that changed.
+        """
+        empty = np.zeros(0, dtype=np.int64)
+        if self.obstacle_type != "dynamic" or not len(self.dynamic_positions):
+            return empty, empty
+
+        moving, headings = self._next_draws()
+        movers = np.flatnonzero(moving)
+        if not len(movers):
+            return empty, empty
+        if self.motion_model == "random_walk":
+            self._headings[movers] = headings[movers]
+        targets = self.dynamic_positions[movers] + _MOVES[self._headings[movers]]
+        cells = targets[:, 0] * self.width + targets[:, 1]
+        if self._padded_map is not None:
+            # The margin keeps off-map reads in bounds; the edge test rejects them.
+            # Negative coordinates wrap to huge unsigned values, so one test covers every edge.
+            inside = (targets.view(np.uint64) < self.map_size).all(axis=1)
+            free = inside & ~self._padded_map[targets[:, 0] + CLEARANCE_LIMIT, targets[:, 1] + CLEARANCE_LIMIT]
+        else:
+            free = ~self.obstacles_at(targets[:, 0], targets[:, 1])
+        if forbidden is not None and len(forbidden):
+            free &= (cells[:, None] != np.asarray(forbidden)[None, :]).all(axis=1)
+        if self.motion_model == "bounce":
+            self._headings[movers[~free]] ^= 1
+        movers, cells = movers[free], cells[free]
+        if len(movers) > 1:
+            # Lowest-indexed obstacle wins a contested cell.
+            order = np.argsort(cells, kind="stable")
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = cells[order[1:]] != cells[order[:-1]]
+            movers, cells = movers[order[first]], cells[order[first]]
+        if not len(movers):
+            return empty, empty
+
+        old = self.dynamic_positions[movers]
+        new = old + _MOVES[self._headings[movers]]
+        self.dynamic_positions[movers] = new
+        if isinstance(self.obstacle_map, PackedBitMap):
+            self.obstacle_map.clear_many(old[:, 0], old[:, 1])
+            self.obstacle_map.set_many(new[:, 0], new[:, 1])
+        else:
+            self.obstacle_map[old[:, 0], old[:, 1]] = False
+            self.obstacle_map[new[:, 0], new[:, 1]] = True
+            self._padded_map[old[:, 0] + CLEARANCE_LIMIT, old[:, 1] + CLEARANCE_LIMIT] = False
+            self._padded_map[new[:, 0] + CLEARANCE_LIMIT, new[:, 1] + CLEARANCE_LIMIT] = True
+        self._clearance_stale = True
+        return old[:, 0] * self.width + old[:, 1], cells
+
+    def _next_draws(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Per-mover move flags and random headings for one tick."""
+        if self._draw_index == len(self._move_draws):
+            shape = (_DRAW_BLOCK, len(self.dynamic_positions))
+            self._move_draws = self.rng.random(shape) < self.move_probability
+            self._heading_draws = self.rng.integers(len(_MOVES), size=shape)
+            self._draw_index = 0
+        index = self._draw_index
+        self._draw_index += 1
+        return self._move_draws[index], self._heading_draws[index]
+
+    def _discard_draws(self) -> None:
+        self._move_draws = np.zeros((0, len(self.dynamic_positions)), dtype=bool)
+        self._heading_draws = np.zeros((0, len(self.dynamic_positions)), dtype=np.int64)
+        self._draw_index = 0
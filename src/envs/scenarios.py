@@ -0,0 +1,115 @@
+"""Pre-generated scenario banks shared read-only between environments."""
+from __future__ import annotations
+
+import argparse
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+from src.envs.distance_fields import obstacle_clearance
+from src.envs.obstacles import sample_obstacle_maps
+
+MAPS_FILE = "maps.npy"
+STARTS_FILE = "starts.npy"
+CLEARANCE_FILE = "clearance.npy"
+
+
+def generate_scenario_bank(
+    path: Union[str, Path],
+    count: int,
+    map_size: Tuple[int, int],
+    num_uavs: int,
+    obstacle_density: float,
+    seed: Optional[int] = None,
+    chunk_size: int = 1024,
+) -> "ScenarioBank":
+    """Write ``count`` obstacle maps, start positions and clearance fields to ``path``.
+
+    The bank is a directory of ``.npy`` files written through memory maps in
+    chunks, so banks larger than memory can be generated.
+    """
+    height, width = map_size
+    if height * width - int(height * width * obstacle_density) < num_uavs:
+        raise ValueError("Not enough free cells for UAV initialisation")
+    rng = np.random.default_rng(seed)
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    # Clearance never exceeds H + W, so small maps fit in int16.
+    clearance_dtype = np.int16 if height + width <= np.iinfo(np.int16).max else np.int32
+    open_memmap = np.lib.format.open_memmap
+    maps = open_memmap(path / MAPS_FILE, mode="w+", dtype=bool, shape=(count, height, width))
+    starts = open_memmap(path / STARTS_FILE, mode="w+", dtype=np.int16, shape=(count, num_uavs, 2))
+    clearance = open_memmap(path / CLEARANCE_FILE, mode="w+", dtype=clearance_dtype, shape=(count, height, width))
+
+    for begin in range(0, count, chunk_size):
+        end = min(begin + chunk_size, count)
+        chunk = sample_obstacle_maps(rng, end - begin, map_size, obstacle_density)
+        # Start cells: the UAV-count smallest random keys among free cells.
+        keys = np.where(chunk.reshape(end - begin, -1), np.inf, rng.random((end - begin, height * width)))
+        cells = np.argpartition(keys, num_uavs - 1, axis=1)[:, :num_uavs]
+        maps[begin:end] = chunk
+        starts[begin:end] = np.stack(np.divmod(cells, width), axis=-1)
+        clearance[begin:end] = obstacle_clearance(chunk)
+
+    for array in (maps, starts, clearance):
+        array.flush()
+    del maps, starts, clearance
+    return ScenarioBank(path)
+
+
+class ScenarioBank:
+    """Read-only, memory-mapped bank of obstacle maps and UAV start positions.
+
+    Opening a bank maps the files without reading them; every process that
+    opens the same directory shares the page cache.
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+        self.maps = np.load(self.path / MAPS_FILE, mmap_mode="r")
+        self.starts = np.load(self.path / STARTS_FILE, mmap_mode="r")
+        self.clearance = np.load(self.path / CLEARANCE_FILE, mmap_mode="r")
+        if not (len(self.maps) == len(self.starts) == len(self.clearance)):
+            raise ValueError(f"Scenario bank {self.path} has mismatched file lengths")
+        self.map_size: Tuple[int, int] = tuple(self.maps.shape[1:])
+        self.num_uavs = self.starts.shape[1]
+
+    def __len__(self) -> int:
+        return len(self.maps)
+
+    def __getitem__(self, index: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return ``(obstacle_map, start_positions, clearance_field)`` for one scenario."""
+        return self.maps[index], self.starts[index], self.clearance[index]
+
+    def check_compatible(self, map_size: Tuple[int, int], num_uavs: int) -> None:
+        if tuple(map_size) != self.map_size:
+            raise ValueError(f"Scenario bank map size {self.map_size} does not match {tuple(map_size)}")
+        if num_uavs > self.num_uavs:
+            raise ValueError(f"Scenario bank holds {self.num_uavs} start positions, need {num_uavs}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate a scenario bank")
+    parser.add_argument("path")
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--map-size", type=int, nargs=2, default=[12, 12])
+    parser.add_argument("--num-uavs", type=int, default=4)
+    parser.add_argument("--obstacle-density", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    bank = generate_scenario_bank(
+        args.path,
+        count=args.count,
+        map_size=tuple(args.map_size),
+        num_uavs=args.num_uavs,
+        obstacle_density=args.obstacle_density,
+        seed=args.seed,
+    )
+    print(f"Wrote {len(bank)} scenarios to {bank.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,542 @@
+"""Multi-environment engines for the UAV grid world: in-process batched and subprocess."""
+from __future__ import annotations
+
+import multiprocessing as mp
+import os
+import traceback
+from multiprocessing.connection import Connection
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from gymnasium import spaces
+
+from src.envs.distance_fields import DistanceFieldStack
+from src.envs.grid_world import (
+    ACTION_DELTAS,
+    Action,
+    GridWorldEnv,
+    apply_shaping,
+    new_cell_rewards,
+    open_move_mask,
+    register_no_progress,
+    shaping_potential,
+)
+
+
+class BatchedGridWorldEnv:
+    """Steps ``num_envs`` independent ``GridWorldEnv`` instances as one set of arrays.
+
+    Mutable state lives in batched arrays (``visited_maps`` (N, H, W),
+    ``uav_positions`` (N, U, 2), ``uav_energy`` (N, U)) and every step is
+    evaluated with vectorised NumPy operations. Reward, collision and
+    termination semantics match ``GridWorldEnv.step``; environment ``i`` behaves
+    exactly like ``GridWorldEnv(seed=seed + i, **env_kwargs)``.
+
+    Finished environments are reset automatically: the observation returned for
+    them is the first observation of the next episode, while ``info`` still
+    describes the step that ended the episode and carries the terminal
+    observation under ``"final_observation"``. ``info["avail_actions"]``
+    follows the returned observation; the mask for the terminal one is under
+    ``"final_avail_actions"``.
+
+    With a ``scenario_bank`` in ``env_kwargs`` each reset loads the drawn
+    scenario's map and clearance into the batched arrays. The distance to the
+    nearest unvisited cell is kept in each environment's ``frontier_field``
+    and repaired as cells are visited, as ``GridWorldEnv`` does.
+    """
+
+    def __init__(self, num_envs: int, seed: Optional[int] = None, **env_kwargs: Any) -> None:
+        if num_envs < 1:
+            raise ValueError(f"num_envs must be positive, received {num_envs}")
+        if env_kwargs.get("observation_mode", "global") != "global":
+            raise ValueError("BatchedGridWorldEnv only supports global observations")
+        if env_kwargs.get("obstacle_type", "static") == "dynamic":
+            raise ValueError("BatchedGridWorldEnv only supports static obstacles")
+        if env_kwargs.get("action_mode", "primitive") != "primitive":
+            raise ValueError("BatchedGridWorldEnv only supports primitive actions")
+
+        self.num_envs = num_envs
+        self.envs = [
+            GridWorldEnv(seed=None if seed is None else seed + idx, **env_kwargs)
+            for idx in range(num_envs)
+        ]
+        template = self.envs[0]
+
+        self.height, self.width = template.height, template.width
+        self.num_uavs = template.num_uavs
+        self.total_cells = template.total_cells
+        self.max_steps = template.max_steps
+        self.energy_budget = template.energy_budget
+
+        self.reward_new_cell_base = template.reward_new_cell_base
+        self.reward_visited_cell = template.reward_visited_cell
+        self.reward_obstacle = template.reward_obstacle
+        self.reward_collision = template.reward_collision
+        self.reward_complete = template.reward_complete
+        self.reward_no_progress = template.reward_no_progress
+        self.no_progress_patience = template.no_progress_patience
+        self.shaping_weight = template.shaping_weight
+        self.obstacle_shaping_weight = template.obstacle_shaping_weight
+
+        self.single_observation_space = template.observation_space
+        self.single_action_space = template.action_space
+        obs_dim = int(self.single_observation_space.shape[0])
+        self.observation_space = spaces.Box(
+            low=0,
+            high=self.single_observation_space.high.max(),
+            shape=(num_envs, obs_dim),
+            dtype=self.single_observation_space.dtype,
+        )
+        self.action_space = spaces.MultiDiscrete(
+            np.tile(self.single_action_space.nvec, (num_envs, 1))
+        )
+
+        # Open-move bits of every cell, per environment; each env's table is a row view.
+        self.open_moves = np.zeros((num_envs, self.total_cells), dtype=np.uint8)
+        for idx, env in enumerate(self.envs):
+            env._open_moves = self.open_moves[idx]
+
+        # Frontier fields share one block of storage so the potential is read for all envs at once.
+        self.frontier_fields = DistanceFieldStack(num_envs, self.height, self.width)
+        for idx, env in enumerate(self.envs):
+            env.frontier_field = self.frontier_fields.fields[idx]
+
+        self.obstacle_maps = np.stack(
+            [env.obstacle_manager.get_obstacle_map() for env in self.envs]
+        )
+        self.clearance = np.stack(
+            [env.obstacle_manager.clearance_field for env in self.envs]
+        )
+
+        shape = (num_envs, self.num_uavs)
+        self.visited_maps = np.zeros((num_envs, self.height, self.width), dtype=bool)
+        self.uav_positions = np.zeros(shape + (2,), dtype=np.int64)
+        self.uav_energy = np.zeros(shape, dtype=int)
+        self.no_progress_steps = np.zeros(shape, dtype=int)
+        self.prev_potential = np.zeros(shape, dtype=np.float32)
+        self.step_count = np.zeros(num_envs, dtype=int)
+        self.visited_count = np.zeros(num_envs, dtype=int)
+        self.episode_reward = np.zeros(num_envs, dtype=np.float64)
+        self.valid_cells = np.zeros(num_envs, dtype=int)
+        self.reachable_cells = np.zeros(num_envs, dtype=int)
+        # Cell count ``info["coverage"]`` divides by, see ``GridWorldEnv``.
+        self.coverage_total = np.zeros(num_envs, dtype=int)
+
+        self._env_index = np.arange(num_envs)[:, None]
+
+    def reset(
+        self, *, seed: Optional[int] = None
+    ) -> Tuple[np.ndarray, Dict[str, Any]]:
+        if seed is not None:
+            for idx, env in enumerate(self.envs):
+                env.rng = np.random.default_rng(seed + idx)
+        self._reset_envs(np.arange(self.num_envs))
+        return self._get_observation(), self._get_info()
+
+    def step(
+        self, actions: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, Dict[str, Any]]:
+        actions = np.asarray(actions, dtype=np.int64)
+        if actions.shape != (self.num_envs, self.num_uavs):
+            raise ValueError(
+                f"Expected actions of shape {(self.num_envs, self.num_uavs)}, received {actions.shape}"
+            )
+
+        env_idx = self._env_index
+        rewards = np.zeros((self.num_envs, self.num_uavs), dtype=np.float32)
+        penalty_registered = np.zeros_like(rewards, dtype=bool)
+        alive = self.uav_energy > 0
+
+        # Moves off the map or into obstacles leave the UAV in place.
+        targets = self.uav_positions + ACTION_DELTAS[actions]
+        blocked = alive & ~open_move_mask(self.open_moves[env_idx, self._uav_cells()], actions)
+        rewards[blocked] += self.reward_obstacle
+        self._register_no_progress(blocked, rewards)
+        penalty_registered |= blocked
+
+        moving = alive & ~blocked
+        attempted = np.where(moving[..., None], targets, self.uav_positions)
+
+        # Any two UAVs (alive or not) ending on the same cell collide.
+        keys = attempted[..., 0] * self.width + attempted[..., 1]
+        collided = alive & self._duplicate_mask(keys)
+        rewards[collided] += self.reward_collision
+        self._register_no_progress(collided, rewards)
+        penalty_registered |= collided
+
+        landed = alive & ~collided
+        self.uav_positions = np.where(landed[..., None], attempted, self.uav_positions)
+        self.uav_energy = np.where(landed, np.maximum(0, self.uav_energy - 1), self.uav_energy)
+
+        rows, cols = self.uav_positions[..., 0], self.uav_positions[..., 1]
+        fresh = landed & ~self.visited_maps[env_idx, rows, cols]
+
+        bonus = new_cell_rewards(
+            fresh, self._remaining_free_cells(), self.reward_new_cell_base, max(self.height, self.width)
+        )
+        rewards[fresh] += bonus[fresh]
+        self.visited_maps[np.broadcast_to(env_idx, rows.shape)[fresh], rows[fresh], cols[fresh]] = True
+        self.visited_count += fresh.sum(axis=1)
+        cells = rows * self.width + cols
+        for env_id in np.flatnonzero(fresh.any(axis=1)):
+            self.envs[env_id].frontier_field.remove_sources(cells[env_id, fresh[env_id]].tolist())
+        self.no_progress_steps[fresh] = 0
+
+        stale = landed & ~fresh
+        rewards[stale] += self.reward_visited_cell
+        self._register_no_progress(stale, rewards)
+        penalty_registered |= stale
+
+        idle = (self.uav_energy > 0) & ~fresh & ~penalty_registered
+        self._register_no_progress(idle, rewards, gentle=True)
+
+        # Potential-based shaping reward
+        potential_new = self._state_potential(np.arange(self.num_envs))
+        apply_shaping(rewards, self.prev_potential, potential_new, self.uav_energy > 0, self.shaping_weight)
+
+        self.step_count += 1
+        self.episode_reward += rewards.sum(axis=1)
+
+        terminated = self._is_covered()
+        truncated = (self.step_count >= self.max_steps) | np.all(self.uav_energy <= 0, axis=1)
+        rewards[terminated] += self.reward_complete / self.num_uavs
+
+        observation = self._get_observation()
+        info = self._get_info()
+        info.update(
+            {
+                "collisions": collided.sum(axis=1),
+                "obstacle_hits": blocked.sum(axis=1),
+                "reward_vector": rewards.copy(),
+            }
+        )
+
+        done = terminated | truncated
+        info["_final_observation"] = done
+        info["final_observation"] = observation.copy()
+        info["final_avail_actions"] = info["avail_actions"].copy()
+        if done.any():
+            finished = np.flatnonzero(done)
+            self._reset_envs(finished)
+            observation[finished] = self._get_observation()[finished]
+            info["avail_actions"][finished] = self._available_actions()[finished]
+
+        return observation, rewards, terminated, truncated, info
+
+    def _reset_envs(self, env_ids: np.ndarray) -> None:
+        self.step_count[env_ids] = 0
+        self.episode_reward[env_ids] = 0.0
+        self.visited_maps[env_ids] = False
+        self.uav_energy[env_ids] = self.energy_budget
+        self.no_progress_steps[env_ids] = 0
+        for env_id in env_ids:
+            env = self.envs[env_id]
+            if env.scenario_bank is not None:
+                positions = env._draw_scenario()
+                self.obstacle_maps[env_id] = env.obstacle_manager.get_obstacle_view()
+                self.clearance[env_id] = env.obstacle_manager.clearance_field
+            else:
+                positions = np.array(env._initial_positions(), dtype=np.int64)
+            env._analyse_reachability(positions)
+            if env.coverage_cells == "repair":
+                self.obstacle_maps[env_id] = env.obstacle_manager.get_obstacle_view()
+                self.clearance[env_id] = env.obstacle_manager.clearance_field
+            if env._table_version != env.obstacle_manager.map_version:
+                env._build_neighbour_table(~self.obstacle_maps[env_id])
+            self.valid_cells[env_id] = env.valid_cells
+            self.reachable_cells[env_id] = env.reachable_cells
+            self.coverage_total[env_id] = env.total_cells if env.coverage_cells == "all" else env.valid_cells
+            self.uav_positions[env_id] = positions
+            self.visited_maps[env_id, positions[:, 0], positions[:, 1]] = True
+            free = ~self.obstacle_maps[env_id]
+            env.frontier_field.reset(sources=free & ~self.visited_maps[env_id], passable=free)
+        self.visited_count[env_ids] = self.visited_maps[env_ids].sum(axis=(1, 2))
+        self.prev_potential[env_ids] = self._state_potential(env_ids)
+
+    def _register_no_progress(
+        self, mask: np.ndarray, rewards: np.ndarray, gentle: bool = False
+    ) -> None:
+        penalty = self.reward_no_progress if not gentle else self.reward_no_progress * 0.5
+        register_no_progress(self.no_progress_steps, mask, rewards, self.no_progress_patience, penalty)
+
+    @staticmethod
+    def _duplicate_mask(keys: np.ndarray) -> np.ndarray:
+        """Mark entries whose key occurs more than once in the same row."""
+        order = np.argsort(keys, axis=1, kind="stable")
+        ordered = np.take_along_axis(keys, order, axis=1)
+        same_as_next = ordered[:, 1:] == ordered[:, :-1]
+        dup_sorted = np.zeros_like(ordered, dtype=bool)
+        dup_sorted[:, 1:] |= same_as_next
+        dup_sorted[:, :-1] |= same_as_next
+        duplicates = np.empty_like(dup_sorted)
+        np.put_along_axis(duplicates, order, dup_sorted, axis=1)
+        return duplicates
+
+    def _state_potential(self, env_ids: np.ndarray) -> np.ndarray:
+        positions = self.uav_positions[env_ids]
+        rows, cols = positions[..., 0], positions[..., 1]
+        distance = self.frontier_fields.lookup(env_ids[:, None], rows, cols)
+        clearance = self.clearance[env_ids[:, None], rows, cols]
+        return shaping_potential(distance, clearance, self.obstacle_shaping_weight).astype(np.float32)
+
+    def _uav_cells(self) -> np.ndarray:
+        return self.uav_positions[..., 0] * self.width + self.uav_positions[..., 1]
+
+    def _available_actions(self) -> np.ndarray:
+        """(N, U, 4) mask of moves that stay on the map and off obstacles.
+
+        Uses the open-move test of ``GridWorldEnv._available_actions``,
+        including its all-true row for a UAV with no such move.
+        """
+        available = open_move_mask(
+            self.open_moves[self._env_index, self._uav_cells()][..., None], np.arange(len(Action))
+        )
+        available[~available.any(axis=-1)] = True
+        return available
+
+    def _remaining_free_cells(self) -> np.ndarray:
+        # Only valid cells can be visited on static maps.
+        return self.valid_cells - self.visited_count
+
+    def _is_covered(self) -> np.ndarray:
+        return self._remaining_free_cells() == 0
+
+    def _get_observation(self) -> np.ndarray:
+        # Same layout, dtype and quantisation as ``GridWorldEnv.global_state``.
+        return self.envs[0].render_global_states(
+            self.visited_maps, self.obstacle_maps, self.uav_positions, self.uav_energy
+        )
+
+    def _get_info(self) -> Dict[str, Any]:
+        return {
+            "coverage": self.visited_count / np.maximum(1, self.coverage_total),
+            "coverage_total": self.coverage_total.copy(),
+            "reachable_coverage": self.visited_count / np.maximum(1, self.reachable_cells),
+            "valid_cells": self.valid_cells.copy(),
+            "steps": self.step_count.copy(),
+            "energy": self.uav_energy.copy(),
+            "uav_positions": self.uav_positions.copy(),
+            "visited_cells": self.visited_count.copy(),
+            "visited_count": self.visited_count.copy(),
+            "remaining_free_cells": self._remaining_free_cells(),
+            "avail_actions": self._available_actions(),
+        }
+
+    def close(self) -> None:
+        for env in self.envs:
+            env.close()
+
+
+def _shared_array(raw: Any, shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _subproc_worker(
+    remote: Connection,
+    parent_remote: Connection,
+    env_kwargs: Dict[str, Any],
+    seeds: Sequence[Optional[int]],
+    env_slice: slice,
+    buffers: Dict[str, Tuple[Any, Tuple[int, ...], str]],
+) -> None:
+    """Step a slice of environments, writing results into the shared buffers."""
+    parent_remote.close()
+    arrays = {name: _shared_array(raw, shape, np.dtype(dtype)) for name, (raw, shape, dtype) in buffers.items()}
+    observations = arrays["observations"][env_slice]
+    final_observations = arrays["final_observations"][env_slice]
+    rewards = arrays["rewards"][env_slice]
+    terminated = arrays["terminated"][env_slice]
+    truncated = arrays["truncated"][env_slice]
+    actions = arrays["actions"][env_slice]
+    try:
+        envs = [GridWorldEnv(seed=seed, reuse_observation_buffer=True, **env_kwargs) for seed in seeds]
+        while True:
+            command, payload = remote.recv()
+            if command == "step":
+                infos = []
+                for idx, env in enumerate(envs):
+                    observation, reward, term, trunc, info = env.step(actions[idx])
+                    rewards[idx] = reward
+                    terminated[idx], truncated[idx] = term, trunc
+                    if term or trunc:
+                        final_observations[idx] = observation
+                        observation, _ = env.reset()
+                    observations[idx] = observation
+                    infos.append(info)
+                remote.send(("ok", infos))
+            elif command == "reset":
+                infos = []
+                for idx, env in enumerate(envs):
+                    seed = None if payload is None else payload + idx
+                    observation, info = env.reset(seed=seed)
+                    observations[idx] = observation
+                    infos.append(info)
+                remote.send(("ok", infos))
+            elif command == "close":
+                for env in envs:
+                    env.close()
+                remote.send(("ok", None))
+                break
+            else:
+                raise ValueError(f"Unknown worker command: {command}")
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        remote.send(("error", traceback.format_exc()))
+    finally:
+        remote.close()
+
+
+class SubprocGridWorldEnv:
+    """Runs ``num_envs`` ``GridWorldEnv`` instances in worker processes.
+
+    Environments are split into contiguous slices, one per worker. Actions,
+    observations, rewards and done flags travel through shared-memory arrays;
+    only the per-env ``info`` dicts are pickled. Environment ``i`` behaves
+    exactly like ``GridWorldEnv(seed=seed + i, **env_kwargs)`` and resets
+    automatically the way ``BatchedGridWorldEnv`` does, so every observation
+    mode and obstacle type is supported.
+
+    ``step_async``/``step_wait`` let the caller work while the workers step.
+    """
+
+    def __init__(
+        self,
+        num_envs: int,
+        seed: Optional[int] = None,
+        num_workers: Optional[int] = None,
+        start_method: Optional[str] = None,
+        **env_kwargs: Any,
+    ) -> None:
+        if num_envs < 1:
+            raise ValueError(f"num_envs must be positive, received {num_envs}")
+        if num_workers is not None and num_workers < 1:
+            raise ValueError(f"num_workers must be positive, received {num_workers}")
+        num_workers = min(num_envs, num_workers or os.cpu_count() or 1)
+        env_kwargs.pop("reuse_observation_buffer", None)
+
+        template = GridWorldEnv(**env_kwargs)
+        self.num_envs = num_envs
+        self.num_uavs = template.num_uavs
+        self.state_dim = template.state_dim
+        self.single_observation_space = template.observation_space
+        self.single_action_space = template.action_space
+        obs_shape = (num_envs,) + self.single_observation_space.shape
+        obs_dtype = self.single_observation_space.dtype
+        self.observation_space = spaces.Box(
+            low=0, high=self.single_observation_space.high.max(), shape=obs_shape, dtype=obs_dtype
+        )
+        self.action_space = spaces.MultiDiscrete(
+            np.tile(self.single_action_space.nvec, (num_envs, 1))
+        )
+        template.close()
+
+        ctx = mp.get_context(start_method)
+        specs = {
+            "observations": (obs_shape, obs_dtype),
+            "final_observations": (obs_shape, obs_dtype),
+            "rewards": ((num_envs, self.num_uavs), np.dtype(np.float32)),
+            "terminated": ((num_envs,), np.dtype(bool)),
+            "truncated": ((num_envs,), np.dtype(bool)),
+            "actions": ((num_envs, self.num_uavs), np.dtype(np.int64)),
+        }
+        buffers = {}
+        self._arrays: Dict[str, np.ndarray] = {}
+        for name, (shape, dtype) in specs.items():
+            raw = ctx.RawArray("B", max(1, int(np.prod(shape)) * dtype.itemsize))
+            buffers[name] = (raw, shape, dtype.str)
+            self._arrays[name] = _shared_array(raw, shape, dtype)
+
+        bounds = np.linspace(0, num_envs, num_workers + 1).astype(int)
+        self._slices = [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+        self._remotes: List[Connection] = []
+        self._processes = []
+        for env_slice in self._slices:
+            seeds = [None if seed is None else seed + idx for idx in range(env_slice.start, env_slice.stop)]
+            remote, worker_remote = ctx.Pipe()
+            process = ctx.Process(
+                target=_subproc_worker,
+                args=(worker_remote, remote, env_kwargs, seeds, env_slice, buffers),
+                daemon=True,
+            )
+            process.start()
+            worker_remote.close()
+            self._remotes.append(remote)
+            self._processes.append(process)
+        self._waiting = False
+        self._closed = False
+
+    def reset(self, *, seed: Optional[int] = None) -> Tuple[np.ndarray, Dict[str, Any]]:
+        for remote, env_slice in zip(self._remotes, self._slices):
+            remote.send(("reset", None if seed is None else seed + env_slice.start))
+        infos = self._gather()
+        return self._arrays["observations"].copy(), self._stack_infos(infos)
+
+    def step_async(self, actions: np.ndarray) -> None:
+        actions = np.asarray(actions, dtype=np.int64)
+        if actions.shape != (self.num_envs, self.num_uavs):
+            raise ValueError(
+                f"Expected actions of shape {(self.num_envs, self.num_uavs)}, received {actions.shape}"
+            )
+        self._arrays["actions"][...] = actions
+        for remote in self._remotes:
+            remote.send(("step", None))
+        self._waiting = True
+
+    def step_wait(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, Dict[str, Any]]:
+        infos = self._gather()
+        terminated = self._arrays["terminated"].copy()
+        truncated = self._arrays["truncated"].copy()
+        info = self._stack_infos(infos)
+        done = terminated | truncated
+        info["_final_observation"] = done
+        info["final_observation"] = np.where(
+            done.reshape((-1,) + (1,) * (self._arrays["observations"].ndim - 1)),
+            self._arrays["final_observations"],
+            self._arrays["observations"],
+        )
+        return self._arrays["observations"].copy(), self._arrays["rewards"].copy(), terminated, truncated, info
+
+    def step(
+        self, actions: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, Dict[str, Any]]:
+        self.step_async(actions)
+        return self.step_wait()
+
+    def _gather(self) -> List[Dict[str, Any]]:
+        infos: List[Dict[str, Any]] = []
+        errors = []
+        for remote in self._remotes:
+            status, payload = remote.recv()
+            if status == "error":
+                errors.append(payload)
+            else:
+                infos.extend(payload)
+        self._waiting = False
+        if errors:
+            self.close()
+            raise RuntimeError("GridWorldEnv worker failed:\n" + "\n".join(errors))
+        return infos
+
+    @staticmethod
+    def _stack_infos(infos: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return {key: np.stack([np.asarray(info[key]) for info in infos]) for key in infos[0]}
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        for remote, process in zip(self._remotes, self._processes):
+            try:
+                if self._waiting:
+                    remote.recv()
+                if process.is_alive():
+                    remote.send(("close", None))
+                    remote.recv()
+            except (OSError, EOFError):
+                pass
+            remote.close()
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()